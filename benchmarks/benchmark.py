@@ -0,0 +1,316 @@
+"""
+This script benchmarks libra on synthetic images of several sizes.
+
+It times every metric in every color space, with torch and with the NumPy backend of the
+classical metrics, metric maps at several window and step sizes, and image differences,
+measures the memory allocated to convert images to tensors, and saves the results as JSON
+so that runs on different commits can be compared.
+
+Usage:
+   python benchmarks/benchmark.py run -o results.json
+   python benchmarks/benchmark.py run --sizes 128 512 --metrics SSIM PSNR -o results.json
+   python benchmarks/benchmark.py run --sizes 2160 --metrics PSNR --color-spaces RGB -o 4k.json
+   python benchmarks/benchmark.py compare before.json after.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+import platform
+import tempfile
+import subprocess
+import statistics
+import warnings
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import libra as libra
+from libra.numpy_backend import numpy_metrics
+
+
+default_sizes = [128, 512, 1024]
+default_map_settings = [(11, 5), (161, 50)]
+default_map_metrics = ["MSE", "PSNR", "SSIM", "GMSD"]
+
+
+def synthetic_pair(size, seed=0):
+    """
+    Build a smooth reference image and a noisy, blurred distorted version of it.
+
+    Args:
+        size (int): Width and height of the images.
+        seed (int, optional): Seed of the random generator.
+
+    Returns:
+        tuple: (distorted image, reference image) as BGR uint8 arrays.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    ref = np.stack([np.sin(6 * x + 2 * y), np.cos(4 * y - 3 * x), np.sin(9 * x * y)], axis=2)
+    ref = ((ref + 1) * 127.5).astype(np.uint8)
+
+    dist = cv2.GaussianBlur(ref, (5, 5), 1.0).astype(np.int16)
+    dist += rng.normal(0, 6, ref.shape).astype(np.int16)
+    dist = np.clip(dist, 0, 255).astype(np.uint8)
+    return dist, ref
+
+
+def time_call(fn, repeat):
+    """
+    Time a function, after a first call that includes model loading and lazy imports.
+
+    Args:
+        fn (callable): Function to time, called without arguments.
+        repeat (int): Number of timed calls.
+
+    Returns:
+        dict: 'first' call time, 'times' of the timed calls, their 'min' and 'median',
+            and 'error' (None, or the error message if the function failed).
+    """
+    result = {'first': None, 'times': [], 'min': None, 'median': None, 'error': None}
+    try:
+        start = time.perf_counter()
+        fn()
+        result['first'] = time.perf_counter() - start
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            result['times'].append(time.perf_counter() - start)
+    except Exception as e:
+        result['error'] = f"{type(e).__name__}: {e}"
+        return result
+
+    result['min'] = min(result['times'])
+    result['median'] = statistics.median(result['times'])
+    return result
+
+
+def allocated_bytes(fn):
+    """
+    Measure the memory allocated by a function.
+
+    Args:
+        fn (callable): Function to measure, called without arguments.
+
+    Returns:
+        int: Peak of the NumPy allocations traced by tracemalloc, plus the CPU memory
+            allocated by torch operators as recorded by the torch profiler.
+    """
+    from torch.profiler import profile, ProfilerActivity
+
+    tracemalloc.start()
+    try:
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            fn()
+        numpy_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    torch_bytes = sum(max(event.self_cpu_memory_usage, 0) for event in prof.events())
+    return numpy_bytes + torch_bytes
+
+
+def copying_conversion(image):
+    '''Conversion of an image to a tensor copying it at each step: float32, normalized, tensor'''
+    import torch
+    image = image.astype(np.float32) / 255.0
+    return torch.tensor(image).permute(2, 0, 1).unsqueeze(0).float()
+
+
+def run_memory_benchmarks(sizes):
+    """
+    Measure the memory allocated to convert an image to a tensor: by preprocess_image, by
+    preprocess_image reusing the tensor of a previous image, and by copying_conversion.
+
+    Returns:
+        list: One dictionary per benchmark with its 'name', 'group', 'params', the allocated
+            'bytes', and the 'savings', fraction of the bytes of copying_conversion saved.
+    """
+    from libra.metrics import preprocess_image
+
+    results = []
+    for size in sizes:
+        dist, _ = synthetic_pair(size)
+        previous = preprocess_image(dist)
+        conversions = {
+            'copying': lambda: copying_conversion(dist),
+            'preprocess': lambda: preprocess_image(dist),
+            'preprocess_reused': lambda: preprocess_image(dist, previous),
+        }
+        measured = {conversion: allocated_bytes(fn) for conversion, fn in conversions.items()}
+
+        for conversion, allocated in measured.items():
+            params = {'conversion': conversion, 'size': size}
+            name = "/".join(["memory"] + [str(value) for value in params.values()])
+            savings = 1 - allocated / measured['copying']
+            results.append(dict(name=name, group="memory", params=params, bytes=allocated, savings=savings,
+                                median=None, error=None))
+            print(f"{name}: {allocated / 2**20:.1f} MiB ({savings:.0%} saved)", flush=True)
+
+    return results
+
+
+def run_benchmarks(sizes, metric_names, color_space_names, map_settings, map_metric_names, repeat):
+    """
+    Run all the benchmarks.
+
+    Returns:
+        list: One dictionary per benchmark with its 'name', 'group', 'params' and timings.
+    """
+    results = []
+
+    def record(group, params, fn):
+        name = "/".join([group] + [str(value) for value in params.values()])
+        timing = time_call(fn, repeat)
+        results.append(dict(name=name, group=group, params=params, **timing))
+        status = timing['error'] if timing['error'] else f"{timing['median']:.4f} s"
+        print(f"{name}: {status}", flush=True)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in sizes:
+            dist, ref = synthetic_pair(size)
+            dist_path = os.path.join(temp_dir, f"dist_{size}.png")
+            ref_path = os.path.join(temp_dir, f"ref_{size}.png")
+            cv2.imwrite(dist_path, dist)
+            cv2.imwrite(ref_path, ref)
+
+            for metric_name in metric_names:
+                for color_space_name in color_space_names:
+                    record("metric", {'metric': metric_name, 'color_space': color_space_name, 'size': size},
+                           lambda: libra.compute_metric(dist, ref, metric_name, color_space_name))
+                    if metric_name in numpy_metrics:
+                        record("numpy", {'metric': metric_name, 'color_space': color_space_name, 'size': size},
+                               lambda: libra.compute_metric(dist, ref, metric_name, color_space_name, backend='numpy'))
+
+            for patch_size, step in map_settings:
+                if patch_size > size:
+                    continue
+                for metric_name in map_metric_names:
+                    def compute_map():
+                        plt = libra.compute_map(dist_path, ref_path, metric_name, 'HSV', patch_size, step)
+                        plt.close()
+                    record("map", {'metric': metric_name, 'window': patch_size, 'step': step, 'size': size}, compute_map)
+
+            for color_space_name in color_space_names:
+                record("diff", {'color_space': color_space_name, 'size': size},
+                       lambda: libra.diff_images(ref_path, dist_path, 10, color_space_name))
+
+    return results
+
+
+def environment():
+    '''Description of the environment of the run'''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+
+    versions = {}
+    for package in ["numpy", "cv2", "torch", "piq", "pyiqa"]:
+        try:
+            versions[package] = __import__(package).__version__
+        except ImportError:
+            versions[package] = None
+
+    return {
+        'commit': commit,
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'versions': versions,
+    }
+
+
+def compare(before_path, after_path, threshold):
+    """
+    Print the benchmarks whose median time, or allocated memory, changed by more than a ratio
+    between two runs.
+
+    Args:
+        before_path (str): JSON results of the first run.
+        after_path (str): JSON results of the second run.
+        threshold (float): Ratio above which a change is reported, e.g. 1.2 for 20%.
+
+    Returns:
+        int: Number of regressions.
+    """
+    with open(before_path) as file:
+        before = {result['name']: result for result in json.load(file)['results']}
+    with open(after_path) as file:
+        after = {result['name']: result for result in json.load(file)['results']}
+
+    regressions = 0
+    print(f"{'benchmark':<40} {'before (s)':>12} {'after (s)':>12} {'ratio':>8}")
+    for name, result in after.items():
+        if name not in before or result['median'] is None or before[name]['median'] is None:
+            continue
+        ratio = result['median'] / before[name]['median']
+        if ratio > threshold or ratio < 1 / threshold:
+            flag = "slower" if ratio > 1 else "faster"
+            regressions += ratio > 1
+            print(f"{name:<40} {before[name]['median']:>12.4f} {result['median']:>12.4f} {ratio:>8.2f} {flag}")
+
+    for name, result in after.items():
+        if name not in before or not result.get('bytes') or not before[name].get('bytes'):
+            continue
+        ratio = result['bytes'] / before[name]['bytes']
+        if ratio > threshold or ratio < 1 / threshold:
+            flag = "more memory" if ratio > 1 else "less memory"
+            regressions += ratio > 1
+            print(f"{name:<40} {before[name]['bytes']:>12d} {result['bytes']:>12d} {ratio:>8.2f} {flag}")
+
+    print(f"{regressions} regressions above {threshold:.2f}x")
+    return regressions
+
+
+def main():
+    warnings.filterwarnings("ignore")
+
+    parser = argparse.ArgumentParser(description="Benchmark libra on synthetic images")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument('-o', '--output', type=str, default="benchmark.json", help='Output JSON file')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=default_sizes, help='Image sizes')
+    run_parser.add_argument('--metrics', type=str, nargs='+', default=None, help='Metrics to time; default is all')
+    run_parser.add_argument('--color-spaces', type=str, nargs='+', default=None, help='Color spaces; default is all')
+    run_parser.add_argument('--map-metrics', type=str, nargs='+', default=default_map_metrics, help='Metrics to time maps for')
+    run_parser.add_argument('--map-settings', type=str, nargs='+', default=None, help='Map window:step settings e.g. 11:5')
+    run_parser.add_argument('--repeat', type=int, default=3, help='Number of timed calls per benchmark')
+
+    compare_parser = subparsers.add_parser("compare", help="compare two runs")
+    compare_parser.add_argument('before', type=str, help='JSON results of the first run')
+    compare_parser.add_argument('after', type=str, help='JSON results of the second run')
+    compare_parser.add_argument('--threshold', type=float, default=1.2, help='Ratio above which a change is reported')
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        regressions = compare(args.before, args.after, args.threshold)
+        sys.exit(1 if regressions else 0)
+
+    metric_names = args.metrics or list(libra.list_metrics())
+    color_space_names = args.color_spaces or list(libra.list_colorspaces())
+    map_settings = default_map_settings
+    if args.map_settings is not None:
+        map_settings = [tuple(int(value) for value in setting.split(':')) for setting in args.map_settings]
+
+    results = run_benchmarks(args.sizes, metric_names, color_space_names, map_settings, args.map_metrics, args.repeat)
+    results += run_memory_benchmarks(args.sizes)
+
+    with open(args.output, 'w') as file:
+        json.dump({'environment': environment(), 'results': results}, file, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -24,12 +24,15 @@ import os
 import sys
 import json
 import argparse
-import pandas as pd
 import warnings
+
 import numpy as np
-from datetime import datetime
 
 import libra as libra
+from libra import profiling
+from libra import inference
+from libra.result_cache import default_cache_path
+from libra.image_difference import difference_image
 
 
 def read_config(config_path):
@@ -56,6 +59,318 @@ def read_config(config_path):
 
 
 
+def run_batch_mode(manifest_path, ref_dir, dist_dir, metric_names, color_space_names, output_path, workers, num_threads=1):
+    """
+    Compute metrics for all the image pairs of a manifest or of two directories.
+
+    Args:
+        manifest_path (str): Path to a CSV or JSON-lines manifest, or None.
+        ref_dir (str): Directory of reference images, used if manifest_path is None.
+        dist_dir (str): Directory of distorted images, paired by file name with ref_dir.
+        metric_names (list of str): metrics to compute.
+        color_space_names (list of str): color spaces to use.
+        output_path (str): Path to the output CSV file.
+        workers (int): Number of worker processes, or None for the number of CPUs.
+        num_threads (int, optional): Torch threads per worker. Default is 1.
+    """
+    from libra.batch import read_manifest, pair_directories, run_batch
+
+    if manifest_path is not None:
+        pairs = read_manifest(manifest_path)
+    elif dist_dir is None:
+        print("Error: a comparison directory is required with a reference directory.")
+        sys.exit(1)
+    else:
+        pairs = pair_directories(ref_dir, dist_dir)
+
+    print(f"Comparing {len(pairs)} image pairs...")
+    done, failed = run_batch(pairs, metric_names, color_space_names, output_path, workers, num_threads)
+    print(f"Results for {done} pairs ({failed} failed) saved to {output_path}")
+
+
+
+def comparison_paths(dist_path):
+    """
+    Expand the comparison argument into the list of comparison images.
+
+    Args:
+        dist_path (str or list of str): Comparison image, comma separated images, glob
+            pattern of images, or a list of any of these.
+
+    Returns:
+        list of str: The comparison images, None if dist_path is a single image.
+    """
+    import glob
+
+    if dist_path is None or (isinstance(dist_path, str) and ',' not in dist_path and not glob.has_magic(dist_path)):
+        return None
+    entries = dist_path if isinstance(dist_path, list) else dist_path.split(',')
+    paths = []
+    for entry in entries:
+        entry = entry.strip()
+        paths.extend(sorted(glob.glob(entry)) if glob.has_magic(entry) else [entry])
+    return paths
+
+
+
+def run_fan_out_mode(ref_path, dist_paths, metric_names, color_space_names, output_path):
+    """
+    Compute metrics between one reference and many comparison images, processing the
+    reference once.
+
+    Args:
+        ref_path (str): Path to the reference image.
+        dist_paths (list of str): Paths to the comparison images.
+        metric_names (list of str): metrics to compute.
+        color_space_names (list of str): color spaces to use.
+        output_path (str): Path to the output CSV file.
+    """
+    from libra.batch import run_fan_out
+
+    print(f"Comparing {len(dist_paths)} images to {ref_path}...")
+    done, failed = run_fan_out(ref_path, dist_paths, metric_names, color_space_names, output_path)
+    print(f"Results for {done} images ({failed} failed) saved to {output_path}")
+
+
+
+def run_sequence_mode(ref_source, dist_source, metric_names, color_space_names, output_path):
+    """
+    Compute metrics frame by frame between two videos or frame sequences.
+
+    Args:
+        ref_source (str): Reference video, directory of frames, or glob pattern of frames.
+        dist_source (str): Comparison sequence, in the same forms.
+        metric_names (list of str): metrics to compute.
+        color_space_names (list of str): color spaces to use.
+        output_path (str): Path to the per-frame CSV file; the aggregates are saved next to it.
+    """
+    from libra.sequence import compare_sequences, summary_path
+
+    print(f"Comparing the frames of {dist_source} to {ref_source}...")
+    try:
+        summary = compare_sequences(ref_source, dist_source, metric_names, color_space_names, output_path)
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit(1)
+
+    for row in summary:
+        print(f"{row['Metric']} ({row['Color space']}): mean {row['Mean']:.6g}, min {row['Min']:.6g}, "
+              f"worst frames {row['Worst frames']}")
+    print(f"Per-frame results saved to {output_path} and aggregates to {summary_path(output_path)}")
+
+
+
+def run_tiled_mode(dist_path, ref_path, generate_metrics, generate_maps, metric_names, color_space_names,
+                   window_size, step_size, batch_size, memory_budget, output_folder_path, csv_path):
+    """
+    Compute metrics and maps of large images tile by tile within a memory budget.
+
+    Args:
+        dist_path (str): Path of distorted image.
+        ref_path (str): Path of reference image.
+        generate_metrics (bool): Flag to compute metrics.
+        generate_maps (bool): Flag to compute metric maps, saved as .npy files.
+        metric_names (list of str): metrics to compute.
+        color_space_names (list of str): color spaces to use.
+        window_size (int): Window size for maps.
+        step_size (int): Step size for maps.
+        batch_size (int): Number of patches evaluated together for maps.
+        memory_budget (int): Memory budget in bytes.
+        output_folder_path (str): Folder where the maps are saved.
+        csv_path (str): Path to the output CSV file of the metrics.
+    """
+    from libra.tiling import compute_metric_tiled, compute_map_tiled
+
+    if generate_metrics:
+        print("Computing metrics tile by tile...")
+        results = []
+        for metric_name in metric_names:
+            metric_result = {'Metric': metric_name}
+            for color_space_name in color_space_names:
+                try:
+                    metric_result[color_space_name] = compute_metric_tiled(dist_path, ref_path, metric_name, color_space_name, memory_budget)
+                except ValueError as e:
+                    print(f"Error: {e}")
+                    metric_result[color_space_name] = float("nan")
+            results.append(metric_result)
+
+        import pandas as pd
+        pd.DataFrame(results).to_csv(csv_path, index=False)
+        print(f"Results saved to {csv_path}")
+
+    if generate_maps:
+        print("Computing metric maps tile by tile...")
+        for color_space in color_space_names:
+            for metric_name in metric_names:
+                output_path = os.path.join(output_folder_path, f"map_{color_space}_{metric_name}.npy")
+                compute_map_tiled(dist_path, ref_path, metric_name, color_space, window_size, step_size,
+                                  memory_budget, output_path, batch_size)
+                print(f"Map for colorspace {color_space} and metric {metric_name} saved to {output_path}")
+
+
+
+def save_metric_map(dist_path, ref_path, metric_name, color_space, window_size, step_size, colormap,
+                    batch_size, renderer, save_array, output_prefix):
+    """
+    Compute a metric map and save it as an image, and optionally as an array.
+
+    Args:
+        dist_path (str): Path of distorted image.
+        ref_path (str): Path of reference image.
+        metric_name (str): metric name.
+        color_space (str): name of the color space.
+        window_size (int): Window size for the map.
+        step_size (int): Step size for the map.
+        colormap (str): Name of the colormap.
+        batch_size (int): Number of patches evaluated together.
+        renderer (str): 'matplotlib' for a figure, or 'opencv' for a faster rendering with a colorbar.
+        save_array (bool): Also save the float32 map as a .npy file.
+        output_prefix (str): Path of the outputs without extension.
+    """
+    if renderer == "matplotlib" and not save_array:
+        plt = libra.compute_map(dist_path, ref_path, metric_name, color_space, window_size, step_size, colormap, batch_size)
+    else:
+        metric_map, metadata = libra.compute_metric_map(dist_path, ref_path, metric_name, color_space, window_size, step_size, batch_size)
+        if save_array:
+            np.save(f"{output_prefix}.npy", metric_map)
+
+        if renderer == "opencv":
+            libra.save_map(metric_map, f"{output_prefix}.png", colormap, title=f"{metric_name} ({color_space})",
+                           caption=f"Patch Size: {window_size}, Step Size: {step_size}")
+            return
+
+        from libra.map_computation import plot_map
+        import matplotlib.pyplot as plt
+        plt.figure()
+        plot_map(metric_map, metric_name, color_space, window_size, step_size, colormap)
+
+    with profiling.stage('savefig'):
+        plt.savefig(f"{output_prefix}.png")
+    plt.close()
+
+
+
+def save_dense_metric_map(image_pair, metric_name, color_space, colormap, map_writer, output_prefix):
+    """
+    Compute the dense map of a metric from its per-pixel map, and save it.
+
+    Args:
+        image_pair (ImagePair): The distorted and reference images.
+        metric_name (str): metric name, one of dense_map_metrics.
+        color_space (str): name of the color space.
+        colormap (str): Name of the colormap of the image.
+        map_writer (MapWriter): Container to write the map to, instead of an image; None for an image.
+        output_prefix (str): Path of the image without extension.
+    """
+    from libra.dense_maps import dense_map_metrics
+
+    if metric_name not in dense_map_metrics:
+        print(f"No dense map for {metric_name}, use one of {', '.join(dense_map_metrics)}")
+        return
+
+    metric_map, metadata = libra.compute_dense_map(image_pair, None, metric_name, color_space)
+    if map_writer is not None:
+        map_writer.write(f"maps/{color_space}/{metric_name}", metric_map, metadata)
+    else:
+        libra.save_map(metric_map, f"{output_prefix}.png", colormap, title=f"{metric_name} ({color_space})",
+                       caption=f"Dense map, {metric_name}: {metadata['score']:.4f}")
+        print(f"Dense map for colorspace {color_space} and metric {metric_name} saved to {output_prefix}.png")
+
+
+
+def save_adaptive_metric_map(dist_path, ref_path, metric_name, color_space, patch_size, levels, batch_size,
+                             colormap, map_writer, output_prefix):
+    """
+    Compute a metric map coarse to fine, and save it with the level of each of its cells.
+
+    Args:
+        dist_path (str): Path of distorted image.
+        ref_path (str): Path of reference image.
+        metric_name (str): metric name.
+        color_space (str): name of the color space.
+        patch_size (int): Size of the finest cells.
+        levels (int): Number of refinements.
+        batch_size (int): Number of patches evaluated together.
+        colormap (str): Name of the colormap of the images.
+        map_writer (MapWriter): Container to write the map and levels to, instead of images; None for images.
+        output_prefix (str): Path of the images without extension.
+    """
+    from libra.adaptive_map import compute_adaptive_metric_map
+
+    metric_map, level_mask, metadata = compute_adaptive_metric_map(dist_path, ref_path, metric_name, color_space,
+                                                                   patch_size, levels, batch_size=batch_size)
+    if map_writer is not None:
+        map_writer.write(f"maps/{color_space}/{metric_name}", metric_map, metadata)
+        map_writer.write(f"levels/{color_space}/{metric_name}", level_mask, metadata)
+    else:
+        libra.save_map(metric_map, f"{output_prefix}.png", colormap, title=f"{metric_name} ({color_space})",
+                       caption=f"Patch Size: {patch_size}, Levels: {metadata['levels']}")
+        libra.save_map(level_mask.astype(np.float32), f"{output_prefix}_levels.png", colormap,
+                       title=f"{metric_name} ({color_space}) levels")
+    print(f"Adaptive map for colorspace {color_space} and metric {metric_name}: "
+          f"{metadata['patches']} patches evaluated instead of {metadata['dense_patches']}")
+
+
+
+def write_diff_statistics(dist_path, ref_path, color_space_names, threshold, output_folder_path):
+    """
+    Save the statistics of the difference of two images as CSV files: the number and
+    fraction of pixels above every threshold, and the bounding boxes of the changed regions.
+
+    Args:
+        dist_path (str): Path to the distorted image.
+        ref_path (str): Path to the reference image.
+        color_space_names (list of str): color spaces to compare the images in.
+        threshold (int): Pixels whose difference is above this value are changed, for the boxes.
+        output_folder_path (str): Folder of the diff_thresholds.csv and diff_boxes.csv files.
+    """
+    import pandas as pd
+
+    statistics = libra.diff_statistics(dist_path, ref_path, color_space_names, threshold)
+    thresholds, boxes = [], []
+    for color_space_name, stats in statistics.items():
+        for level, (count, fraction) in enumerate(zip(stats['counts'], stats['fractions'])):
+            thresholds.append({'Color space': color_space_name, 'Threshold': level, 'Pixels': count, 'Fraction': fraction})
+        for x, y, width, height, pixels in stats['boxes']:
+            boxes.append({'Color space': color_space_name, 'X': x, 'Y': y, 'Width': width, 'Height': height, 'Pixels': pixels})
+
+    thresholds_path = os.path.join(output_folder_path, "diff_thresholds.csv")
+    boxes_path = os.path.join(output_folder_path, "diff_boxes.csv")
+    pd.DataFrame(thresholds).to_csv(thresholds_path, index=False)
+    pd.DataFrame(boxes, columns=['Color space', 'X', 'Y', 'Width', 'Height', 'Pixels']).to_csv(boxes_path, index=False)
+    print(f"Difference statistics saved to {thresholds_path} and {boxes_path}")
+
+
+
+def profile_columns(before):
+    """
+    Time spent in each stage since the given totals, as extra CSV columns.
+
+    Args:
+        before (dict): Stage totals returned by profiling.totals() before the computation.
+
+    Returns:
+        dict: '<stage> (s)' -> time in seconds.
+    """
+    after = profiling.totals()
+    return {f"{name} (s)": after[name] - before.get(name, 0.0) for name in profiling.stages if name in after}
+
+
+
+def write_profile(output_folder_path):
+    """
+    Print the time spent in each stage and save it as a Chrome trace.
+
+    Args:
+        output_folder_path (str): Folder where profile_trace.json is saved.
+    """
+    print(profiling.report())
+    trace_path = os.path.join(output_folder_path, "profile_trace.json")
+    profiling.write_chrome_trace(trace_path)
+    print(f"Profile trace saved to {trace_path}, open it in chrome://tracing or https://ui.perfetto.dev")
+
+
+
 def main(argv):
     """
     Main function to compute IQA metrics and save the results.
@@ -73,17 +388,25 @@ def main(argv):
     parser.add_argument('-j', '--json', type=str, required=False, help='JSON Input file')
     
     required_arg = True
-    if '-j' in sys.argv or '--json' in sys.argv:
-        required_arg = False
+    for option in ['-j', '--json', '-b', '--manifest', '-rd', '--refdir', '--serve']:
+        if option in sys.argv:
+            required_arg = False
     
     parser.add_argument('-r', '--ref', type=str, required=required_arg, help='Refrence image')
-    parser.add_argument('-c', '--comparison', type=str, required=required_arg, help='Comparison image')
+    parser.add_argument('-c', '--comparison', type=str, required=required_arg, help='Comparison image; several comma separated images or a glob pattern are all compared to the reference, with metrics saved to the output CSV')
     
     parser.add_argument('-m', '--metrics', type=str, required=False, default="SSIM", help='metrics to use e.g SSIM')
     parser.add_argument('-d', '--imgdiff', required=False, action="store_true", help='generate image diff')
+    parser.add_argument('--diffstats', required=False, action="store_true", help='save the pixels above every difference threshold and the boxes of the changed regions as CSV, without rendering the difference')
     parser.add_argument('-p', '--mapdiff', required=False, action="store_true", help='generate image diff map')
     
-    #parser.add_argument('-o', '--output_directory', type=str, required=False, default="", help='Output directory')
+    parser.add_argument('-b', '--manifest', type=str, required=False, help='CSV or JSON-lines manifest of image pairs to compare in batch')
+    parser.add_argument('-rd', '--refdir', type=str, required=False, help='Directory of reference images to compare in batch, paired by file name')
+    parser.add_argument('-cd', '--cmpdir', type=str, required=False, help='Directory of comparison images to compare in batch, paired by file name')
+    parser.add_argument('-w', '--workers', type=int, required=False, default=None, help='Number of worker processes in batch; default is the number of CPUs')
+    parser.add_argument('-s', '--sequence', required=False, action="store_true", help='compare the reference and comparison as videos, frame directories or frame glob patterns, frame by frame')
+    parser.add_argument('-tm', '--tilememory', type=int, required=False, default=None, help='Evaluate large images tile by tile within this memory budget in MB; maps are saved as .npy')
+    parser.add_argument('-o', '--output', type=str, required=False, default="metrics.csv", help='Output CSV file in batch')
     
     parser.add_argument('-ds', '--diffcolspace', type=str, required=False, default="RGB", help='opencv color space to use for difference; default is JET')
     parser.add_argument('-dc', '--diffcolormap', type=str, required=False, default="JET", help='color map for map difference')
@@ -92,6 +415,24 @@ def main(argv):
     parser.add_argument('-pc', '--mapcolormap', type=str, required=False, default="gray", help='matplotlib color map for map difference, default is gray')
     parser.add_argument('-pw', '--windowsize', type=int, default=11, help='Window Size for map')
     parser.add_argument('-ps', '--stepsize', type=int, default=5, help='Step Size for map')
+    parser.add_argument('-pb', '--batchsize', type=int, default=64, help='Number of patches evaluated together for map')
+    parser.add_argument('-pr', '--maprenderer', type=str, default="matplotlib", choices=["matplotlib", "opencv"], help='Renderer of the map images; opencv is faster and uses the colormaps of the difference')
+    parser.add_argument('-pl', '--maplevels', type=int, default=0, help='compute the maps coarse to fine with this many refinements of cells of window size * 2^levels, refining only where the metric changes; saves the refinement levels too')
+    parser.add_argument('-pn', '--mapdense', required=False, action="store_true", help='compute dense maps of SSIM, GMSD, MDSI, HaarPSI, FSIM and VSI from their per-pixel maps, in one pass over the images')
+    parser.add_argument('-pa', '--maparrays', required=False, action="store_true", help='also save the values of the maps as .npy files')
+    
+    parser.add_argument('--mapstore', type=str, required=False, default=None, help='write the float32 maps and the differences to this single .h5, .zarr or .npz container instead of PNG images')
+    parser.add_argument('--serve', type=str, nargs='?', required=False, default=None, const="127.0.0.1:8765", help='run a comparison server on host:port or a Unix socket path, keeping the models of the metrics loaded; default is 127.0.0.1:8765')
+    parser.add_argument('--profile', required=False, action="store_true", help='report the time spent in each stage and save a Chrome trace')
+    parser.add_argument('--cache', type=str, nargs='?', required=False, default=None, const=default_cache_path, help='cache metric values and maps in this SQLite file; default is ~/.cache/libra/results.sqlite')
+    parser.add_argument('--cachesize', type=int, required=False, default=1024, help='Maximum size of the cache in MB, least recently used results are evicted first')
+    parser.add_argument('--threads', type=int, required=False, default=None, help='Number of torch threads; default is the torch default, and 1 per worker in batch')
+    parser.add_argument('--channelslast', required=False, action="store_true", help='run the models and images in the channels last memory format')
+    parser.add_argument('--bf16', required=False, action="store_true", help='run LPIPS and DISTS in bfloat16 on the CPU')
+    parser.add_argument('--compile', type=str, nargs='?', required=False, default=None, const='inductor', help='compile the LPIPS, DISTS and PieAPP models with torch.compile, optionally with this backend')
+    parser.add_argument('--backend', type=str, required=False, default="torch", choices=["torch", "onnx"], help='run the networks of LPIPS, DISTS, PieAPP, MUSIQ, NIMA and CLIPIQA with torch or ONNX Runtime')
+    parser.add_argument('--int8', required=False, action="store_true", help='quantize the matrix multiplications of the ONNX networks to int8')
+    parser.add_argument('--classical', type=str, required=False, default="auto", choices=["auto", "torch", "numpy"], help='compute MSE, PSNR, SSIM, GMSD and PHASH with torch, or with NumPy and OpenCV only; auto uses NumPy and OpenCV when torch is not installed')
     
     
     args = parser.parse_args()
@@ -117,10 +458,30 @@ def main(argv):
         color_spaces_to_use = config.get("color_spaces", ["RGB"])
         window_size = config.get("map_window_size", 11)
         step_size = config.get("map_step_size", 50)
+        batch_size = config.get("map_batch_size", 64)
+        map_renderer = config.get("map_renderer", "matplotlib")
+        save_map_arrays = config.get("save_map_arrays", False)
+        map_store_path = config.get("map_store")
+        map_levels = config.get("map_levels", 0)
+        map_dense = config.get("map_dense", False)
         generate_image_difference = config.get("generate_image_difference", False)
+        generate_difference_statistics = config.get("generate_difference_statistics", False)
         difference_threshold = config.get("difference_threshold", 10)
         map_colormap = config.get("map_colormap", "gray")
         diff_colormap = config.get("diff_colormap", "JET") 
+        manifest_path = config.get("manifest")
+        ref_dir = config.get("reference_directory")
+        dist_dir = config.get("distorted_directory")
+        workers = config.get("workers")
+        batch_output_path = os.path.join(output_folder_path, output_csv_name)
+        tile_memory = config.get("tile_memory_mb")
+        sequence = config.get("sequence", False)
+        profile = config.get("profile", False)
+        cache_path = config.get("cache")
+        if cache_path is True:
+            cache_path = default_cache_path
+        cache_max_mb = config.get("cache_max_mb", 1024)
+        inference_settings = config.get("inference", {})
         
     else:
         generate_metrics = False
@@ -129,22 +490,42 @@ def main(argv):
         
         generate_maps = args.mapdiff
         generate_image_difference = args.imgdiff
+        generate_difference_statistics = args.diffstats
         
         
         ref_path = args.ref
         dist_path = args.comparison
         
-        map_metrics = [args.metrics]   
-        color_spaces_to_use = [args.diffcolspace]
+        map_metrics = args.metrics.split(',')
+        color_spaces_to_use = args.diffcolspace.split(',')
         difference_threshold = args.diffthreshold
         window_size = args.windowsize
         step_size = args.stepsize
+        batch_size = args.batchsize
+        map_renderer = args.maprenderer
+        save_map_arrays = args.maparrays
+        map_store_path = args.mapstore
+        map_levels = args.maplevels
+        map_dense = args.mapdense
         map_colormap = args.mapcolormap
         diff_colormap = args.diffcolormap
+        manifest_path = args.manifest
+        ref_dir = args.refdir
+        dist_dir = args.cmpdir
+        workers = args.workers
+        batch_output_path = args.output
+        tile_memory = args.tilememory
+        sequence = args.sequence
+        profile = args.profile
+        cache_path = args.cache
+        cache_max_mb = args.cachesize
+        inference_settings = {'num_threads': args.threads, 'channels_last': args.channelslast,
+                              'bfloat16': args.bf16, 'compile': args.compile or False,
+                              'backend': args.backend, 'int8': args.int8, 'classical_backend': args.classical}
         
         
-    options =  generate_metrics or generate_maps or generate_image_difference
-    if options == False:
+    options =  generate_metrics or generate_maps or generate_image_difference or generate_difference_statistics
+    if options == False and args.serve is None:
         generate_metrics = True
         map_metrics = ['SSIM']
         color_spaces_to_use = ['LAB']
@@ -154,6 +535,58 @@ def main(argv):
     
     if run_mode == "JSON":
         libra.create_output_folder(output_folder_path)
+    else:
+        output_folder_path = ""
+
+    if profile:
+        profiling.enable()
+
+    inference.configure(**inference_settings)
+
+    # Reuse the results of previous runs for unchanged images
+    if cache_path:
+        libra.enable_cache(cache_path, cache_max_mb * 1024 * 1024)
+
+
+    # Serve comparisons to other processes, keeping the models of the metrics loaded
+    if args.serve is not None:
+        from libra.server import serve
+        serve(args.serve, metric_names=map_metrics)
+        return
+
+    # Compare many pairs if a manifest or directories are given
+    if manifest_path is not None or ref_dir is not None:
+        run_batch_mode(manifest_path, ref_dir, dist_dir, map_metrics, color_spaces_to_use, batch_output_path, workers,
+                       inference_settings.get('num_threads') or 1)
+        return
+
+
+    # Compare many images to one reference, processing the reference once
+    dist_paths = None if sequence else comparison_paths(dist_path)
+    if dist_paths is not None:
+        if generate_maps or generate_image_difference:
+            print("Maps and differences are not computed when comparing several images to a reference.")
+        run_fan_out_mode(ref_path, dist_paths, map_metrics, color_spaces_to_use, batch_output_path)
+        if profile:
+            write_profile(output_folder_path)
+        return
+
+
+    # Compare videos or frame sequences frame by frame
+    if sequence:
+        run_sequence_mode(ref_path, dist_path, map_metrics, color_spaces_to_use, batch_output_path)
+        if profile:
+            write_profile(output_folder_path)
+        return
+
+
+    # Evaluate large images tile by tile if a memory budget is given
+    if tile_memory is not None:
+        run_tiled_mode(dist_path, ref_path, generate_metrics, generate_maps, map_metrics, color_spaces_to_use,
+                       window_size, step_size, batch_size, tile_memory * 1024 * 1024, output_folder_path, batch_output_path)
+        if profile:
+            write_profile(output_folder_path)
+        return
 
 
     # Compute metric if flag is on
@@ -164,14 +597,18 @@ def main(argv):
         else:
             print("Computing metrics...")
             
+            # Decode and convert each image only once for all metrics and color spaces
+            image_pair = libra.ImagePair(dist_path, ref_path)
             results = []
             for metric_name in map_metrics:
-                metric_result = {'Metric': metric_name}            
-                for color_space_name in color_spaces_to_use:
-                    metric_result[color_space_name] = libra.compute_metric(dist_path, ref_path, metric_name, color_space_name)
-                    
+                before = profiling.totals()
+                metric_result = image_pair.compute([metric_name], color_spaces_to_use)[0]
+                if profile:
+                    # Time spent on this metric in each stage, over all color spaces
+                    metric_result.update(profile_columns(before))
                 results.append(metric_result)
                 
+            import pandas as pd
             results_df = pd.DataFrame(results)
                 
             csv_path = os.path.join(output_folder_path, output_csv_name)
@@ -179,8 +616,22 @@ def main(argv):
             print(f"Results saved to {csv_path}")
 
 
+    # Write the maps and differences to one container, in the background, instead of PNG images
+    map_writer = None
+    if map_store_path is not None and (generate_maps or generate_image_difference):
+        from libra.map_store import MapWriter
+        map_writer = MapWriter(os.path.join(output_folder_path, map_store_path))
+
+
     # compute diff if flag is on
-    if generate_image_difference:
+    if generate_image_difference and map_writer is not None:
+        print("Computing image difference...")
+        for color_space_name in color_spaces_to_use:
+            difference = difference_image(dist_path, ref_path, difference_threshold, color_space_name)
+            map_writer.write(f"diffs/{color_space_name}", difference,
+                             {'color_space': color_space_name, 'threshold': difference_threshold})
+
+    elif generate_image_difference:
         if run_mode == "CMD":
             color_space_name = color_spaces_to_use[0]
             heatmap, heatmap_eq = libra.diff_images(dist_path, ref_path, difference_threshold, color_space_name, diff_colormap)
@@ -210,15 +661,46 @@ def main(argv):
                 print(f"Thresholded difference image for {color_space_name} saved to {diff_output_path}")
 
 
+    # Compute the statistics of the difference, for every threshold at once, if flag is on
+    if generate_difference_statistics:
+        print("Computing difference statistics...")
+        write_diff_statistics(dist_path, ref_path, color_spaces_to_use, difference_threshold, output_folder_path)
+
+
+    # Compute dense maps from the per-pixel maps of the metrics if flag is on
+    if generate_maps and map_dense:
+        print("Computing dense metric maps...")
+        image_pair = libra.ImagePair(dist_path, ref_path)
+        for color_space in color_spaces_to_use:
+            for metric_name in map_metrics:
+                save_dense_metric_map(image_pair, metric_name, color_space, map_colormap, map_writer,
+                                      os.path.join(output_folder_path, f"map_{color_space}_{metric_name}"))
+
+    # Compute maps coarse to fine if levels are given
+    elif generate_maps and map_levels > 0:
+        print("Computing adaptive metric maps...")
+        for color_space in color_spaces_to_use:
+            for metric_name in map_metrics:
+                save_adaptive_metric_map(dist_path, ref_path, metric_name, color_space, window_size, map_levels,
+                                         batch_size, map_colormap, map_writer,
+                                         os.path.join(output_folder_path, f"map_{color_space}_{metric_name}"))
+
     # Compute maps if flag is on
-    if generate_maps:
+    elif generate_maps and map_writer is not None:
+        print("Computing Metric Maps...")
+        for color_space in color_spaces_to_use:
+            for metric_name in map_metrics:
+                metric_map, metadata = libra.compute_metric_map(dist_path, ref_path, metric_name, color_space,
+                                                                window_size, step_size, batch_size)
+                map_writer.write(f"maps/{color_space}/{metric_name}", metric_map, metadata)
+
+    elif generate_maps:
         if run_mode == "CMD":
             color_space_name = color_spaces_to_use[0]
             metric_name = map_metrics[0]
             
-            plt = libra.compute_map(dist_path, ref_path, metric_name, color_space_name, window_size, step_size, map_colormap)
-            plt.savefig(f"map_{color_space_name}_{metric_name}.png")
-            plt.close()
+            save_metric_map(dist_path, ref_path, metric_name, color_space_name, window_size, step_size, map_colormap,
+                            batch_size, map_renderer, save_map_arrays, f"map_{color_space_name}_{metric_name}")
             
             print(f"Difference map saved to map_{color_space_name}_{metric_name}.png")
             
@@ -227,14 +709,19 @@ def main(argv):
             
             for color_space in color_spaces_to_use:
                 for metric_name in map_metrics:
-                    plt = libra.compute_map(dist_path, ref_path, metric_name, color_space, window_size, step_size, map_colormap)
-                    
                     output_path = os.path.join(output_folder_path, "map")
-                    plt.savefig(f"{output_path}_{color_space}_{metric_name}.png")
-                    plt.close()
+                    save_metric_map(dist_path, ref_path, metric_name, color_space, window_size, step_size, map_colormap,
+                                    batch_size, map_renderer, save_map_arrays, f"{output_path}_{color_space}_{metric_name}")
                     
                     print(f"Difference map for colorspace {color_space} and metric {metric_name} saved to {output_path}_{color_space}_{metric_name}.png")
 
+    if map_writer is not None:
+        map_writer.close()
+        print(f"Maps and differences saved to {map_writer.path}")
+
+
+    if profile:
+        write_profile(output_folder_path)
 
 
 if __name__ == "__main__":
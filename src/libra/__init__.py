@@ -1,4 +1,12 @@
-from .map_computation import compute_map
+from .map_computation import compute_map, compute_metric_map
+from .adaptive_map import compute_adaptive_metric_map
+from .dense_maps import compute_dense_map
+from .map_rendering import render_map, save_map
 from .compute_metrics import compute_metric, list_metrics, list_colorspaces
-from .image_difference import diff_images
-from .utils import get_color_space_code, load_image, is_same, write_image, create_output_folder
\ No newline at end of file
+from .image_difference import diff_images, diff_statistics
+from .image_pair import ImagePair, compare_to_reference
+from .utils import get_color_space_code, load_image, is_same, write_image, create_output_folder
+from .model_registry import warmup, evict, set_memory_limit
+from .result_cache import enable_cache, disable_cache
+from .deep_features import FeatureCache, distance_matrix
+from .phash_index import PHashIndex
@@ -0,0 +1,268 @@
+"""
+This module computes metric maps coarse to fine, refining only where the metric changes.
+
+The image is tiled with large cells, on which the metric is evaluated first. Each cell
+whose value crosses a threshold, or whose value differs from those of its neighbors, is
+split into four cells of half the size, which are evaluated in turn, down to the patch size.
+Until the values of the metric vary, e.g. on a single coarse cell, the cells over which the
+images differ unevenly are split instead. Flat regions, such as the uniform background of a
+scientific render, are thus evaluated once per coarse cell instead of once per patch.
+
+The map is piecewise constant: each pixel takes the value of the finest cell evaluated over
+it, and the level mask gives the level of this cell, 0 being the coarsest.
+
+Example:
+    from libra.adaptive_map import compute_adaptive_metric_map
+
+    metric_map, levels, metadata = compute_adaptive_metric_map("compressed.png", "orig.png", "SSIM", "HSV",
+                                                               patch_size=32, levels=3)
+    print(metadata['patches'], "patches instead of", metadata['dense_patches'])
+"""
+
+import cv2
+import numpy as np
+
+from .utils import *
+from .metrics import *
+from . import profiling
+from . import inference
+from .map_computation import box_metrics, convert_map_color_space, _compute_patch
+
+torch = lazy_import('torch')
+
+
+# Default number of refinements from the coarsest cells to the patch size
+default_levels = 3
+
+# Default fraction of the spread of the coarse values above which the standard deviation of a
+# cell and its neighbors refines the cell
+default_tolerance = 0.05
+
+
+def cell_positions(length, cell_size):
+    """
+    Args:
+        length (int): Height or width of the image.
+        cell_size (int): Size of the cells.
+
+    Returns:
+        numpy.ndarray: Start of each cell along the axis; the last cell ends at the edge of the image.
+    """
+    count = -(-length // cell_size)
+    return np.minimum(np.arange(count) * cell_size, length - cell_size)
+
+
+def metric_values_at(im1, im2, metric_name, tops, lefts, patch_size, batch_size=64):
+    """
+    Evaluate a metric on patches at the given positions.
+
+    Args:
+        im1 (numpy.ndarray): The first input image.
+        im2 (numpy.ndarray): The second input image (ignored for no-reference metrics).
+        metric_name (str): Name of the metric.
+        tops (numpy.ndarray): Row of the top left corner of each patch.
+        lefts (numpy.ndarray): Column of the top left corner of each patch.
+        patch_size (int): The size of the patches.
+        batch_size (int, optional): Number of patches evaluated per forward pass. Default is 64.
+
+    Returns:
+        numpy.ndarray: Value of each patch, nan where the metric failed.
+    """
+    profiling.count('patches', len(tops))
+    values = np.full(len(tops), np.nan)
+    if len(tops) == 0:
+        return values
+
+    if metric_name in box_metrics:
+        # Mean error of each patch from a summed-area table of the per-pixel error
+        error_fn, transform = box_metrics[metric_name]
+        channels = im1.shape[2] if im1.ndim == 3 else 1
+        table = cv2.integral(np.ascontiguousarray(error_fn(im1, im2), dtype=np.float64), sdepth=cv2.CV_64F)
+        bottoms, rights = tops + patch_size, lefts + patch_size
+        sums = table[bottoms, rights] - table[tops, rights] - table[bottoms, lefts] + table[tops, lefts]
+        return transform(sums / float(patch_size * patch_size) / channels)
+
+    if metric_name in no_reference_metrics:
+        im2 = None
+    if metric_name not in batched_metrics:
+        metric_fn = metrics[metric_name]
+        for k, (i, j) in enumerate(zip(tops, lefts)):
+            values[k] = _compute_patch(im1, im2, i, j, patch_size, metric_fn)
+        return values
+
+    batched_fn = batched_metrics[metric_name]
+    tensor1 = preprocess_image(im1)
+    tensor2 = None if im2 is None else preprocess_image(im2)
+
+    for start in range(0, len(tops), batch_size):
+        positions = list(zip(tops[start:start + batch_size], lefts[start:start + batch_size]))
+        try:
+            with inference.context(metric_name):
+                patches1 = torch.stack([tensor1[0, :, i:i+patch_size, j:j+patch_size] for i, j in positions])
+                if tensor2 is None:
+                    batch_values = batched_fn(patches1)
+                else:
+                    patches2 = torch.stack([tensor2[0, :, i:i+patch_size, j:j+patch_size] for i, j in positions])
+                    batch_values = batched_fn(patches1, patches2)
+            values[start:start + len(positions)] = batch_values.detach().flatten().cpu().numpy()
+        except Exception:
+            # Evaluate the patches of the batch one by one, so that only failing patches are lost
+            metric_fn = metrics[metric_name]
+            for k, (i, j) in enumerate(positions, start):
+                values[k] = _compute_patch(im1, im2, i, j, patch_size, metric_fn)
+
+    return values
+
+
+def _varies(image, tops, lefts, cell_size):
+    '''Whether the values of an image differ within each cell'''
+    return np.array([np.ptp(image[i:i + cell_size, j:j + cell_size]) > 0 for i, j in zip(tops, lefts)], dtype=bool)
+
+
+def _neighborhood_std(grid):
+    '''Standard deviation of the finite values of each cell and its 8 neighbors'''
+    valid = np.isfinite(grid)
+    values = np.pad(np.where(valid, grid, 0.0), 1)
+    counts = np.pad(valid.astype(np.float64), 1)
+
+    rows, cols = grid.shape
+    total, squares, count = np.zeros(grid.shape), np.zeros(grid.shape), np.zeros(grid.shape)
+    for di in range(3):
+        for dj in range(3):
+            window = values[di:di + rows, dj:dj + cols]
+            total += window
+            squares += window * window
+            count += counts[di:di + rows, dj:dj + cols]
+
+    mean = total / np.maximum(count, 1)
+    return np.sqrt(np.maximum(squares / np.maximum(count, 1) - mean * mean, 0))
+
+
+def compute_adaptive_metric_map(dist, ref, metric_name='SSIM', color_space='HSV', patch_size=32,
+                                levels=default_levels, threshold=None, tolerance=default_tolerance, batch_size=64):
+    """
+    Compute the map of a metric coarse to fine, refining only the cells where the metric changes.
+
+    The coarsest cells are patch_size * 2**levels pixels wide. A cell is split in four if its
+    value is worse than threshold, or if the standard deviation of the values of the cell and
+    its 8 neighbors is above tolerance times the spread of the values of the first level whose
+    values differ. Before such a level, e.g. when the coarsest level is a single cell, the
+    cells over which the difference of the images is not uniform (the distorted image for
+    no-reference metrics) are split.
+
+    Args:
+        dist (str, bytes or numpy.ndarray): Path of distorted image, its content, or the BGR image.
+        ref (str, bytes or numpy.ndarray): Path of reference image, its content, or the BGR image.
+        metric_name (str): metric name.
+        color_space (str): name of the color space.
+        patch_size (int, optional): Size of the finest cells. Default is 32.
+        levels (int, optional): Number of refinements; fewer if the coarsest cells would not
+            fit in the image. Default is 3.
+        threshold (float, optional): Cells worse than this value are refined, e.g. below it
+            for SSIM or above it for LPIPS. Default is None, refining on the variation only.
+        tolerance (float, optional): Refine where the metric varies by more than this fraction
+            of its range. Default is 0.05.
+        batch_size (int, optional): Number of patches evaluated per forward pass. Default is 64.
+
+    Returns:
+        tuple: (float32 map shaped as the distorted image, nan where the metric failed,
+            uint8 level of the cell giving the value of each pixel,
+            metadata dictionary with the 'metric', 'color_space', 'patch_size', 'levels',
+            the number of evaluated 'patches' and of 'dense_patches' tiling the image at
+            the patch size, and the 'min', 'max' and 'mean' of the map)
+
+    Raises:
+        FileNotFoundError: If an image cannot be read.
+        KeyError: If the metric does not exist.
+        ValueError: If the patches do not fit in the image.
+    """
+    if metric_name not in metrics:
+        raise KeyError(f"Unknown metric '{metric_name}'")
+
+    img1 = decode_image(dist)
+    img2 = decode_image(ref)
+    img2 = cv2.resize(img2, (img1.shape[1], img1.shape[0]))
+    img1_cs = convert_map_color_space(img1, color_space)
+    img2_cs = convert_map_color_space(img2, color_space)
+
+    # Variation within the cells, used until the values of the metric vary
+    if metric_name in no_reference_metrics:
+        variation = img1_cs
+    else:
+        variation = cv2.absdiff(img1_cs, img2_cs)
+
+    height, width = img1.shape[:2]
+    if patch_size > min(height, width):
+        raise ValueError(f"Patches of {patch_size} pixels do not fit in a {width}x{height} image")
+    while levels > 0 and patch_size << levels > min(height, width):
+        levels -= 1
+
+    metric_map = np.full((height, width), np.nan, dtype=np.float32)
+    level_mask = np.zeros((height, width), dtype=np.uint8)
+    evaluated, filled = None, None
+    patches, spread = 0, None
+
+    with profiling.stage('forward'):
+        for level in range(levels + 1):
+            cell_size = patch_size << (levels - level)
+            tops, lefts = cell_positions(height, cell_size), cell_positions(width, cell_size)
+
+            # Cells of this level: all of them at first, then the children of the refined cells
+            if evaluated is None:
+                evaluated = np.ones((len(tops), len(lefts)), dtype=bool)
+            else:
+                evaluated = refined[np.arange(len(tops))[:, None] // 2, np.arange(len(lefts))[None, :] // 2]
+            rows, cols = np.nonzero(evaluated)
+            patches += len(rows)
+
+            grid = np.full(evaluated.shape, np.nan)
+            grid[rows, cols] = metric_values_at(img1_cs, img2_cs, metric_name, tops[rows], lefts[cols],
+                                                cell_size, batch_size)
+
+            # Pixels take the value of the finest cell evaluated over them
+            pixel_rows = np.minimum(np.arange(height) // cell_size, len(tops) - 1)
+            pixel_cols = np.minimum(np.arange(width) // cell_size, len(lefts) - 1)
+            covered = evaluated[np.ix_(pixel_rows, pixel_cols)]
+            metric_map[covered] = grid[np.ix_(pixel_rows, pixel_cols)][covered]
+            level_mask[covered] = level
+
+            # Cells that were not evaluated keep the value of their parent, to compare neighbors
+            if filled is not None:
+                parents = filled[np.arange(len(tops))[:, None] // 2, np.arange(len(lefts))[None, :] // 2]
+                grid = np.where(evaluated, grid, parents)
+            filled = grid
+
+            if level == levels:
+                break
+
+            finite = grid[np.isfinite(grid)]
+            if not spread:
+                spread = float(finite.max() - finite.min()) if finite.size else 0.0
+
+            refined = np.zeros_like(evaluated)
+            if spread > 0:
+                refined = evaluated & (_neighborhood_std(grid) > tolerance * spread)
+            else:
+                # No variation of the metric to compare cells with: split where the images vary
+                refined[rows, cols] = _varies(variation, tops[rows], lefts[cols], cell_size)
+            if threshold is not None:
+                worse = grid > threshold if metric_name in lower_is_better_metrics else grid < threshold
+                refined |= evaluated & worse
+
+    finite = metric_map[np.isfinite(metric_map)]
+    metadata = {
+        'metric': metric_name,
+        'color_space': color_space,
+        'patch_size': patch_size,
+        'levels': levels,
+        'patches': patches,
+        'dense_patches': int(len(cell_positions(height, patch_size)) * len(cell_positions(width, patch_size))),
+        'min': float(finite.min()) if finite.size else float("nan"),
+        'max': float(finite.max()) if finite.size else float("nan"),
+        'mean': float(finite.mean()) if finite.size else float("nan"),
+    }
+    return metric_map, level_mask, metadata
+
+
+def __dir__():
+    return ["compute_adaptive_metric_map", "metric_values_at", "cell_positions"]
@@ -0,0 +1,291 @@
+"""
+This module provides a batch mode comparing many image pairs with a pool of worker processes.
+
+Pairs are read from a CSV or JSON-lines manifest, or matched by file name between two
+directories. Each worker loads the models it needs once, and results are written to the
+output CSV file as soon as each pair completes. Errors are recorded per pair instead of
+stopping the run.
+
+In fan-out mode, many distorted images are compared to a single reference in the current
+process, and the work done on the reference is reused for every distorted image.
+"""
+
+import os
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+from .utils import *
+from .image_pair import ImagePair
+from .model_registry import warmup
+from .result_cache import enable_cache, get_cache
+from . import inference
+
+torch = lazy_import('torch')
+
+
+# Accepted column names for the reference and distorted images in a manifest
+reference_keys = ["reference", "ref", "reference_image_path"]
+distorted_keys = ["distorted", "dist", "comparison", "distorted_image_path"]
+
+
+def read_manifest(manifest_path):
+    """
+    Read the image pairs listed in a manifest.
+
+    The manifest is either a CSV file with a header, or a JSON-lines file with one object
+    per line (.jsonl or .json extension). The reference image is given by a 'reference',
+    'ref' or 'reference_image_path' field and the distorted image by a 'distorted', 'dist',
+    'comparison' or 'distorted_image_path' field. Relative paths are relative to the manifest.
+
+    Args:
+        manifest_path (str): Path to the manifest.
+
+    Returns:
+        list: (reference path, distorted path) tuples.
+
+    Raises:
+        ValueError: If an entry does not name both images.
+    """
+    with open(manifest_path, 'r', newline='') as file:
+        if manifest_path.endswith(('.jsonl', '.json')):
+            entries = [json.loads(line) for line in file if line.strip()]
+        else:
+            entries = list(csv.DictReader(file))
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    pairs = []
+    for line_number, entry in enumerate(entries, 1):
+        ref = _first_field(entry, reference_keys)
+        dist = _first_field(entry, distorted_keys)
+        if ref is None or dist is None:
+            raise ValueError(f"Entry {line_number} of '{manifest_path}' must give a reference and a distorted image")
+        pairs.append((os.path.join(base_dir, ref), os.path.join(base_dir, dist)))
+    return pairs
+
+
+def _first_field(entry, keys):
+    for key in keys:
+        if entry.get(key):
+            return entry[key].strip()
+    return None
+
+
+def pair_directories(ref_dir, dist_dir):
+    """
+    Match the images of two directories by file name.
+
+    Args:
+        ref_dir (str): Directory of the reference images.
+        dist_dir (str): Directory of the distorted images.
+
+    Returns:
+        list: (reference path, distorted path) tuples, sorted by file name. Files without
+            a match in the other directory are skipped.
+    """
+    dist_names = set(os.listdir(dist_dir))
+    return [(os.path.join(ref_dir, name), os.path.join(dist_dir, name))
+            for name in sorted(os.listdir(ref_dir))
+            if name in dist_names and os.path.isfile(os.path.join(ref_dir, name))]
+
+
+def compute_pair(ref_path, dist_path, metric_names, color_space_names):
+    """
+    Compute the metrics of one pair, capturing any error.
+
+    Args:
+        ref_path (str): Path of reference image.
+        dist_path (str): Path of distorted image.
+        metric_names (list of str): metrics to use.
+        color_space_names (list of str): color spaces to use.
+
+    Returns:
+        dict: 'reference', 'distorted', 'results' (as returned by ImagePair.compute) and
+            'error' (None, or the error message if the pair failed).
+    """
+    record = {'reference': ref_path, 'distorted': dist_path, 'results': [], 'error': None}
+    try:
+        record['results'] = ImagePair(dist_path, ref_path).compute(metric_names, color_space_names)
+    except Exception as e:
+        record['error'] = f"{type(e).__name__}: {e}"
+    return record
+
+
+def _error_record(ref_path, dist_path, error):
+    '''Record of a pair that could not be computed'''
+    return {'reference': ref_path, 'distorted': dist_path, 'results': [], 'error': f"{type(error).__name__}: {error}"}
+
+
+def _warmup(metric_names):
+    '''Load the model of each metric once; a model that fails to load is reported, and recorded as the error of each pair'''
+    for metric_name in metric_names:
+        try:
+            warmup([metric_name])
+        except Exception as e:
+            print(f"Warning: the model of {metric_name} cannot be loaded: {type(e).__name__}: {e}")
+
+
+def _init_worker(metric_names, num_threads, cache_settings=None, inference_settings=None):
+    '''Apply the inference settings of the parent and limit the threads of the worker, open the result cache of the parent, and load the models once'''
+    if inference_settings is not None:
+        inference.configure(**inference_settings)
+    if num_threads is not None:
+        inference.configure(num_threads=num_threads)
+    if cache_settings is not None:
+        enable_cache(*cache_settings)
+    _warmup(metric_names)
+
+
+def run_batch(pairs, metric_names, color_space_names, output_path, workers=None, num_threads=1):
+    """
+    Compute the metrics of many image pairs and stream the results to a CSV file.
+
+    The CSV file has one row per pair and metric with the columns Reference, Distorted,
+    Metric, one column per color space, and Error. Rows are written in completion order.
+
+    Args:
+        pairs (list): (reference path, distorted path) tuples.
+        metric_names (list of str): metrics to use.
+        color_space_names (list of str): color spaces to use.
+        output_path (str): Path of the output CSV file.
+        workers (int, optional): Number of worker processes; the number of CPUs if None.
+            With 1 worker, pairs are computed in the current process.
+        num_threads (int, optional): Torch threads per worker, to avoid oversubscribing the
+            CPUs. Default is 1; None leaves the torch default.
+
+    Returns:
+        tuple: (number of pairs computed, number of pairs that failed)
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    records = _iter_records(pairs, metric_names, color_space_names, workers, num_threads)
+    return _write_records(records, color_space_names, output_path)
+
+
+def run_fan_out(ref_path, dist_paths, metric_names, color_space_names, output_path):
+    """
+    Compute the metrics of many distorted images against one reference and stream the
+    results to a CSV file.
+
+    The reference is decoded, converted and processed once, and its statistics and deep
+    features are reused for every distorted image. The CSV file has the same columns as
+    in run_batch, with rows in the order of dist_paths.
+
+    Args:
+        ref_path (str): Path of the reference image.
+        dist_paths (list of str): Paths of the distorted images.
+        metric_names (list of str): metrics to use.
+        color_space_names (list of str): color spaces to use.
+        output_path (str): Path of the output CSV file.
+
+    Returns:
+        tuple: (number of distorted images computed, number that failed)
+    """
+    _warmup(metric_names)
+    return _write_records(_iter_fan_out_records(ref_path, dist_paths, metric_names, color_space_names),
+                          color_space_names, output_path)
+
+
+def _iter_fan_out_records(ref_path, dist_paths, metric_names, color_space_names):
+    '''Yield the record of each distorted image compared to the reference'''
+    # The tensors of each distorted image reuse those of the previous one
+    reference_pair, buffers = None, {}
+    for dist_path in dist_paths:
+        record = {'reference': ref_path, 'distorted': dist_path, 'results': [], 'error': None}
+        try:
+            if reference_pair is None:
+                reference_pair = pair = ImagePair(dist_path, ref_path, buffers)
+            else:
+                pair = reference_pair.with_distorted(dist_path, buffers)
+            record['results'] = pair.compute(metric_names, color_space_names)
+        except Exception as e:
+            record['error'] = f"{type(e).__name__}: {e}"
+        yield record
+
+
+def _write_records(records, color_space_names, output_path):
+    '''Write the rows of the records to a CSV file as they come, and count them'''
+    columns = ["Reference", "Distorted", "Metric"] + list(color_space_names) + ["Error"]
+    done, failed = 0, 0
+
+    with open(output_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+
+        for record in records:
+            for row in _record_rows(record, color_space_names):
+                writer.writerow(row)
+            file.flush()
+
+            done += 1
+            if record['error'] is not None:
+                failed += 1
+                print(f"Error comparing {record['distorted']} to {record['reference']}: {record['error']}")
+
+    return done, failed
+
+
+def _iter_records(pairs, metric_names, color_space_names, workers, num_threads):
+    '''Yield the record of each pair as it completes'''
+    if workers <= 1:
+        # Pairs are computed in this process: limit its threads for the run only
+        previous_settings, previous_threads = inference.get_settings(), torch.get_num_threads()
+        try:
+            _init_worker(metric_names, num_threads)
+            for ref_path, dist_path in pairs:
+                yield compute_pair(ref_path, dist_path, metric_names, color_space_names)
+        finally:
+            inference.configure(**previous_settings)
+            torch.set_num_threads(previous_threads)
+        return
+
+    # Bound the number of pending pairs so that huge manifests are not all queued at once
+    max_pending = 4 * workers
+    pending = {}   # future -> (reference path, distorted path)
+    pairs = iter(pairs)
+
+    # Workers share the result cache of this process, through their own connections
+    cache = get_cache()
+    cache_settings = None if cache is None else (cache.path, cache.max_bytes)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(metric_names, num_threads, cache_settings, inference.get_settings())) as executor:
+        while True:
+            for ref_path, dist_path in pairs:
+                try:
+                    future = executor.submit(compute_pair, ref_path, dist_path, metric_names, color_space_names)
+                except BrokenProcessPool as e:
+                    yield _error_record(ref_path, dist_path, e)
+                    continue
+                pending[future] = (ref_path, dist_path)
+                if len(pending) >= max_pending:
+                    break
+
+            if not pending:
+                break
+
+            # A worker that dies breaks the pool: its pairs, and those after it, record the error
+            completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                ref_path, dist_path = pending.pop(future)
+                try:
+                    record = future.result()
+                except BrokenProcessPool as e:
+                    record = _error_record(ref_path, dist_path, e)
+                yield record
+
+
+def _record_rows(record, color_space_names):
+    '''CSV rows of a pair record'''
+    if record['error'] is not None:
+        return [[record['reference'], record['distorted'], ""] + [""] * len(color_space_names) + [record['error']]]
+
+    return [[record['reference'], record['distorted'], metric_result['Metric']]
+            + [metric_result[color_space_name] for color_space_name in color_space_names] + [""]
+            for metric_result in record['results']]
+
+
+def __dir__():
+    return ["read_manifest", "pair_directories", "compute_pair", "run_batch", "run_fan_out"]
@@ -1,42 +1,27 @@
 from .utils import *
 from .metrics import *
+from .image_pair import ImagePair
 
 
-def compute_metric(dist_path, ref_path, metric_name='SSIM', color_space_name='LAB'):
+def compute_metric(dist_path, ref_path, metric_name='SSIM', color_space_name='LAB', backend=None):
     """
     Compute the specified IQA metrics for the given images and color spaces.
 
     Args:
-        dist_path (str): Path of distorted image.
-        ref_path (str): Path of reference image.
+        dist_path (str, bytes or numpy.ndarray): Path of distorted image, or its content.
+        ref_path (str, bytes or numpy.ndarray): Path of reference image, or its content.
         metric_name (str): metrics to use e.g. 'SSIM'.
         color_space_name (str): Name of the color spaces to use for computing metrics e.g. 'LAB'
+        backend (str, optional): 'torch', 'numpy' to compute MSE, PSNR, SSIM, GMSD or PHASH
+            with NumPy and OpenCV, or 'auto' to use numpy when torch is not installed.
+            Default is the classical_backend inference setting.
 
     Returns:
-        list: List of dictionaries containing metric results for each color space.
+        float: The metric value, nan if the metric does not exist.
     """
-    dist_image = load_image(dist_path)
-    ref_image = load_image(ref_path)
-    
-
-    if metric_name in metrics:
-        metric_fn = metrics[metric_name]
-        
-        color_space_code = color_spaces[color_space_name]
-        dist_image_converted = cv2.cvtColor(dist_image, color_space_code)
-        ref_image_converted  = cv2.cvtColor(ref_image, color_space_code)
-    
-        if metric_name in ["BRISQUE", "NIQE", "MUSIQ", "NIMA", "CLIPIQA"]:
-            result = metric_fn(dist_image_converted)
-        else:
-            result = metric_fn(dist_image_converted, ref_image_converted)
-
-        return result
-    else:
-        return float("nan")
-    
-    
-    
+    return ImagePair(dist_path, ref_path).compute_metric(metric_name, color_space_name, backend)
+
+
 def list_metrics():
     """
     Returns:
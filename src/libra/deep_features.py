@@ -0,0 +1,261 @@
+"""
+This module splits the deep feature metrics (LPIPS and DISTS) into a feature extraction
+per image and a distance between features.
+
+The VGG16 activations of an image only depend on that image, so they can be extracted once
+and compared to the activations of many other images. The results are those of the piq
+models from the model registry.
+
+A FeatureCache keeps the features of many images in memory, spilling the least recently
+used ones to disk if needed, so that comparing N images with each other costs N backbone
+passes instead of 2·N².
+
+Example:
+    ref_features = extract_features('LPIPS', ref_tensor)
+    for dist_tensor in dist_tensors:
+        lpips = feature_distance('LPIPS', extract_features('LPIPS', dist_tensor), ref_features)
+
+    matrix = distance_matrix(["render_1.png", "render_2.png", "render_3.png"], 'LPIPS')
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+from .utils import *
+from .model_registry import get_model
+from .metrics import preprocess_image
+from .result_cache import content_hash, package_versions
+from . import profiling
+from . import inference
+
+torch = lazy_import('torch')
+F = lazy_import('torch.nn.functional')
+
+
+# Metrics computed from the deep features of each image
+deep_feature_metrics = ['LPIPS', 'DISTS']
+
+# DISTS resizes images so that their smaller side is at most this size
+dists_max_size = 256
+
+default_feature_cache_max_bytes = 1024 * 1024 * 1024
+
+
+def extract_features(metric_name, x):
+    """
+    Deep features of images, as computed by the model of a metric.
+
+    Args:
+        metric_name (str): 'LPIPS' or 'DISTS'.
+        x (torch.Tensor): Images in [0, 1], shaped (N, C, H, W).
+
+    Returns:
+        list of torch.Tensor: Activations of the layers compared by the metric.
+    """
+    model = get_model(metric_name)
+    # The model is shared by the registry, so the images are moved to it rather than the reverse
+    parameter = next(model.parameters())
+    x = x.to(device=parameter.device, dtype=parameter.dtype)
+
+    if metric_name == 'DISTS':
+        h, w = x.shape[-2:]
+        if min(h, w) > dists_max_size:
+            x = F.interpolate(x, scale_factor=dists_max_size / min(h, w), recompute_scale_factor=False, mode='bilinear')
+
+    profiling.count('feature extractions')
+    with profiling.stage('forward'), inference.context(metric_name):
+        features = model.get_features(x)
+    # Features computed under bfloat16 autocast are compared and cached in float32
+    return [feature.float() for feature in features]
+
+
+def feature_distance(metric_name, x_features, y_features):
+    """
+    Value of a metric from the deep features of the distorted and reference images.
+
+    Args:
+        metric_name (str): 'LPIPS' or 'DISTS'.
+        x_features (list of torch.Tensor): Features of the distorted images, from extract_features.
+        y_features (list of torch.Tensor): Features of the reference images.
+
+    Returns:
+        torch.Tensor: The metric value of each image.
+    """
+    model = get_model(metric_name)
+    with profiling.stage('forward'), inference.context():
+        distances = model.compute_distance(x_features, y_features)
+        loss = torch.cat([(d * w.to(d)).mean(dim=[2, 3]) for d, w in zip(distances, model.weights)], dim=1).sum(dim=1)
+    return 1 - loss if metric_name == 'DISTS' else loss
+
+
+def features_size(features):
+    '''Size of a list of feature tensors in bytes'''
+    return sum(feature.element_size() * feature.nelement() for feature in features)
+
+
+class FeatureCache:
+    """
+    Deep features of images, extracted once and kept in memory with least recently used
+    eviction.
+
+    When a spill directory is given, evicted features are saved there and loaded back
+    instead of being extracted again. Features are keyed by the metric, the color space, the
+    content of the image, the sources of libra and the inference settings changing the
+    features, so the spill directory can be reused across runs.
+
+    Example:
+        cache = FeatureCache(max_bytes=2 * 1024**3, spill_dir="/tmp/libra_features")
+        lpips = feature_distance('LPIPS', cache.get('LPIPS', "render_1.png"), cache.get('LPIPS', "render_2.png"))
+    """
+
+    def __init__(self, max_bytes=default_feature_cache_max_bytes, spill_dir=None):
+        """
+        Args:
+            max_bytes (int, optional): Size of the features kept in memory, above which the
+                least recently used are evicted. None means unbounded. Default is 1 GB.
+            spill_dir (str, optional): Directory where evicted features are saved; they are
+                dropped if None.
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = None if spill_dir is None else os.path.abspath(os.path.expanduser(spill_dir))
+        self._features = OrderedDict()   # key -> features, least recently used first
+        self._sizes = {}                 # key -> size in bytes
+        self._lock = threading.Lock()
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+
+    @staticmethod
+    def make_key(metric_name, image, color_space_name):
+        '''Key of the features of an image, from its content, and the sources of libra, versions and inference settings computing them'''
+        versions = package_versions()
+        fields = [metric_name, color_space_name, content_hash(image), versions['libra'], versions['piq'], versions['torch'],
+                  inference.value_settings(metric_name)]
+        return hashlib.sha256(json.dumps(fields).encode()).hexdigest()
+
+
+    def get(self, metric_name, image, color_space_name='RGB'):
+        """
+        Features of an image, extracted if they are neither in memory nor spilled to disk.
+
+        Args:
+            metric_name (str): 'LPIPS' or 'DISTS'.
+            image (str, bytes or numpy.ndarray): Path to the image, content of an image file,
+                or a BGR image.
+            color_space_name (str, optional): Color space the image is converted to. Default is RGB.
+
+        Returns:
+            list of torch.Tensor: The features.
+        """
+        key = self.make_key(metric_name, image, color_space_name)
+        with self._lock:
+            features = self._features.get(key)
+            if features is not None:
+                self._features.move_to_end(key)
+                profiling.count('feature cache hits')
+                return features
+
+        features = self._load_spilled(key)
+        if features is None:
+            profiling.count('feature cache misses')
+            converted = cv2.cvtColor(decode_image(image), color_spaces[color_space_name])
+            features = extract_features(metric_name, preprocess_image(converted))
+
+        with self._lock:
+            self._features[key] = features
+            self._sizes[key] = features_size(features)
+            self._enforce_limit()
+        return features
+
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, f"{key}.pt")
+
+
+    def _load_spilled(self, key):
+        '''Features spilled to disk, None if they are not there'''
+        if self.spill_dir is None or not os.path.exists(self._spill_path(key)):
+            return None
+        profiling.count('feature cache spill reads')
+        with profiling.stage('imread'):
+            return torch.load(self._spill_path(key))
+
+
+    def _enforce_limit(self):
+        '''Evict the least recently used features until the cache fits in max_bytes, keeping the newest'''
+        if self.max_bytes is None:
+            return
+        while len(self._features) > 1 and self.size() > self.max_bytes:
+            key, features = self._features.popitem(last=False)
+            del self._sizes[key]
+            if self.spill_dir is not None and not os.path.exists(self._spill_path(key)):
+                # Write to a temporary file first, so that a concurrent reader never sees a partial file
+                temp_path = f"{self._spill_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with profiling.stage('imwrite'):
+                    torch.save([feature.cpu() for feature in features], temp_path)
+                os.replace(temp_path, self._spill_path(key))
+
+
+    def size(self):
+        """
+        Returns:
+            int: Size of the features in memory in bytes.
+        """
+        return sum(self._sizes.values())
+
+
+    def __len__(self):
+        return len(self._features)
+
+
+    def clear(self):
+        '''Drop the features in memory; spilled features are kept'''
+        with self._lock:
+            self._features.clear()
+            self._sizes.clear()
+
+
+def distance_matrix(images, metric_name='LPIPS', color_space_name='RGB', feature_cache=None):
+    """
+    Distances between every pair of images from their deep features.
+
+    The features of each image are extracted once, so the matrix costs N backbone passes
+    for N images as long as they fit in the feature cache or can be spilled. LPIPS and DISTS
+    are symmetric, so each pair is compared once.
+
+    Args:
+        images (list): Images as paths, contents of image files, or BGR images.
+        metric_name (str, optional): 'LPIPS' or 'DISTS'. Default is LPIPS.
+        color_space_name (str, optional): Color space the images are converted to. Default is RGB.
+        feature_cache (FeatureCache, optional): Cache of the features; an unbounded in-memory
+            cache is used if None.
+
+    Returns:
+        numpy.ndarray: (N, N) matrix whose element (i, j) is the metric between images i and j.
+
+    Raises:
+        ValueError: If the metric is not a deep feature metric.
+    """
+    if metric_name not in deep_feature_metrics:
+        raise ValueError(f"{metric_name} is not one of the deep feature metrics {deep_feature_metrics}")
+    if feature_cache is None:
+        feature_cache = FeatureCache(max_bytes=None)
+
+    n = len(images)
+    matrix = np.zeros((n, n), dtype=np.float64)
+    for i in range(n):
+        x_features = feature_cache.get(metric_name, images[i], color_space_name)
+        for j in range(i, n):
+            y_features = feature_cache.get(metric_name, images[j], color_space_name)
+            matrix[i, j] = matrix[j, i] = feature_distance(metric_name, x_features, y_features).item()
+    return matrix
+
+
+def __dir__():
+    return ["deep_feature_metrics", "extract_features", "feature_distance", "FeatureCache", "distance_matrix"]
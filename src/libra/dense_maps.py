@@ -0,0 +1,328 @@
+"""
+This module computes dense maps of the metrics that build a per-pixel map before pooling it.
+
+SSIM, GMSD, MDSI, HaarPSI, FSIM and VSI compare the images pixel by pixel, at full or reduced
+resolution, and pool the resulting map into one value. Their dense map is this map, taken
+from one pass over the whole images instead of evaluating the metric on every patch, and
+resized to the images. The computations follow piq step by step, and pooling a map as piq
+does gives the value of the metric, returned as the 'score' of its metadata:
+
+- SSIM: SSIM map averaged over the channels, pooled by its mean.
+- GMSD: absolute deviation of the gradient magnitude similarity from its mean, pooled by
+  its root mean square.
+- MDSI: deviation of the gradient and chromaticity similarity from its mean, pooled by its
+  mean to the power of 0.25.
+- HaarPSI: local similarity weighted over the orientations, in the units of HaarPSI, pooled
+  by a weighted mean before the conversion to these units.
+- FSIM: local similarity of phase congruency, gradient and chromaticity, pooled by a mean
+  weighted by the phase congruency.
+- VSI: local similarity of visual saliency, gradient and chromaticity, pooled by a mean
+  weighted by the visual saliency.
+
+Example:
+    from libra.dense_maps import compute_dense_map
+
+    metric_map, metadata = compute_dense_map("compressed.png", "orig.png", "GMSD", "LAB", channel=0)
+"""
+
+import cv2
+import numpy as np
+
+from .utils import *
+from .image_pair import ImagePair
+from .fused_metrics import FusedMetrics, ssim_kernel_size
+from . import profiling
+from . import inference
+
+torch = lazy_import('torch')
+F = lazy_import('torch.nn.functional')
+piq_functional = lazy_import('piq.functional')
+# FSIM and VSI maps call private functions of piq, hence the version of piq pinned in requirements.txt
+piq_fsim = lazy_import('piq.fsim')
+piq_vsi = lazy_import('piq.vsi')
+
+
+# Parameters of the metrics, as in piq
+mdsi_c1, mdsi_c2, mdsi_c3 = 140., 55., 550.
+mdsi_alpha, mdsi_q, mdsi_o = 0.6, 0.25, 0.25
+
+haarpsi_scales = 3
+haarpsi_c, haarpsi_alpha = 30.0, 4.2
+
+fsim_scales, fsim_orientations = 4, 4
+fsim_t1, fsim_t2, fsim_t3, fsim_t4, fsim_lambda = 0.85, 160, 200, 200, 0.03
+
+vsi_c1, vsi_c2, vsi_c3 = 1.27, 386., 130.
+vsi_alpha, vsi_beta = 0.4, 0.02
+
+
+def _gradient_kernels(kernel):
+    return torch.stack([kernel, kernel.transpose(-1, -2)])
+
+
+def _ssim_map(x, y, workspace):
+    '''SSIM map, shrunk by the valid Gaussian filtering of images downsampled by a factor'''
+    ssim_map, _ = workspace.ssim_map()
+    return ssim_map[0], ssim_kernel_size // 2, ssim_map[0].mean()
+
+
+def _gmsd_map(x, y, workspace):
+    '''Deviation of the gradient magnitude similarity of the luma halved once'''
+    deviation = workspace.gmsd_map()
+    return deviation[0], 0, deviation[0].pow(2).mean().sqrt()
+
+
+def _mdsi_map(x, y, workspace):
+    '''Deviation of the gradient and chromaticity similarity, as in piq.mdsi with combination='sum' '''
+    if x.size(1) == 1:
+        x = x.repeat(1, 3, 1, 1)
+        y = y.repeat(1, 3, 1, 1)
+    x = x / 1.0 * 255
+    y = y / 1.0 * 255
+
+    # Averaging image if the size is large enough
+    kernel_size = max(1, round(min(x.size()[-2:]) / 256))
+    padding = kernel_size // 2
+    if padding:
+        up_pad = (kernel_size - 1) // 2
+        pad_to_use = [up_pad, padding, up_pad, padding]
+        x = F.pad(x, pad=pad_to_use)
+        y = F.pad(y, pad=pad_to_use)
+    x = F.avg_pool2d(x, kernel_size=kernel_size)
+    y = F.avg_pool2d(y, kernel_size=kernel_size)
+
+    x_lhm = piq_functional.rgb2lhm(x)
+    y_lhm = piq_functional.rgb2lhm(y)
+    kernels = _gradient_kernels(piq_functional.prewitt_filter(device=x_lhm.device, dtype=x_lhm.dtype))
+    gm_x = piq_functional.gradient_map(x_lhm[:, :1], kernels)
+    gm_y = piq_functional.gradient_map(y_lhm[:, :1], kernels)
+    gm_avg = piq_functional.gradient_map((x_lhm[:, :1] + y_lhm[:, :1]) / 2., kernels)
+
+    similarity_map = piq_functional.similarity_map
+    gs_total = similarity_map(gm_x, gm_y, mdsi_c1) + similarity_map(gm_x, gm_avg, mdsi_c2) - \
+               similarity_map(gm_y, gm_avg, mdsi_c2)
+    cs_total = (2 * (x_lhm[:, 1:2] * y_lhm[:, 1:2] + x_lhm[:, 2:] * y_lhm[:, 2:]) + mdsi_c3) / \
+               (x_lhm[:, 1:2] ** 2 + y_lhm[:, 1:2] ** 2 + x_lhm[:, 2:] ** 2 + y_lhm[:, 2:] ** 2 + mdsi_c3)
+    gcs = mdsi_alpha * gs_total + (1 - mdsi_alpha) * cs_total
+
+    gcs_q = piq_functional.pow_for_complex(base=gcs, exp=mdsi_q)
+    mct = gcs_q.mean(dim=2, keepdim=True).mean(dim=3, keepdim=True)
+    deviation = (gcs_q - mct).pow(2).sum(dim=-1).sqrt()
+    return deviation[0, 0], 0, deviation[0, 0].mean() ** mdsi_o
+
+
+def _haarpsi_map(x, y, workspace):
+    '''Local HaarPSI similarity of the images halved once, weighted over the orientations'''
+    num_channels = x.size(1)
+    x = x / 1.0 * 255
+    y = y / 1.0 * 255
+    if num_channels == 3:
+        x_yiq = piq_functional.rgb2yiq(x)
+        y_yiq = piq_functional.rgb2yiq(y)
+    else:
+        x_yiq, y_yiq = x, y
+
+    down_pad = max(x.shape[2] % 2, x.shape[3] % 2)
+    x_yiq = F.avg_pool2d(F.pad(x_yiq, pad=[0, down_pad, 0, down_pad]), kernel_size=2, stride=2, padding=0)
+    y_yiq = F.avg_pool2d(F.pad(y_yiq, pad=[0, down_pad, 0, down_pad]), kernel_size=2, stride=2, padding=0)
+
+    # Haar wavelet decomposition
+    coefficients_x, coefficients_y = [], []
+    for scale in range(haarpsi_scales):
+        kernel_size = 2 ** (scale + 1)
+        kernels = _gradient_kernels(piq_functional.haar_filter(kernel_size, dtype=x.dtype, device=x.device))
+        # Asymmetrical padding due to even kernel size, as MATLAB conv2(A, B, 'same')
+        pad_to_use = [kernel_size // 2 - 1, kernel_size // 2, kernel_size // 2 - 1, kernel_size // 2]
+        coefficients_x.append(F.conv2d(F.pad(x_yiq[:, :1], pad=pad_to_use, mode='constant'), kernels))
+        coefficients_y.append(F.conv2d(F.pad(y_yiq[:, :1], pad=pad_to_use, mode='constant'), kernels))
+    coefficients_x = torch.cat(coefficients_x, dim=1)
+    coefficients_y = torch.cat(coefficients_y, dim=1)
+
+    # Low frequency coefficients weight the similarities of the high frequency ones
+    weights = torch.max(torch.abs(coefficients_x[:, 4:]), torch.abs(coefficients_y[:, 4:]))
+    similarity_map = piq_functional.similarity_map
+    sim_map = []
+    for orientation in range(2):
+        magnitude_x = torch.abs(coefficients_x[:, (orientation, orientation + 2)])
+        magnitude_y = torch.abs(coefficients_y[:, (orientation, orientation + 2)])
+        sim_map.append(similarity_map(magnitude_x, magnitude_y, constant=haarpsi_c).sum(dim=1, keepdims=True) / 2)
+
+    if num_channels == 3:
+        x_yiq = F.pad(x_yiq, pad=[0, 1, 0, 1])
+        y_yiq = F.pad(y_yiq, pad=[0, 1, 0, 1])
+        coefficients_x_iq = torch.abs(F.avg_pool2d(x_yiq[:, 1:], kernel_size=2, stride=1, padding=0))
+        coefficients_y_iq = torch.abs(F.avg_pool2d(y_yiq[:, 1:], kernel_size=2, stride=1, padding=0))
+        weights = torch.cat([weights, weights.mean(dim=1, keepdims=True)], dim=1)
+        sim_map.append(similarity_map(coefficients_x_iq, coefficients_y_iq, constant=haarpsi_c).sum(dim=1, keepdims=True) / 2)
+    sim_map = torch.cat(sim_map, dim=1)
+
+    weighted = (sim_map * haarpsi_alpha).sigmoid() * weights
+    eps = torch.finfo(sim_map.dtype).eps
+    score = (weighted.sum(dim=[1, 2, 3]) + eps) / (torch.sum(weights, dim=[1, 2, 3]) + eps)
+
+    # Pixels without weight take the plain mean of their similarities
+    total_weight = weights.sum(dim=1)
+    local = torch.where(total_weight > 0, weighted.sum(dim=1) / total_weight.clamp_min(eps),
+                        (sim_map * haarpsi_alpha).sigmoid().mean(dim=1))
+
+    def logit(similarity):
+        return (torch.log(similarity / (1 - similarity)) / haarpsi_alpha) ** 2
+    return logit(local)[0], 0, logit(score)[0]
+
+
+def _fsim_map(x, y, workspace):
+    '''Local FSIM similarity, with the data range of compute_fsim'''
+    data_range = x.max() - x.min()
+    x = x / float(data_range) * 255
+    y = y / float(data_range) * 255
+
+    kernel_size = max(1, round(min(x.shape[-2:]) / 256))
+    x = F.avg_pool2d(x, kernel_size)
+    y = F.avg_pool2d(y, kernel_size)
+
+    chromatic = x.size(1) == 3
+    if chromatic:
+        x_yiq = piq_functional.rgb2yiq(x)
+        y_yiq = piq_functional.rgb2yiq(y)
+        x_lum, y_lum = x_yiq[:, :1], y_yiq[:, :1]
+    else:
+        x_lum, y_lum = x, y
+
+    filters = piq_fsim._construct_filters(x_lum, fsim_scales, fsim_orientations)
+    pc_x = piq_fsim._phase_congruency(x_lum, filters=filters, scales=fsim_scales, orientations=fsim_orientations)
+    pc_y = piq_fsim._phase_congruency(y_lum, filters=filters, scales=fsim_scales, orientations=fsim_orientations)
+
+    kernels = _gradient_kernels(piq_functional.scharr_filter(device=x_lum.device, dtype=x_lum.dtype))
+    grad_map_x = piq_functional.gradient_map(x_lum, kernels)
+    grad_map_y = piq_functional.gradient_map(y_lum, kernels)
+
+    similarity_map = piq_functional.similarity_map
+    local = similarity_map(grad_map_x, grad_map_y, fsim_t2) * similarity_map(pc_x, pc_y, fsim_t1)
+    pc_max = torch.where(pc_x > pc_y, pc_x, pc_y)
+    weighted = local * pc_max
+    if chromatic:
+        chromaticity = torch.abs(similarity_map(x_yiq[:, 1:2], y_yiq[:, 1:2], fsim_t3) *
+                                 similarity_map(x_yiq[:, 2:], y_yiq[:, 2:], fsim_t4)) ** fsim_lambda
+        weighted = weighted * chromaticity
+        local = local * chromaticity
+    return local[0, 0], 0, weighted.sum() / pc_max.sum()
+
+
+def _vsi_map(x, y, workspace):
+    '''Local VSI similarity'''
+    if x.size(1) == 1:
+        x = x.repeat(1, 3, 1, 1)
+        y = y.repeat(1, 3, 1, 1)
+    x = x * 255. / 1.0
+    y = y * 255. / 1.0
+
+    vs_x = piq_vsi.sdsp(x, data_range=255)
+    vs_y = piq_vsi.sdsp(y, data_range=255)
+    x_lmn = piq_functional.rgb2lmn(x)
+    y_lmn = piq_functional.rgb2lmn(y)
+
+    # Averaging image if the size is large enough
+    kernel_size = max(1, round(min(vs_x.size()[-2:]) / 256))
+    padding = kernel_size // 2
+    if padding:
+        pad_to_use = [padding, (kernel_size - 1) // 2, padding, (kernel_size - 1) // 2]
+        vs_x, vs_y = F.pad(vs_x, pad=pad_to_use, mode='replicate'), F.pad(vs_y, pad=pad_to_use, mode='replicate')
+        x_lmn, y_lmn = F.pad(x_lmn, pad=pad_to_use, mode='replicate'), F.pad(y_lmn, pad=pad_to_use, mode='replicate')
+    vs_x, vs_y = F.avg_pool2d(vs_x, kernel_size=kernel_size), F.avg_pool2d(vs_y, kernel_size=kernel_size)
+    x_lmn, y_lmn = F.avg_pool2d(x_lmn, kernel_size=kernel_size), F.avg_pool2d(y_lmn, kernel_size=kernel_size)
+
+    kernels = _gradient_kernels(piq_functional.scharr_filter(device=x_lmn.device, dtype=x_lmn.dtype))
+    gm_x = piq_functional.gradient_map(x_lmn[:, :1], kernels)
+    gm_y = piq_functional.gradient_map(y_lmn[:, :1], kernels)
+
+    similarity_map = piq_functional.similarity_map
+    s_vs = similarity_map(vs_x, vs_y, vsi_c1)
+    s_gm = similarity_map(gm_x, gm_y, vsi_c2)
+    s_c = similarity_map(x_lmn[:, 1:2], y_lmn[:, 1:2], vsi_c3) * similarity_map(x_lmn[:, 2:], y_lmn[:, 2:], vsi_c3)
+    # Real part of the power of the possibly negative chromatic similarity
+    s_c_real_pow = (s_c.abs() ** vsi_beta) * torch.cos(torch.atan2(torch.zeros_like(s_c), s_c) * vsi_beta)
+    local = s_vs * s_gm.pow(vsi_alpha) * s_c_real_pow
+
+    vs_max = torch.max(vs_x, vs_y)
+    eps = torch.finfo(vs_max.dtype).eps
+    score = ((local * vs_max).sum() + eps) / (vs_max.sum() + eps)
+    return local[0, 0], 0, score
+
+
+# Metric -> function of the distorted and reference tensors, and of their FusedMetrics
+# workspace, returning the native map, the margin lost to valid filtering and the score
+dense_map_metrics = {
+    'SSIM': _ssim_map,
+    'GMSD': _gmsd_map,
+    'MDSI': _mdsi_map,
+    'HaarPSI': _haarpsi_map,
+    'FSIM': _fsim_map,
+    'VSI': _vsi_map,
+}
+
+
+def _to_image_size(native_map, margin, shape):
+    '''Native map spread over the image: edges lost to valid filtering are replicated, then resized'''
+    native_map = native_map.detach().float().cpu().numpy()
+    if margin:
+        native_map = np.pad(native_map, margin, mode='edge')
+    if native_map.shape != tuple(shape):
+        native_map = cv2.resize(native_map, (shape[1], shape[0]), interpolation=cv2.INTER_LINEAR)
+    return native_map.astype(np.float32)
+
+
+def compute_dense_map(dist, ref, metric_name='SSIM', color_space='HSV', channel=None):
+    """
+    Compute the dense map of a metric from its native per-pixel map, in one pass over the images.
+
+    Args:
+        dist (str, bytes, numpy.ndarray or ImagePair): Path of distorted image, its content, the
+            BGR image, or an ImagePair of the distorted and reference images.
+        ref (str, bytes or numpy.ndarray): Path of reference image, its content, or the BGR
+            image; ignored if dist is an ImagePair.
+        metric_name (str): 'SSIM', 'GMSD', 'MDSI', 'HaarPSI', 'FSIM' or 'VSI'.
+        color_space (str): name of the color space.
+        channel (int, optional): Only compare this channel of the color space, as a grayscale
+            image; all channels if None.
+
+    Returns:
+        tuple: (float32 map shaped as the distorted image,
+            metadata dictionary with the 'metric', 'color_space', 'channel', the shape of
+            the 'native_shape' map before resizing, its pooled 'score', which is the value
+            of the metric, and the 'min', 'max' and 'mean' of the map)
+
+    Raises:
+        FileNotFoundError: If an image cannot be read.
+        KeyError: If the metric has no dense map.
+    """
+    if metric_name not in dense_map_metrics:
+        raise KeyError(f"No dense map for metric '{metric_name}', use one of {list(dense_map_metrics)}")
+
+    pair = dist if isinstance(dist, ImagePair) else ImagePair(dist, ref)
+    x, y = pair.tensor('dist', color_space), pair.tensor('ref', color_space)
+    if channel is None:
+        workspace = pair.workspace(color_space)
+    else:
+        x, y = x[:, channel:channel + 1], y[:, channel:channel + 1]
+        workspace = FusedMetrics(x, y)
+
+    with profiling.stage('forward'), inference.context(metric_name):
+        native_map, margin, score = dense_map_metrics[metric_name](x, y, workspace)
+        metric_map = _to_image_size(native_map, margin, x.shape[-2:])
+
+    finite = metric_map[np.isfinite(metric_map)]
+    metadata = {
+        'metric': metric_name,
+        'color_space': color_space,
+        'channel': channel,
+        'native_shape': list(native_map.shape),
+        'score': float(score),
+        'min': float(finite.min()) if finite.size else float("nan"),
+        'max': float(finite.max()) if finite.size else float("nan"),
+        'mean': float(finite.mean()) if finite.size else float("nan"),
+    }
+    return metric_map, metadata
+
+
+def __dir__():
+    return ["compute_dense_map", "dense_map_metrics"]
@@ -0,0 +1,285 @@
+"""
+This module computes the metrics of the SSIM and gradient magnitude families from shared
+intermediates.
+
+SSIM and MS-SSIM are both built on Gaussian-filtered means, variances and covariances of
+an image pyramid, and GMSD and MS-GMSD on the Prewitt gradient magnitudes of a luma pyramid.
+A FusedMetrics workspace computes each pyramid level, filtered statistic and gradient map
+once for an image pair, and every requested metric is derived from them.
+
+The computations follow piq step by step, so the SSIM and MS-SSIM values are identical to
+piq.ssim and piq.multi_scale_ssim, and the GMSD and MS-GMSD values agree with piq.gmsd and
+piq.multi_scale_gmsd to float32 rounding.
+"""
+
+from .utils import *
+
+torch = lazy_import('torch')
+F = lazy_import('torch.nn.functional')
+
+
+# Parameters of the metrics, as in piq
+ssim_kernel_size = 11
+ssim_kernel_sigma = 1.5
+ssim_k1, ssim_k2 = 0.01, 0.03
+ms_ssim_weights = [0.0448, 0.2856, 0.3001, 0.2363, 0.1333]
+
+# Constant of the gradient similarity for images in [0, 1]; piq uses 170 for images in [0, 255]
+gms_constant = 170 / (255. ** 2)
+ms_gmsd_weights = [0.096, 0.596, 0.289, 0.019]
+ms_gmsd_alpha = 0.5
+
+# Luma weights of the YIQ color space
+yiq_luma_weights = [0.299, 0.587, 0.114]
+
+
+class FusedMetrics:
+    """
+    Shared intermediates of a distorted and a reference image, and the metrics derived from them.
+
+    The intermediates of each image are kept apart from the joint ones, so that workspaces
+    comparing several distorted images to the same reference can share the reference side.
+
+    Example:
+        workspace = FusedMetrics(dist_tensor, ref_tensor)
+        ssim, ms_ssim = workspace.ssim(), workspace.ms_ssim()   # MS-SSIM reuses the SSIM statistics
+    """
+
+    def __init__(self, x, y, y_memo=None):
+        """
+        Args:
+            x (torch.Tensor): Distorted images in [0, 1], shaped (N, C, H, W).
+            y (torch.Tensor): Reference images in [0, 1], shaped (N, C, H, W).
+            y_memo (dict, optional): Intermediates of the reference images, shared by the
+                workspaces comparing other distorted images to the same reference.
+        """
+        self.x = x
+        self.y = y
+        self._memo = {'x': {}, 'y': {} if y_memo is None else y_memo, 'xy': {}}
+
+
+    def _cached(self, side, key, fn):
+        '''Value of fn(), computed once per key for the images of a side: 'x', 'y' or 'xy' for both'''
+        memo = self._memo[side]
+        if key not in memo:
+            memo[key] = fn()
+        return memo[key]
+
+
+    def _image(self, side):
+        return self.x if side == 'x' else self.y
+
+
+    ##################### SSIM FAMILY ###########################################
+
+    def _gaussian_kernel(self):
+        def build():
+            coords = torch.arange(ssim_kernel_size, dtype=self.x.dtype, device=self.x.device)
+            coords -= (ssim_kernel_size - 1) / 2.
+            g = coords ** 2
+            g = (- (g.unsqueeze(0) + g.unsqueeze(1)) / (2 * ssim_kernel_sigma ** 2)).exp()
+            g /= g.sum()
+            return g.unsqueeze(0).repeat(self.x.size(1), 1, 1, 1)
+        return self._cached('xy', 'gaussian_kernel', build)
+
+
+    def _ssim_input(self, side, scale):
+        '''
+        Images of a side at a scale: ('pyramid', level) for a level of the MS-SSIM pyramid,
+        halved with replicate padding at each level, or ('pooled', f) for the images average
+        pooled by f
+        '''
+        def build():
+            kind, factor = scale
+            if kind == 'pooled':
+                return F.avg_pool2d(self._image(side), kernel_size=factor)
+            if factor == 0:
+                return self._image(side)
+            image = self._ssim_input(side, ('pyramid', factor - 1))
+            padding = max(image.shape[2] % 2, image.shape[3] % 2)
+            image = F.pad(image, pad=[padding, 0, padding, 0], mode='replicate')
+            return F.avg_pool2d(image, kernel_size=2, padding=0)
+        return self._cached(side, ('ssim_input', scale), build)
+
+
+    def _filtered(self, side, scale):
+        '''Gaussian-filtered mean, squared mean and variance of the images of a side at a scale'''
+        def build():
+            image = self._ssim_input(side, scale)
+            kernel = self._gaussian_kernel()
+            if image.size(-1) < kernel.size(-1) or image.size(-2) < kernel.size(-2):
+                raise ValueError(f'Kernel size can\'t be greater than actual input size. '
+                                 f'Input size: {image.size()}. Kernel size: {kernel.size()}')
+            mu = F.conv2d(image, weight=kernel, stride=1, padding=0, groups=image.size(1))
+            mu_sq = mu ** 2
+            sigma_sq = F.conv2d(image ** 2, weight=kernel, stride=1, padding=0, groups=image.size(1)) - mu_sq
+            return mu, mu_sq, sigma_sq
+        return self._cached(side, ('filtered', scale), build)
+
+
+    def _ssim_maps(self, scale):
+        '''Per channel SSIM and contrast-structure maps at a scale'''
+        c1 = ssim_k1 ** 2
+        c2 = ssim_k2 ** 2
+        mu_x, mu_xx, sigma_xx = self._filtered('x', scale)
+        mu_y, mu_yy, sigma_yy = self._filtered('y', scale)
+        x, y = self._ssim_input('x', scale), self._ssim_input('y', scale)
+        mu_xy = mu_x * mu_y
+        sigma_xy = F.conv2d(x * y, weight=self._gaussian_kernel(), stride=1, padding=0, groups=x.size(1)) - mu_xy
+
+        cs = (2. * sigma_xy + c2) / (sigma_xx + sigma_yy + c2)
+        ss = (2. * mu_xy + c1) / (mu_xx + mu_yy + c1) * cs
+        return ss, cs
+
+
+    def _ssim_statistics(self, scale):
+        '''Per channel SSIM and contrast-structure means at a scale'''
+        def build():
+            ss, cs = self._ssim_maps(scale)
+            return ss.mean(dim=(-1, -2)), cs.mean(dim=(-1, -2))
+        return self._cached('xy', ('ssim_statistics', scale), build)
+
+
+    def _ssim_scale(self):
+        '''Scale of the images SSIM is computed on, and the factor they are downsampled by'''
+        # Images are average pooled when they are large enough
+        f = max(1, round(min(self.x.size()[-2:]) / 256))
+        if f == 1:
+            return ('pyramid', 0), f
+        if f == 2 and self.x.shape[2] % 2 == 0 and self.x.shape[3] % 2 == 0:
+            # Same images as the first level of the MS-SSIM pyramid
+            return ('pyramid', 1), f
+        return ('pooled', f), f
+
+
+    def ssim(self):
+        """
+        Returns:
+            torch.Tensor: SSIM of each image, as piq.ssim with reduction='none'.
+        """
+        scale, _ = self._ssim_scale()
+        ssim_val, _ = self._ssim_statistics(scale)
+        return ssim_val.mean(1)
+
+
+    def ssim_map(self):
+        """
+        Returns:
+            tuple: (SSIM map of each image averaged over the channels, shaped (N, H', W'),
+                whose mean is the SSIM of piq.ssim up to float32 rounding, and the factor
+                the images were downsampled by before the valid Gaussian filtering)
+        """
+        scale, f = self._ssim_scale()
+        ss, _ = self._ssim_maps(scale)
+        return ss.mean(1), f
+
+
+    def ms_ssim(self):
+        """
+        Returns:
+            torch.Tensor: MS-SSIM of each image, as piq.multi_scale_ssim with reduction='none'.
+        """
+        scale_weights = torch.tensor(ms_ssim_weights, dtype=self.x.dtype, device=self.x.device)
+        levels = scale_weights.size(0)
+        min_size = (ssim_kernel_size - 1) * 2 ** (levels - 1) + 1
+        if self.x.size(-1) < min_size or self.x.size(-2) < min_size:
+            raise ValueError(f'Invalid size of the input images, expected at least {min_size}x{min_size}.')
+
+        mcs = []
+        ssim_val = None
+        for level in range(levels):
+            ssim_val, cs = self._ssim_statistics(('pyramid', level))
+            mcs.append(cs)
+
+        mcs_ssim = torch.relu(torch.stack(mcs[:-1] + [ssim_val], dim=0))
+        return torch.prod((mcs_ssim ** scale_weights.view(-1, 1, 1)), dim=0).mean(1)
+
+
+    ##################### GRADIENT MAGNITUDE FAMILY ###########################################
+
+    def _luma_pyramid(self, side, level):
+        '''YIQ luma of the images of a side at a level of the pyramid, halved with zero padding at each level'''
+        def build():
+            if level == 0:
+                image = self._image(side)
+                if image.size(1) != 3:
+                    return image[:, :1]
+                weights = torch.tensor(yiq_luma_weights, dtype=image.dtype, device=image.device).view(1, 3, 1, 1)
+                return (image * weights).sum(dim=1, keepdim=True)
+
+            image = self._luma_pyramid(side, level - 1)
+            down_pad = max(image.shape[2] % 2, image.shape[3] % 2)
+            image = F.pad(image, pad=[0, down_pad, 0, down_pad])
+            return F.avg_pool2d(image, kernel_size=2, padding=0)
+        return self._cached(side, ('luma_pyramid', level), build)
+
+
+    def _gradients(self, side, level):
+        '''Prewitt gradient magnitude of the luma of a side at a level of the pyramid'''
+        def build():
+            image = self._luma_pyramid(side, level)
+            p_filter = torch.tensor([[[-1., 0., 1.], [-1., 0., 1.], [-1., 0., 1.]]], dtype=image.dtype, device=image.device) / 3
+            kernels = torch.stack([p_filter, p_filter.transpose(-1, -2)])
+            return torch.sqrt(torch.sum(F.conv2d(image, kernels, padding=1) ** 2, dim=-3, keepdim=True))
+        return self._cached(side, ('gradients', level), build)
+
+
+    def _gms(self, level, alpha):
+        '''Gradient magnitude similarity map at a level of the pyramid'''
+        x_grad, y_grad = self._gradients('x', level), self._gradients('y', level)
+        return (2.0 * x_grad * y_grad - alpha * x_grad * y_grad + gms_constant) / \
+               (x_grad ** 2 + y_grad ** 2 - alpha * x_grad * y_grad + gms_constant)
+
+
+    def _gms_deviation(self, level, alpha):
+        '''Standard deviation of the gradient magnitude similarity at a level of the pyramid'''
+        gms = self._gms(level, alpha)
+        mean_gms = torch.mean(gms, dim=[1, 2, 3], keepdim=True)
+        return torch.pow(gms - mean_gms, 2).mean(dim=[1, 2, 3]).sqrt()
+
+
+    def gmsd(self):
+        """
+        Returns:
+            torch.Tensor: GMSD of each image, as piq.gmsd with reduction='none'.
+        """
+        # GMSD is computed on the images halved once
+        return self._gms_deviation(1, 0.0)
+
+
+    def gmsd_map(self):
+        """
+        Returns:
+            torch.Tensor: Absolute deviation of the gradient magnitude similarity from its
+                mean, shaped (N, H / 2, W / 2), whose root mean square is the GMSD.
+        """
+        gms = self._gms(1, 0.0)[:, 0]
+        return (gms - gms.mean(dim=(-1, -2), keepdim=True)).abs()
+
+
+    def ms_gmsd(self):
+        """
+        Returns:
+            torch.Tensor: MS-GMSD of each image, as piq.multi_scale_gmsd with reduction='none'.
+        """
+        scale_weights = torch.tensor(ms_gmsd_weights, dtype=self.x.dtype, device=self.x.device)
+        num_scales = scale_weights.size(0)
+        min_size = 2 ** num_scales + 1
+        if self.x.size(-1) < min_size or self.x.size(-2) < min_size:
+            raise ValueError(f'Invalid size of the input images, expected at least {min_size}x{min_size}.')
+
+        ms_gmds = torch.stack([self._gms_deviation(scale, ms_gmsd_alpha) for scale in range(num_scales)], dim=1)
+        return torch.sqrt(torch.sum(scale_weights.view(1, num_scales) * (ms_gmds ** 2), dim=1))
+
+
+# Metrics derived from a FusedMetrics workspace, one value per image
+fused_metrics = {
+    'SSIM': FusedMetrics.ssim,
+    'MS-SSIM': FusedMetrics.ms_ssim,
+    'GMSD': FusedMetrics.gmsd,
+    'MS-GMSD': FusedMetrics.ms_gmsd,
+}
+
+
+def __dir__():
+    return ["FusedMetrics", "fused_metrics"]
@@ -3,11 +3,17 @@ This module provides functions to compare two images and generate a thresholded
 
 It supports various color spaces and allows for comparing specific color channels.
 The thresholded difference image highlights the significant differences between the two images.
+
+diff_statistics computes the absolute difference once per color space and returns its
+statistics instead of images: the number of pixels above every threshold, from a single
+histogram, per-channel histograms, and the bounding boxes of the changed regions.
 """
 
 import cv2
+import numpy as np
 
 from .utils import *
+from . import profiling
 
 
 def diff_images(image1_path, image2_path, threshold=0, color_space_name='HSV', colormap_name='JET', color_channels=None):
@@ -31,42 +37,157 @@ def diff_images(image1_path, image2_path, threshold=0, color_space_name='HSV', c
         image difference image (open CV)
         iamge difference histogram equalized (open CV)
     """
-    # Load and convert images
-    color_space_code = get_color_space_code(color_space_name)
-    image1 = load_and_convert_image(image1_path, color_space_code)
-    image2 = load_and_convert_image(image2_path, color_space_code)
-    
     colormap = color_maps['JET']
     if colormap_name in color_maps:
         colormap = color_maps[colormap_name]
     else:
         print(f"{colormap_name} colormap does not exist. JET will be used!")
 
+    thresholded_diff = difference_image(image1_path, image2_path, threshold, color_space_name, color_channels)
 
-    if color_channels is None:
-        # Calculate the absolute difference between the images
-        difference = cv2.absdiff(image1, image2)
-    else:
-        # Calculate the absolute difference between specific color channels
-        image1_channels = cv2.split(image1)
-        image2_channels = cv2.split(image2)
-        difference = cv2.absdiff(image1_channels[color_channels], image2_channels[color_channels])
-
-    # Apply threshold 
-    _, thresholded_diff = cv2.threshold(difference, threshold, 255, cv2.THRESH_TOZERO)
-    
-    # Convert the difference to grayscale
-    diff_gray = cv2.cvtColor(thresholded_diff, cv2.COLOR_BGR2GRAY)
+    with profiling.stage('diff'):
+        # Convert the difference to grayscale
+        diff_gray = cv2.cvtColor(thresholded_diff, cv2.COLOR_BGR2GRAY)
 
-    # histogram equalize the difference    
-    equalized_diff = cv2.equalizeHist(diff_gray)
+        # histogram equalize the difference    
+        equalized_diff = cv2.equalizeHist(diff_gray)
 
-    # Apply a colormap to visualize the difference
-    heatmap = cv2.applyColorMap(diff_gray, colormap)
-    heatmapEq = cv2.applyColorMap(equalized_diff, colormap)
+    with profiling.stage('render'):
+        # Apply a colormap to visualize the difference
+        heatmap = cv2.applyColorMap(diff_gray, colormap)
+        heatmapEq = cv2.applyColorMap(equalized_diff, colormap)
     
     return heatmap, heatmapEq
 
 
+def difference_image(image1_path, image2_path, threshold=0, color_space_name='HSV', color_channels=None):
+    """
+    Thresholded absolute difference of two images, before it is rendered by diff_images.
+
+    Args:
+        image1_path (str, bytes or numpy.ndarray): The first image, as a path, the content of
+            an image file, or a BGR image.
+        image2_path (str, bytes or numpy.ndarray): The second image, in the same forms.
+        threshold (int): Differences up to this value are set to zero.
+        color_space_name (str): name of the color space to use
+        color_channels (int or None, optional): Only compare this channel; all channels if None.
+
+    Raises:
+        FileNotFoundError: If either of the input image files is not found.
+
+    Returns:
+        numpy.ndarray: uint8 difference, with the channels of the color space.
+    """
+    # Load and convert images
+    color_space_code = get_color_space_code(color_space_name)
+    image1 = load_and_convert_image(image1_path, color_space_code)
+    image2 = load_and_convert_image(image2_path, color_space_code)
+
+    with profiling.stage('diff'):
+        if color_channels is None:
+            # Calculate the absolute difference between the images
+            difference = cv2.absdiff(image1, image2)
+        else:
+            # Calculate the absolute difference between specific color channels
+            image1_channels = cv2.split(image1)
+            image2_channels = cv2.split(image2)
+            difference = cv2.absdiff(image1_channels[color_channels], image2_channels[color_channels])
+
+        # Apply threshold 
+        _, thresholded_diff = cv2.threshold(difference, threshold, 255, cv2.THRESH_TOZERO)
+    return thresholded_diff
+
+
+# Thresholds of the sweep: every value of an 8-bit difference
+num_levels = 256
+
+
+def diff_statistics(image1_path, image2_path, color_space_names=('HSV',), threshold=0, color_channels=None, min_box_area=1):
+    """
+    Statistics of the absolute difference of two images, without rendering it.
+
+    The difference of a pixel is the largest absolute difference of its channels, or of the
+    selected channel. Each image is decoded once, and for each color space the difference is
+    computed once and histogrammed, so the number of pixels above every threshold comes from
+    a single cumulative sum instead of one diff_images call per threshold.
+
+    Args:
+        image1_path (str, bytes or numpy.ndarray): The first image, as a path, the content of
+            an image file, or a BGR image.
+        image2_path (str, bytes or numpy.ndarray): The second image, in the same forms.
+        color_space_names (list of str, optional): Color spaces to compare the images in.
+            Default is HSV.
+        threshold (int, optional): Pixels whose difference is above this value are changed,
+            for the bounding boxes. Default is 0.
+        color_channels (int, optional): Only compare this channel; all channels if None.
+        min_box_area (int, optional): Changed regions with fewer pixels are left out of the
+            bounding boxes. Default is 1.
+
+    Returns:
+        dict: Color space name -> dictionary holding
+            'pixels': the number of pixels,
+            'counts': (L,) int64 array, whose element t is the number of pixels whose
+                difference is above t, as highlighted by diff_images with threshold t;
+                L is 256, or the largest difference plus one for 16-bit images,
+            'fractions': (256,) float64 array, counts divided by the number of pixels,
+            'channel_histograms': (C, L) int64 array, histogram of the absolute difference
+                of each compared channel,
+            'channel_means': (C,) float64 array, mean absolute difference of each channel,
+            'max': the largest difference,
+            'boxes': (B, 5) int64 array of (x, y, width, height, pixels) rows, one per
+                8-connected region of changed pixels, largest first.
+
+    Raises:
+        FileNotFoundError: If either of the input image files is not found.
+        KeyError: If a color space does not exist.
+    """
+    # Read as in difference_image, so that the statistics are those of the rendered differences
+    image1 = read_unchanged_image(image1_path)
+    image2 = read_unchanged_image(image2_path)
+
+    statistics = {}
+    for color_space_name in color_space_names:
+        with profiling.stage('cvtColor'):
+            converted1 = cv2.cvtColor(image1, color_spaces[color_space_name])
+            converted2 = cv2.cvtColor(image2, color_spaces[color_space_name])
+
+        with profiling.stage('diff'):
+            difference = cv2.absdiff(converted1, converted2)
+            if difference.ndim == 2:
+                difference = difference[:, :, None]
+            if color_channels is not None:
+                difference = difference[:, :, [color_channels]]
+            pixel_difference = difference.max(axis=2)
+
+            # Every histogram has one bin per level, 8-bit or up to the largest difference of 16-bit images
+            levels = max(num_levels, int(pixel_difference.max()) + 1)
+
+            # Pixels above each threshold, from the histogram of the differences
+            histogram = np.bincount(pixel_difference.ravel(), minlength=levels).astype(np.int64)
+            pixels = int(pixel_difference.size)
+            counts = pixels - np.cumsum(histogram)
+
+            channel_histograms = np.stack([np.bincount(difference[:, :, c].ravel(), minlength=levels)
+                                           for c in range(difference.shape[2])]).astype(np.int64)
+            channel_means = (channel_histograms * np.arange(levels)).sum(axis=1) / pixels
+
+            # Bounding boxes of the regions of changed pixels
+            changed = (pixel_difference > threshold).astype(np.uint8)
+            _, _, stats, _ = cv2.connectedComponentsWithStats(changed, connectivity=8)
+            boxes = stats[1:][stats[1:, cv2.CC_STAT_AREA] >= min_box_area].astype(np.int64)
+            boxes = boxes[np.argsort(-boxes[:, cv2.CC_STAT_AREA], kind='stable')]
+
+        statistics[color_space_name] = {
+            'pixels': pixels,
+            'counts': counts,
+            'fractions': counts / pixels,
+            'channel_histograms': channel_histograms,
+            'channel_means': channel_means,
+            'max': int(pixel_difference.max()),
+            'boxes': boxes,
+        }
+    return statistics
+
+
 def __dir__():
-    return ["diff_images"]
\ No newline at end of file
+    return ["diff_images", "difference_image", "diff_statistics"]
\ No newline at end of file
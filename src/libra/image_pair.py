@@ -0,0 +1,293 @@
+"""
+This module provides the ImagePair class, a comparison session between a distorted and a
+reference image.
+
+Each image is decoded once, and every color space conversion and tensor built from it is
+cached, so that computing many metrics in many color spaces does not repeat that work.
+Metrics of the SSIM and gradient magnitude families are derived from a FusedMetrics
+workspace per color space, sharing their filtered statistics and gradient maps, and LPIPS
+and DISTS from the deep features of each image.
+
+The work done on each image is cached apart, so that comparing many distorted images to one
+reference (ImagePair.with_distorted, or compare_to_reference) does it once for the reference.
+"""
+
+import cv2
+
+from .utils import *
+from .metrics import *
+from . import profiling
+from . import result_cache
+from . import inference
+from .fused_metrics import FusedMetrics, fused_metrics
+from .deep_features import deep_feature_metrics, extract_features, feature_distance
+from .numpy_backend import numpy_metrics, resolve_backend
+
+
+class ImagePair:
+    """
+    A distorted and a reference image with lazily cached conversions.
+
+    Example:
+        pair = ImagePair("compressed.png", "orig.png")
+        results = pair.compute(["SSIM", "PSNR"], ["RGB", "LAB"])
+    """
+
+    def __init__(self, dist, ref, buffers=None):
+        """
+        Args:
+            dist (str, bytes or numpy.ndarray): Distorted image, as a path, the content of an
+                image file, or a BGR image.
+            ref (str, bytes or numpy.ndarray): Reference image, in the same forms.
+            buffers (dict, optional): Tensors of the distorted image of a previous pair that is
+                no longer used, by color space; they are reused to hold the tensors of this
+                distorted image, and replaced by them.
+        """
+        self._sources = {'dist': dist, 'ref': ref}
+        # which -> cache of the work done on the image: decoded image, conversions, tensors,
+        # content hash, deep features and fused metric intermediates
+        self._caches = {'dist': {}, 'ref': {}}
+        self._workspaces = {}   # color space -> FusedMetrics
+        self._buffers = buffers
+
+
+    def with_distorted(self, dist, buffers=None):
+        """
+        Pair another distorted image with the same reference.
+
+        The new pair shares the cache of the reference with this pair, so the reference is
+        decoded, converted and processed once for all the pairs.
+
+        Args:
+            dist (str, bytes or numpy.ndarray): Distorted image, in the same forms as in __init__.
+            buffers (dict, optional): Tensors to reuse for the distorted image, as in __init__.
+
+        Returns:
+            ImagePair: The new pair.
+        """
+        pair = ImagePair(dist, self._sources['ref'], buffers)
+        pair._caches['ref'] = self._caches['ref']
+        return pair
+
+
+    def _cached(self, which, key, fn):
+        '''Value of fn(), computed once per key for an image'''
+        cache = self._caches[which]
+        if key not in cache:
+            cache[key] = fn()
+        return cache[key]
+
+
+    def image(self, which):
+        """
+        Args:
+            which (str): 'dist' or 'ref'.
+
+        Returns:
+            numpy.ndarray: The decoded BGR image.
+        """
+        return self._cached(which, 'image', lambda: decode_image(self._sources[which]))
+
+
+    def converted(self, which, color_space_name):
+        """
+        Args:
+            which (str): 'dist' or 'ref'.
+            color_space_name (str): Name of the color space e.g. 'LAB'.
+
+        Returns:
+            numpy.ndarray: The image converted to the color space.
+        """
+        def convert():
+            image = self.image(which)
+            with profiling.stage('cvtColor'):
+                return cv2.cvtColor(image, color_spaces[color_space_name])
+        return self._cached(which, ('converted', color_space_name), convert)
+
+
+    def tensor(self, which, color_space_name):
+        """
+        Args:
+            which (str): 'dist' or 'ref'.
+            color_space_name (str): Name of the color space e.g. 'LAB'.
+
+        Returns:
+            torch.Tensor: The converted image normalized to [0, 1], shaped (1, C, H, W).
+        """
+        def build():
+            if which != 'dist' or self._buffers is None:
+                return preprocess_image(self.converted(which, color_space_name))
+            tensor = preprocess_image(self.converted(which, color_space_name), self._buffers.get(color_space_name))
+            self._buffers[color_space_name] = tensor
+            return tensor
+        return self._cached(which, ('tensor', color_space_name), build)
+
+
+    def features(self, which, metric_name, color_space_name):
+        """
+        Args:
+            which (str): 'dist' or 'ref'.
+            metric_name (str): 'LPIPS' or 'DISTS'.
+            color_space_name (str): Name of the color space e.g. 'LAB'.
+
+        Returns:
+            list of torch.Tensor: The deep features of the image used by the metric.
+        """
+        return self._cached(which, ('features', metric_name, color_space_name),
+                            lambda: extract_features(metric_name, self.tensor(which, color_space_name)))
+
+
+    def workspace(self, color_space_name):
+        """
+        Args:
+            color_space_name (str): Name of the color space e.g. 'LAB'.
+
+        Returns:
+            FusedMetrics: The intermediates shared by the fused metrics in the color space.
+        """
+        if color_space_name not in self._workspaces:
+            reference_memo = self._cached('ref', ('fused', color_space_name), dict)
+            self._workspaces[color_space_name] = FusedMetrics(self.tensor('dist', color_space_name),
+                                                              self.tensor('ref', color_space_name),
+                                                              reference_memo)
+        return self._workspaces[color_space_name]
+
+
+    def content_hash(self, which):
+        """
+        Args:
+            which (str): 'dist' or 'ref'.
+
+        Returns:
+            str: Hash of the content of the image, computed without decoding it.
+        """
+        return self._cached(which, 'hash', lambda: result_cache.content_hash(self._sources[which]))
+
+
+    def compute_metric(self, metric_name='SSIM', color_space_name='LAB', backend=None):
+        """
+        Compute one metric in one color space.
+
+        Args:
+            metric_name (str): metric to use e.g. 'SSIM'.
+            color_space_name (str): Name of the color space to use e.g. 'LAB'.
+            backend (str, optional): 'torch', 'numpy' to compute MSE, PSNR, SSIM, GMSD or
+                PHASH with NumPy and OpenCV, or 'auto' to use numpy when torch is not
+                installed. Default is the classical_backend inference setting.
+
+        Returns:
+            float: The metric value, nan if the metric does not exist.
+
+        Raises:
+            ValueError: If the backend does not exist, or the numpy backend does not compute the metric.
+        """
+        if metric_name not in metrics:
+            return float("nan")
+        backend = resolve_backend(backend or inference.settings['classical_backend'], metric_name)
+
+        cache = result_cache.get_cache()
+        key = None
+        if cache is not None:
+            try:
+                ref_hash = None if metric_name in no_reference_metrics else self.content_hash('ref')
+                key = cache.make_key('metric', self.content_hash('dist'), ref_hash, metric_name, color_space_name,
+                                     backend=backend if backend == 'numpy' else None)
+            except OSError:
+                # Missing images are reported when they are decoded
+                key = None
+
+        if key is not None:
+            value = cache.get(key)
+            if value is not None:
+                profiling.count('cache hits')
+                return value
+            profiling.count('cache misses')
+
+        value = self._compute_metric(metric_name, color_space_name, backend)
+        if key is not None and value is not None:
+            cache.put(key, value)
+        return value
+
+
+    def _compute_metric(self, metric_name, color_space_name, backend='torch'):
+        '''Compute one metric in one color space, without the result cache'''
+        if backend == 'numpy':
+            with profiling.stage('forward'):
+                return numpy_metrics[metric_name](self.converted('dist', color_space_name),
+                                                  self.converted('ref', color_space_name))
+
+        if metric_name in fused_metrics:
+            workspace = self.workspace(color_space_name)
+            with profiling.stage('forward'), inference.context(metric_name):
+                return fused_metrics[metric_name](workspace).item()
+
+        if metric_name in deep_feature_metrics:
+            return feature_distance(metric_name, self.features('dist', metric_name, color_space_name),
+                                    self.features('ref', metric_name, color_space_name)).item()
+
+        metric_fn = metrics[metric_name]
+        if metric_name in array_metrics:
+            inputs = self.converted
+        else:
+            inputs = self.tensor
+
+        if metric_name in no_reference_metrics:
+            args = (inputs('dist', color_space_name),)
+        else:
+            args = (inputs('dist', color_space_name), inputs('ref', color_space_name))
+
+        with profiling.stage('forward'):
+            return metric_fn(*args)
+
+
+    def compute(self, metric_names, color_space_names, backend=None):
+        """
+        Compute several metrics in several color spaces.
+
+        Args:
+            metric_names (list of str): metrics to use e.g. ['SSIM', 'PSNR'].
+            color_space_names (list of str): color spaces to use e.g. ['RGB', 'LAB'].
+            backend (str, optional): Backend of the classical metrics, as in compute_metric.
+
+        Returns:
+            list: One dictionary per metric, holding the metric name under 'Metric' and its
+                value for each color space under the name of the color space.
+        """
+        results = []
+        for metric_name in metric_names:
+            metric_result = {'Metric': metric_name}
+            for color_space_name in color_space_names:
+                metric_result[color_space_name] = self.compute_metric(metric_name, color_space_name, backend)
+            results.append(metric_result)
+        return results
+
+
+def compare_to_reference(ref, dists, metric_names, color_space_names):
+    """
+    Compute metrics between one reference and many distorted images.
+
+    The reference is decoded, converted and processed once, and its statistics and deep
+    features are reused for every distorted image. The tensors of each distorted image are
+    written to the buffers of the previous one, so they are allocated once.
+
+    Args:
+        ref (str, bytes or numpy.ndarray): Reference image.
+        dists (iterable): Distorted images, in the same forms.
+        metric_names (list of str): metrics to use e.g. ['SSIM', 'LPIPS'].
+        color_space_names (list of str): color spaces to use e.g. ['RGB', 'LAB'].
+
+    Yields:
+        tuple: (distorted image, results as returned by ImagePair.compute)
+    """
+    reference_pair, buffers = None, {}
+    for dist in dists:
+        if reference_pair is None:
+            reference_pair = ImagePair(dist, ref, buffers)
+            pair = reference_pair
+        else:
+            pair = reference_pair.with_distorted(dist, buffers)
+        yield dist, pair.compute(metric_names, color_space_names)
+
+
+def __dir__():
+    return ["ImagePair", "compare_to_reference"]
@@ -0,0 +1,223 @@
+"""
+This module holds the process-wide settings used when metrics run their torch computations.
+
+By default metrics run in torch.inference_mode, so no autograd graph is recorded, with the
+other settings left to torch. The settings can be changed with configure():
+
+- num_threads: intra-op threads of torch, e.g. 1 per worker when several processes share
+  the CPUs.
+- channels_last: images and models in the channels last memory format, which is faster for
+  the convolutions of the deep models on most CPUs.
+- bfloat16: the deep models listed in bfloat16_metrics run under bfloat16 autocast on the
+  CPU; their features are returned in float32.
+- compile: the feature extractors of the deep models listed in compiled_metrics are compiled
+  with torch.compile, with the given backend if a name is given.
+- backend: 'torch', or 'onnx' to run the networks of the learned metrics with ONNX Runtime
+  (see onnx_backend), with the weights of their matrix multiplications quantized to int8
+  if int8 is set.
+- classical_backend: 'torch', or 'numpy' to compute MSE, PSNR, SSIM, GMSD and PHASH with
+  NumPy and OpenCV (see numpy_backend); 'auto' uses numpy when torch is not installed.
+
+Changing channels_last, compile, backend or int8 drops the models already built, so they are
+built again with the new settings.
+
+Example:
+    from libra import inference
+
+    inference.configure(num_threads=4, channels_last=True, bfloat16=True)
+    libra.compute_metric("compressed.png", "orig.png", "LPIPS", "RGB")
+"""
+
+import functools
+import contextlib
+
+from .utils import *
+
+torch = lazy_import('torch')
+
+
+default_settings = {
+    'inference_mode': True,
+    'num_threads': None,
+    'channels_last': False,
+    'bfloat16': False,
+    'compile': False,
+    'backend': 'torch',
+    'int8': False,
+    'classical_backend': 'auto',
+}
+
+# Deep models whose values stay within about 1e-2 of float32 under bfloat16 autocast
+bfloat16_metrics = ['LPIPS', 'DISTS']
+
+# Deep models whose feature extractor is compiled when compile is set
+compiled_metrics = ['LPIPS', 'DISTS', 'PieAPP']
+
+# Backends running the networks of the learned metrics
+backends = ['torch', 'onnx']
+
+# Backends computing the classical metrics; 'auto' is numpy when torch is not installed
+classical_backends = ['auto', 'torch', 'numpy']
+
+# Settings applied to the models when they are built
+model_settings = ['channels_last', 'compile', 'backend', 'int8']
+
+settings = dict(default_settings)
+
+
+def configure(**new_settings):
+    """
+    Change the inference settings of the process.
+
+    Args:
+        inference_mode (bool, optional): Run metrics in torch.inference_mode. Default is True.
+        num_threads (int, optional): Intra-op threads of torch; None leaves the torch default.
+        channels_last (bool, optional): Use the channels last memory format. Default is False.
+        bfloat16 (bool, optional): Run the models of bfloat16_metrics under bfloat16
+            autocast. Default is False.
+        compile (bool or str, optional): Compile the models of compiled_metrics, with the
+            default backend if True or the named backend e.g. 'inductor'. Default is False.
+        backend (str, optional): 'torch', or 'onnx' to run the networks of the learned metrics
+            with ONNX Runtime. Default is torch.
+        int8 (bool, optional): Quantize the matrix multiplications of the ONNX networks to
+            int8. Default is False.
+        classical_backend (str, optional): 'torch', 'numpy' to compute MSE, PSNR, SSIM, GMSD
+            and PHASH with NumPy and OpenCV, or 'auto' to use numpy when torch is not
+            installed. Default is auto.
+
+    Returns:
+        dict: The settings before the change, so that they can be restored with configure(**previous).
+
+    Raises:
+        KeyError: If a setting does not exist.
+        ValueError: If the backend or the classical backend does not exist.
+    """
+    for name in new_settings:
+        if name not in default_settings:
+            raise KeyError(f"Unknown inference setting '{name}', expected one of {list(default_settings)}")
+    if new_settings.get('backend', 'torch') not in backends:
+        raise ValueError(f"Unknown backend '{new_settings['backend']}', expected one of {backends}")
+    if new_settings.get('classical_backend', 'auto') not in classical_backends:
+        raise ValueError(f"Unknown classical backend '{new_settings['classical_backend']}', expected one of {classical_backends}")
+
+    previous = dict(settings)
+    settings.update(new_settings)
+
+    if settings['num_threads'] is not None and settings['num_threads'] != torch.get_num_threads():
+        torch.set_num_threads(settings['num_threads'])
+
+    if any(settings[name] != previous[name] for name in model_settings):
+        # Models are prepared when they are built, so build them again
+        from .model_registry import evict
+        evict()
+    return previous
+
+
+def get_settings():
+    """
+    Returns:
+        dict: A copy of the current inference settings.
+    """
+    return dict(settings)
+
+
+def value_settings(metric_name):
+    """
+    Settings that change the values of a metric, part of the keys of its cached results.
+
+    Args:
+        metric_name (str): Name of the metric.
+
+    Returns:
+        dict: The settings applied to the metric whose values differ from those of the
+            default settings, empty if there are none.
+    """
+    values = {}
+    if settings['bfloat16'] and metric_name in bfloat16_metrics:
+        values['bfloat16'] = True
+    if settings['backend'] == 'onnx':
+        from .onnx_backend import exported_methods
+        if metric_name in exported_methods:
+            values['backend'] = 'onnx'
+            values['int8'] = bool(settings['int8'])
+    return values
+
+
+def context(metric_name=None):
+    """
+    Context manager running a metric with the inference settings.
+
+    Args:
+        metric_name (str, optional): Name of the metric, to apply the settings restricted to
+            some metrics such as bfloat16.
+
+    Returns:
+        contextlib.ExitStack: The context manager.
+    """
+    stack = contextlib.ExitStack()
+    if settings['inference_mode']:
+        stack.enter_context(torch.inference_mode())
+    if settings['bfloat16'] and metric_name in bfloat16_metrics:
+        stack.enter_context(torch.autocast('cpu', dtype=torch.bfloat16))
+    return stack
+
+
+def run(metric_name):
+    """
+    Decorator running a metric function with the inference settings.
+
+    Args:
+        metric_name (str): Name of the metric.
+
+    Returns:
+        callable: The decorator.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with context(metric_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def prepare_input(x):
+    """
+    Args:
+        x (torch.Tensor): Images shaped (N, C, H, W).
+
+    Returns:
+        torch.Tensor: The images in the memory format of the settings.
+    """
+    if settings['channels_last'] and x.dim() == 4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
+
+
+def prepare_model(metric_name, model):
+    """
+    Apply the model settings to a model that was just built.
+
+    Args:
+        metric_name (str): Name of the metric.
+        model (object): The model, usually a torch.nn.Module.
+
+    Returns:
+        object: The prepared model.
+    """
+    if not isinstance(model, torch.nn.Module):
+        return model
+    if settings['channels_last']:
+        model = model.to(memory_format=torch.channels_last)
+    if settings['backend'] == 'onnx':
+        from .onnx_backend import prepare_model as prepare_onnx_model
+        return prepare_onnx_model(metric_name, model, settings['int8'])
+    if settings['compile'] and metric_name in compiled_metrics and hasattr(model, 'get_features'):
+        backend = settings['compile'] if isinstance(settings['compile'], str) else 'inductor'
+        # Compile the backbone only, so that the models keep their methods and attributes
+        model.get_features = torch.compile(model.get_features, backend=backend, dynamic=True)
+    return model
+
+
+def __dir__():
+    return ["configure", "get_settings", "context", "run", "prepare_input", "prepare_model"]
@@ -6,12 +6,19 @@ The computed metric values and maps can be used for evaluating the quality of im
 and detecting differences between them.
 """
 
+import os
+import sys
+
 import cv2
 import numpy as np
-import matplotlib.pyplot as plt
 
 from .utils import *
 from .metrics import *
+from . import profiling
+from . import result_cache
+from . import inference
+
+torch = lazy_import('torch')
 
 
 
@@ -47,18 +54,162 @@ def compute_mse_map(im1, im2, patch_size=161, step=50):
     Returns:
         numpy.ndarray: The MSE map between the two images.
     """
-    h, w, _ = im1.shape
-    mse_map = np.zeros((h, w))
+    return compute_box_metric_map(im1, im2, 'MSE', patch_size, step)
+
+
+def _squared_error(im1, im2):
+    '''Per-pixel squared error, summed over the channels'''
+    diff = im1.astype(np.float64) - im2.astype(np.float64)
+    return _sum_channels(diff * diff)
+
+
+def _absolute_error(im1, im2):
+    '''Per-pixel absolute error, summed over the channels'''
+    return _sum_channels(np.abs(im1.astype(np.float64) - im2.astype(np.float64)))
 
-    for i in range(0, h - patch_size + 1, step):
-        for j in range(0, w - patch_size + 1, step):
-            patch1 = im1[i:i+patch_size, j:j+patch_size, :]
-            patch2 = im2[i:i+patch_size, j:j+patch_size, :]
-            err = np.sum((patch1.astype("float") - patch2.astype("float")) ** 2)
-            err /= float(patch1.shape[0] * patch1.shape[1] * patch1.shape[2])
-            mse_map[i:i+patch_size, j:j+patch_size] = err
 
-    return mse_map
+def _sum_channels(error):
+    return error.sum(axis=2) if error.ndim == 3 else error
+
+
+def _psnr(mse):
+    '''PSNR of images in [0, 255], computed as piq does on images normalized to [0, 1]'''
+    return -10 * np.log10(mse / (255.0 ** 2) + 1e-8)
+
+
+# metric name -> (per-pixel error, transform of the mean error over a window)
+box_metrics = {
+    'MSE': (_squared_error, lambda mean: mean),
+    'PSNR': (_squared_error, _psnr),
+    'MAE': (_absolute_error, lambda mean: mean),
+}
+
+
+def window_means(values, patch_size, step):
+    """
+    Compute the mean of the values over every patch using a summed-area table.
+
+    The cost does not depend on the patch size.
+
+    Args:
+        values (numpy.ndarray): 2D array of per-pixel values.
+        patch_size (int): The size of the patches.
+        step (int): The step size between patches; 1 gives a dense output.
+
+    Returns:
+        numpy.ndarray: Mean of each patch, shaped (rows, columns) of the patch grid.
+    """
+    rows, cols = patch_grid_shape(values.shape, patch_size, step)
+    table = cv2.integral(np.ascontiguousarray(values, dtype=np.float64), sdepth=cv2.CV_64F)
+
+    top = np.arange(rows)[:, None] * step
+    left = np.arange(cols)[None, :] * step
+    bottom, right = top + patch_size, left + patch_size
+    sums = table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+    return sums / float(patch_size * patch_size)
+
+
+def compute_box_metric_map(im1, im2, metric_name, patch_size=161, step=50):
+    """
+    Compute a map of a mean-based metric (MSE, PSNR or MAE) over patches of the images.
+
+    The metric of each patch is derived from a summed-area table of the per-pixel error, so
+    the cost is proportional to the number of pixels whatever the patch size and step.
+
+    Args:
+        im1 (numpy.ndarray): The first input image.
+        im2 (numpy.ndarray): The second input image.
+        metric_name (str): 'MSE', 'PSNR' or 'MAE'.
+        patch_size (int, optional): The size of the patches. Default is 161.
+        step (int, optional): The step size between patches. Default is 50.
+
+    Returns:
+        numpy.ndarray: The metric map between the two images.
+    """
+    values = box_metric_values(im1, im2, metric_name, patch_size, step)
+    return scatter_average(values, patch_size, step, im1.shape[:2])
+
+
+def box_metric_values(im1, im2, metric_name, patch_size, step):
+    '''Value of a mean-based metric for each patch, shaped (rows, columns) of the patch grid'''
+    error_fn, transform = box_metrics[metric_name]
+    channels = im1.shape[2] if im1.ndim == 3 else 1
+    return transform(window_means(error_fn(im1, im2), patch_size, step) / channels)
+
+
+def scatter_average(values, patch_size, step, shape, region=None):
+    """
+    Spread patch values back over the image, averaging the values of overlapping patches.
+
+    Args:
+        values (numpy.ndarray): Value of each patch, shaped (rows, columns) of the patch grid.
+            NaN values are ignored.
+        patch_size (int): The size of the patches.
+        step (int): The step size between patches.
+        shape (tuple): (height, width) of the image.
+        region (tuple, optional): (top, bottom, left, right) of the part of the map to
+            compute. Default is the whole map.
+
+    Returns:
+        numpy.ndarray: The map, 0 where no patch has a value.
+    """
+    if region is None:
+        region = (0, shape[0], 0, shape[1])
+    top, bottom, left, right = region
+
+    # Only the patches overlapping the region contribute, so the values may be memory-mapped
+    first_row, last_row = _overlapping_patches(top, bottom, patch_size, step, values.shape[0])
+    first_col, last_col = _overlapping_patches(left, right, patch_size, step, values.shape[1])
+    values = np.asarray(values[first_row:last_row, first_col:last_col], dtype=np.float64)
+
+    valid = ~np.isnan(values)
+    origin = (first_row, first_col)
+    total = _paint_windows(np.where(valid, values, 0.0), origin, patch_size, step, region)
+    count = _paint_windows(valid.astype(np.float64), origin, patch_size, step, region)
+
+    metric_map = np.zeros((bottom - top, right - left))
+    np.divide(total, count, out=metric_map, where=count > 0.5)
+    return metric_map
+
+
+def _paint_windows(values, origin, patch_size, step, region):
+    '''Sum of the values of the patches covering each pixel of the region, using running sums along each axis; values start at the (row, column) origin of the patch grid'''
+    top, bottom, left, right = region
+    first_row, first_col = origin
+    last_row, last_col = first_row + values.shape[0], first_col + values.shape[1]
+
+    starts = np.arange(first_row, last_row) * step - top
+    diff = np.zeros((bottom - top + 1, values.shape[1]))
+    np.add.at(diff, np.clip(starts, 0, bottom - top), values)
+    np.add.at(diff, np.clip(starts + patch_size, 0, bottom - top), -values)
+    row_sums = np.cumsum(diff, axis=0)[:-1]
+
+    starts = np.arange(first_col, last_col) * step - left
+    diff = np.zeros((bottom - top, right - left + 1))
+    np.add.at(diff.T, np.clip(starts, 0, right - left), row_sums.T)
+    np.add.at(diff.T, np.clip(starts + patch_size, 0, right - left), -row_sums.T)
+    return np.cumsum(diff, axis=1)[:, :-1]
+
+
+def _overlapping_patches(start, end, patch_size, step, count):
+    '''Range of the patch indices along one axis whose extent overlaps [start, end)'''
+    first = max(0, (start - patch_size) // step + 1)
+    last = min(count, (end - 1) // step + 1)
+    return first, max(first, last)
+
+
+def patch_grid_shape(shape, patch_size, step):
+    """
+    Args:
+        shape (tuple): (height, width) of the image.
+        patch_size (int): The size of the patches.
+        step (int): The step size between patches.
+
+    Returns:
+        tuple: Number of patch rows and columns that fit in the image.
+    """
+    h, w = shape[:2]
+    return max(0, (h - patch_size) // step + 1), max(0, (w - patch_size) // step + 1)
 
 
 def compute_patchwise_metric(im1, im2, patch_size, step, metric_fn):
@@ -75,35 +226,232 @@ def compute_patchwise_metric(im1, im2, patch_size, step, metric_fn):
     Returns:
         numpy.ndarray: The quality metric map between the two images (or for the single image in case of no-reference metrics).
     """
-    h, w, _ = im1.shape
-    metric_map = np.zeros((h, w))
-
-    for i in range(0, h - patch_size + 1, step):
-        for j in range(0, w - patch_size + 1, step):
-            patch1 = im1[i:i+patch_size, j:j+patch_size, :]
-
-            if im2 is not None:
-                patch2 = im2[i:i+patch_size, j:j+patch_size, :]
-                try:
-                    metric_value = metric_fn(patch1, patch2)
-                    metric_map[i:i+patch_size, j:j+patch_size] = metric_value
-                except Exception as e:
-                    print(f"Error computing metric on patch ({i}, {j}): {e}")
-            else:
-                try:
-                    metric_value = metric_fn(patch1)
-                    metric_map[i:i+patch_size, j:j+patch_size] = metric_value
-                except Exception as e:
-                    print(f"Error computing no-reference metric on patch ({i}, {j}): {e}")
+    values = patchwise_values(im1, im2, patch_size, step, metric_fn)
+    return scatter_average(values, patch_size, step, im1.shape[:2])
+
+
+def patchwise_values(im1, im2, patch_size, step, metric_fn):
+    '''Value of the metric function for each patch, shaped (rows, columns) of the patch grid'''
+    rows, cols = patch_grid_shape(im1.shape, patch_size, step)
+    values = np.full((rows, cols), np.nan)
+
+    for r in range(rows):
+        for c in range(cols):
+            i, j = r * step, c * step
+            values[r, c] = _compute_patch(im1, im2, i, j, patch_size, metric_fn)
+
+    return values
+
+
+def _compute_patch(im1, im2, i, j, patch_size, metric_fn):
+    '''Evaluate the metric on the patch at (i, j), nan if it fails'''
+    patch1 = im1[i:i+patch_size, j:j+patch_size]
+
+    if im2 is not None:
+        patch2 = im2[i:i+patch_size, j:j+patch_size]
+        try:
+            return metric_fn(patch1, patch2)
+        except Exception as e:
+            print(f"Error computing metric on patch ({i}, {j}): {e}")
+    else:
+        try:
+            return metric_fn(patch1)
+        except Exception as e:
+            print(f"Error computing no-reference metric on patch ({i}, {j}): {e}")
+    return np.nan
+
+
+def compute_batched_patchwise_metric(im1, im2, patch_size, step, metric_name, batch_size=64):
+    """
+    Compute a quality metric map by evaluating the metric on mini-batches of patches.
+
+    All the patches are extracted as one view of the image tensor and evaluated batch_size at
+    a time in a single forward pass. If a batch fails, its patches are evaluated one by one.
+
+    Args:
+        im1 (numpy.ndarray): The first input image.
+        im2 (numpy.ndarray): The second input image (can be None for no-reference metrics).
+        patch_size (int): The size of the patches to compute the metric on.
+        step (int): The step size between patches.
+        metric_name (str): Name of the metric, must be in batched_metrics.
+        batch_size (int, optional): Number of patches evaluated per forward pass. Default is 64.
+
+    Returns:
+        numpy.ndarray: The quality metric map between the two images (or for the single image in case of no-reference metrics).
+    """
+    values = batched_patchwise_values(im1, im2, patch_size, step, metric_name, batch_size)
+    return scatter_average(values, patch_size, step, im1.shape[:2])
+
+
+def batched_patchwise_values(im1, im2, patch_size, step, metric_name, batch_size=64):
+    '''Value of a batched metric for each patch, shaped (rows, columns) of the patch grid'''
+    batched_fn = batched_metrics[metric_name]
+    rows, cols = patch_grid_shape(im1.shape, patch_size, step)
+    values = np.full(rows * cols, np.nan)
+
+    patches1 = extract_patches(preprocess_image(im1), patch_size, step)
+    patches2 = None if im2 is None else extract_patches(preprocess_image(im2), patch_size, step)
+
+    for start in range(0, rows * cols, batch_size):
+        index = torch.arange(start, min(start + batch_size, rows * cols))
+        r, c = index // cols, index % cols
+
+        try:
+            with inference.context(metric_name):
+                if patches2 is None:
+                    batch_values = batched_fn(patches1[r, c])
+                else:
+                    batch_values = batched_fn(patches1[r, c], patches2[r, c])
+            values[start:start + len(index)] = batch_values.detach().flatten().cpu().numpy()
+        except Exception:
+            # Evaluate the patches of the batch one by one, so that only failing patches are lost
+            metric_fn = metrics[metric_name]
+            for k in range(start, start + len(index)):
+                i, j = (k // cols) * step, (k % cols) * step
+                values[k] = _compute_patch(im1, im2, i, j, patch_size, metric_fn)
+
+    return values.reshape(rows, cols)
+
+
+def metric_patch_values(im1, im2, metric_name, patch_size, step, batch_size=64):
+    """
+    Evaluate a metric on every patch of the images, with the fastest available method.
 
+    Args:
+        im1 (numpy.ndarray): The first input image.
+        im2 (numpy.ndarray): The second input image (ignored for no-reference metrics).
+        metric_name (str): Name of the metric.
+        patch_size (int): The size of the patches.
+        step (int): The step size between patches.
+        batch_size (int, optional): Number of patches evaluated per forward pass. Default is 64.
+
+    Returns:
+        numpy.ndarray: Value of each patch, shaped (rows, columns) of the patch grid, nan
+            where the metric failed.
+    """
+    profiling.count('patches', int(np.prod(patch_grid_shape(im1.shape, patch_size, step))))
+    if metric_name in box_metrics:
+        return box_metric_values(im1, im2, metric_name, patch_size, step)
+
+    if metric_name in no_reference_metrics:
+        im2 = None
+    if metric_name in batched_metrics:
+        return batched_patchwise_values(im1, im2, patch_size, step, metric_name, batch_size)
+    return patchwise_values(im1, im2, patch_size, step, metrics[metric_name])
+
+
+def extract_patches(image_tensor, patch_size, step):
+    """
+    Extract all the patches of an image as a view, without copying the image.
+
+    Args:
+        image_tensor (torch.Tensor): Image shaped (1, C, H, W).
+        patch_size (int): The size of the patches.
+        step (int): The step size between patches.
+
+    Returns:
+        torch.Tensor: View shaped (rows, columns, C, patch_size, patch_size).
+    """
+    patches = image_tensor[0].unfold(1, patch_size, step).unfold(2, patch_size, step)
+    return patches.permute(1, 2, 0, 3, 4)
+
+
+
+def convert_map_color_space(image, color_space):
+    """
+    Convert a BGR image to the color space used for metric maps.
+
+    Args:
+        image (numpy.ndarray): The BGR image.
+        color_space (str): Name of the color space. The image is kept in BGR order for 'RGB'.
+
+    Returns:
+        numpy.ndarray: The converted image.
+    """
+    if color_space == "RGB":
+        return image
+    with profiling.stage('cvtColor'):
+        return cv2.cvtColor(image, getattr(cv2, f"COLOR_BGR2{color_space}"))
+
+
+def _metric_map(dist, ref, metric_name, color_space, patch_size, step, batch_size):
+    '''Map of a metric in its native precision, read from the result cache if enabled'''
+    # The SSIM map does not depend on the patch and step sizes
+    map_patch_size, map_step = (None, None) if metric_name == "SSIM" else (patch_size, step)
+    key = result_cache.cache_key('map', dist, ref, metric_name, color_space, map_patch_size, map_step)
+    if key is not None:
+        metric_map = result_cache.get_cache().get(key)
+        profiling.count('cache hits' if metric_map is not None else 'cache misses')
+        if metric_map is not None:
+            return metric_map
+
+    img1 = decode_image(dist)
+    img2 = decode_image(ref)
+    img2 = cv2.resize(img2, (img1.shape[1], img1.shape[0]))
+
+    img1_cs = convert_map_color_space(img1, color_space)
+    img2_cs = convert_map_color_space(img2, color_space)
+
+    with profiling.stage('forward'):
+        if metric_name == "SSIM":
+            ssim_value, metric_map = compute_ssim_map(img1_cs, img2_cs)
+        else:
+            # Evaluate the metric on every patch and average overlapping patches
+            values = metric_patch_values(img1_cs, img2_cs, metric_name, patch_size, step, batch_size)
+            metric_map = scatter_average(values, patch_size, step, img1_cs.shape[:2])
+
+    if key is not None:
+        result_cache.get_cache().put(key, metric_map)
     return metric_map
 
 
+def compute_metric_map(dist, ref, metric_name='SSIM', color_space='HSV', patch_size=161, step=50, batch_size=64):
+    """
+    Compute the map of a metric as an array, without rendering it.
 
-def compute_map(dist_path, ref_path, metric_name='SSIM', color_space='HSV', patch_size=161, step=50, colormap='gray'):
+    Args:
+        dist (str, bytes or numpy.ndarray): Path of distorted image, its content, or the BGR image.
+        ref (str, bytes or numpy.ndarray): Path of reference image, its content, or the BGR image.
+        metric_name (str): metric name.
+        color_space (str): name of the color space.
+        patch_size (int, optional): The size of the patches to compute the metrics on. Default is 161.
+        step (int, optional): The step size between patches. Default is 50.
+        batch_size (int, optional): Number of patches evaluated per forward pass. Default is 64.
+
+    Returns:
+        tuple: (float32 map shaped as the distorted image, nan where the metric failed,
+            metadata dictionary with the 'metric', 'color_space', 'patch_size', 'step',
+            and the 'min', 'max' and 'mean' of the map)
+
+    Raises:
+        FileNotFoundError: If an image cannot be read.
+        KeyError: If the metric does not exist.
+    """
+    if metric_name != "SSIM" and metric_name not in metrics:
+        raise KeyError(f"Unknown metric '{metric_name}'")
+
+    metric_map = _metric_map(dist, ref, metric_name, color_space, patch_size, step, batch_size).astype(np.float32)
+
+    finite = metric_map[np.isfinite(metric_map)]
+    metadata = {
+        'metric': metric_name,
+        'color_space': color_space,
+        'patch_size': patch_size,
+        'step': step,
+        'min': float(finite.min()) if finite.size else float("nan"),
+        'max': float(finite.max()) if finite.size else float("nan"),
+        'mean': float(finite.mean()) if finite.size else float("nan"),
+    }
+    return metric_map, metadata
+
+
+def compute_map(dist_path, ref_path, metric_name='SSIM', color_space='HSV', patch_size=161, step=50, colormap='gray', batch_size=64):
     """
     Generate metric maps for the given images, metrics, and color spaces, and save them to files.
 
+    To get the values of the map, use compute_metric_map, and to render it without
+    matplotlib, use map_rendering.render_map.
+
     Args:
         dist_path (str): Path of distorted image.
         ref_path (str): Path of reference image.
@@ -112,45 +460,50 @@ def compute_map(dist_path, ref_path, metric_name='SSIM', color_space='HSV', patc
         patch_size (int, optional): The size of the patches to compute the metrics on. Default is 161.
         step (int, optional): The step size between patches. Default is 50.
         colormap (str, optional) : Name of the colormap to show the difference in matplotlib
+        batch_size (int, optional): Number of patches evaluated per forward pass. Default is 64.
         
     Return:
         plot (matplotlib)
     """
-    img1 = load_image(dist_path)
-    img2 = load_image(ref_path)
-    
-    
-    img2 = cv2.resize(img2, (img1.shape[1], img1.shape[0]))
-    
-    if color_space == "RGB":
-        img1_cs = img1
-        img2_cs = img2
-    else:
-        img1_cs = cv2.cvtColor(img1, getattr(cv2, f"COLOR_BGR2{color_space}"))
-        img2_cs = cv2.cvtColor(img2, getattr(cv2, f"COLOR_BGR2{color_space}"))
+    import matplotlib.pyplot as plt
+
+    for path in (dist_path, ref_path):
+        if isinstance(path, str) and not os.path.isfile(path):
+            print("Unable to read input images.")
+            sys.exit(1)
 
-    metric_fn = metrics['MSE']
-    
     plt.figure()
     try:
-        if metric_name == "SSIM":
-            ssim_value, ssim_map = compute_ssim_map(img1_cs, img2_cs)
-            im = plt.imshow(ssim_map, cmap=colormap)
-            plt.title(f'SSIM ({color_space})')
-        elif metric_name == "MSE":
-            mse_map = compute_mse_map(img1_cs, img2_cs)
-            im = plt.imshow(mse_map, cmap=colormap)
-            plt.title(f'MSE ({color_space})')
-        elif metric_name in ["BRISQUE", "NIQE", "MUSIQ", "NIMA", "CLIPIQA"]:
-            # No-reference metrics, compute on img1 only
-            metric_map = compute_patchwise_metric(img1_cs, None, patch_size, step, metric_fn)
-            im = plt.imshow(metric_map, cmap=colormap)
-            plt.title(f'{metric_name} ({color_space})')
-        else:
-            # Full-reference metrics
-            metric_map = compute_patchwise_metric(img1_cs, img2_cs, patch_size, step, metric_fn)
-            im = plt.imshow(metric_map, cmap=colormap)
-            plt.title(f'{metric_name} ({color_space})')
+        metric_map = _metric_map(dist_path, ref_path, metric_name, color_space, patch_size, step, batch_size)
+        plot_map(metric_map, metric_name, color_space, patch_size, step, colormap)
+        #print(f"Map generation completed for {metric_name} in {color_space} color space.")
+
+    except Exception as e:
+        print(f"Error generating {metric_name} Map for {color_space} color space: {e}")
+            
+    return plt
+
+
+def plot_map(metric_map, metric_name, color_space, patch_size, step, colormap='gray'):
+    """
+    Draw a metric map in the current matplotlib figure.
+
+    Args:
+        metric_map (numpy.ndarray): The map, as returned by compute_metric_map.
+        metric_name (str): metric name.
+        color_space (str): name of the color space.
+        patch_size (int): The size of the patches of the map.
+        step (int): The step size between patches.
+        colormap (str, optional) : Name of the colormap in matplotlib. Default is gray.
+
+    Return:
+        plot (matplotlib)
+    """
+    import matplotlib.pyplot as plt
+
+    with profiling.stage('render'):
+        im = plt.imshow(metric_map, cmap=colormap)
+        plt.title(f'{metric_name} ({color_space})')
 
         plt.axis('off')
         cbar = plt.colorbar(im)
@@ -161,13 +514,8 @@ def compute_map(dist_path, ref_path, metric_name='SSIM', color_space='HSV', patc
                     wrap=True, horizontalalignment='center', fontsize=10)
 
         plt.tight_layout()
-        #print(f"Map generation completed for {metric_name} in {color_space} color space.")
-
-    except Exception as e:
-        print(f"Error generating {metric_name} Map for {color_space} color space: {e}")
-            
     return plt
 
 
 def __dir__():
-    return ["compute_map"]
\ No newline at end of file
+    return ["compute_map", "compute_metric_map"]
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""
+This module renders metric maps to images with OpenCV.
+
+Maps are normalized, colored with a colormap of the color_maps table using cv2.applyColorMap,
+and optionally framed with a title, a colorbar and a caption. Rendering does not use
+matplotlib, so it has no global state, is safe to use from several threads, and is much
+faster than drawing and saving a figure.
+"""
+
+import cv2
+import numpy as np
+
+from .utils import *
+from . import profiling
+
+
+# Color of the pixels where the map is nan
+nan_color = (0, 0, 0)
+
+
+def colormap_code(colormap_name):
+    """
+    Args:
+        colormap_name (str): Name of a colormap of color_maps, case insensitive, or 'GRAY'.
+
+    Returns:
+        int: The OpenCV colormap, None for gray.
+    """
+    name = colormap_name.upper()
+    if name in ('GRAY', 'GREY'):
+        return None
+    if name in color_maps:
+        return color_maps[name]
+    print(f"{colormap_name} colormap does not exist. JET will be used!")
+    return color_maps['JET']
+
+
+def normalize_map(metric_map, value_range=None):
+    """
+    Scale a map to 8 bits.
+
+    Args:
+        metric_map (numpy.ndarray): The map shaped (H, W).
+        value_range (tuple, optional): (min, max) values mapped to 0 and 255; the range of
+            the map if None.
+
+    Returns:
+        tuple: (uint8 map, mask of the nan values, (min, max) value range)
+    """
+    metric_map = np.asarray(metric_map, dtype=np.float64)
+    nan_mask = ~np.isfinite(metric_map)
+
+    if value_range is None:
+        if nan_mask.all():
+            value_range = (0.0, 0.0)
+        else:
+            value_range = (float(np.nanmin(metric_map[~nan_mask])), float(np.nanmax(metric_map[~nan_mask])))
+    vmin, vmax = value_range
+
+    scale = 255.0 / (vmax - vmin) if vmax > vmin else 0.0
+    normalized = np.clip((np.where(nan_mask, vmin, metric_map) - vmin) * scale, 0, 255)
+    return np.round(normalized).astype(np.uint8), nan_mask, (vmin, vmax)
+
+
+def apply_colormap(gray, colormap):
+    '''Color an 8 bits map with an OpenCV colormap, or keep it gray if colormap is None'''
+    if colormap is None:
+        return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+    return cv2.applyColorMap(gray, colormap)
+
+
+def render_map(metric_map, colormap_name='JET', value_range=None, colorbar=True, title=None, caption=None):
+    """
+    Render a metric map to a color image.
+
+    Args:
+        metric_map (numpy.ndarray): The map shaped (H, W).
+        colormap_name (str, optional): Name of a colormap of color_maps, or 'GRAY'. Default is JET.
+        value_range (tuple, optional): (min, max) values of the colormap; the range of the map if None.
+        colorbar (bool, optional): Draw a labelled colorbar to the right of the map. Default is True.
+        title (str, optional): Text drawn above the map.
+        caption (str, optional): Text drawn below the map.
+
+    Returns:
+        numpy.ndarray: The BGR image.
+    """
+    with profiling.stage('render'):
+        gray, nan_mask, (vmin, vmax) = normalize_map(metric_map, value_range)
+        colormap = colormap_code(colormap_name)
+        image = apply_colormap(gray, colormap)
+        image[nan_mask] = nan_color
+
+        if not (colorbar or title or caption):
+            return image
+        return _frame(image, colormap, vmin, vmax, colorbar, title, caption)
+
+
+def _frame(image, colormap, vmin, vmax, colorbar, title, caption):
+    '''Draw the map on a white canvas with a title, a colorbar and a caption'''
+    h, w = image.shape[:2]
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = max(0.4, min(h, w) / 800)
+    thickness = max(1, int(round(font_scale * 1.5)))
+    (_, text_h), baseline = cv2.getTextSize("0", font, font_scale, thickness)
+    line_h = text_h + baseline
+    margin = max(8, line_h // 2)
+
+    labels = []
+    bar_w, labels_w = 0, 0
+    if colorbar:
+        bar_w = max(12, w // 25)
+        labels = [f"{value:.4g}" for value in np.linspace(vmax, vmin, 5)]
+        labels_w = max(cv2.getTextSize(label, font, font_scale, thickness)[0][0] for label in labels)
+
+    top = margin + (line_h + margin if title else 0)
+    bottom = margin + (line_h + margin if caption else 0)
+    right = margin + (bar_w + margin // 2 + labels_w + margin if colorbar else 0)
+    left = margin
+
+    canvas = np.full((top + h + bottom, left + w + right, 3), 255, dtype=np.uint8)
+    canvas[top:top + h, left:left + w] = image
+
+    if colorbar:
+        x0 = left + w + margin
+        gradient = np.linspace(255, 0, h).round().astype(np.uint8).reshape(h, 1)
+        canvas[top:top + h, x0:x0 + bar_w] = apply_colormap(np.repeat(gradient, bar_w, axis=1), colormap)
+        cv2.rectangle(canvas, (x0, top), (x0 + bar_w - 1, top + h - 1), (0, 0, 0), 1)
+
+        for label, y in zip(labels, np.linspace(top, top + h - 1, len(labels))):
+            y = int(round(y))
+            cv2.line(canvas, (x0 + bar_w, y), (x0 + bar_w + margin // 4, y), (0, 0, 0), 1)
+            text_y = min(max(y + text_h // 2, text_h), canvas.shape[0] - baseline)
+            cv2.putText(canvas, label, (x0 + bar_w + margin // 2, text_y), font, font_scale, (0, 0, 0), thickness, cv2.LINE_AA)
+
+    for text, y in ((title, margin + text_h), (caption, top + h + margin + text_h)):
+        if text:
+            text_w = cv2.getTextSize(text, font, font_scale, thickness)[0][0]
+            x = max(0, left + (w - text_w) // 2)
+            cv2.putText(canvas, text, (x, y), font, font_scale, (0, 0, 0), thickness, cv2.LINE_AA)
+
+    return canvas
+
+
+def save_map(metric_map, path, colormap_name='JET', value_range=None, colorbar=True, title=None, caption=None):
+    """
+    Render a metric map and write it to an image file.
+
+    Args:
+        metric_map (numpy.ndarray): The map shaped (H, W).
+        path (str): Path of the image file e.g. 'map.png'.
+        colormap_name, value_range, colorbar, title, caption: As in render_map.
+    """
+    image = render_map(metric_map, colormap_name, value_range, colorbar, title, caption)
+    write_image(image, path)
+
+
+def __dir__():
+    return ["render_map", "save_map"]
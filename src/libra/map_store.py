@@ -0,0 +1,344 @@
+"""
+This module stores the maps and differences of a run in a single container file.
+
+Instead of one rendered PNG per metric, color space and difference, the float32 maps and the
+uint8 thresholded differences are written, unrendered and lossless, to one HDF5 (.h5),
+Zarr (.zarr) or NPZ (.npz) file. HDF5 and Zarr arrays are chunked and compressed, and are
+read back chunk by chunk, so a region of a map is read without decompressing the whole map.
+NPZ files are compressed zip archives of .npy files, read one whole array at a time.
+
+Arrays are compressed and written by a background thread, so that writing overlaps the
+computation of the next maps. HDF5 files and zip archives take one writer at a time, hence
+a single writer thread; the queue between the two is bounded so that maps waiting to be
+written do not accumulate in memory.
+
+Example:
+    from libra.map_store import MapWriter, open_maps
+
+    with MapWriter("run.h5") as writer:
+        metric_map, metadata = libra.compute_metric_map("compressed.png", "orig.png", "SSIM", "HSV")
+        writer.write("maps/HSV/SSIM", metric_map, metadata)
+
+    with open_maps("run.h5") as maps:
+        region = maps["maps/HSV/SSIM"][100:200, 300:400]
+
+h5py and zarr are optional dependencies, only needed for their format.
+"""
+
+import os
+import json
+import queue
+import zipfile
+import threading
+
+import numpy as np
+
+from .utils import *
+from . import profiling
+
+h5py = lazy_import('h5py')
+zarr = lazy_import('zarr')
+
+
+# File extension -> container format
+formats = {
+    '.h5': 'hdf5',
+    '.hdf5': 'hdf5',
+    '.zarr': 'zarr',
+    '.npz': 'npz',
+}
+
+# Entry of the NPZ archives holding the attributes of the arrays
+npz_attributes_name = "__attributes__.json"
+
+default_chunk_size = 256
+default_compression_level = 4
+
+
+def container_format(path, format=None):
+    """
+    Args:
+        path (str): Path of the container.
+        format (str, optional): 'hdf5', 'zarr' or 'npz'; taken from the extension of path if None.
+
+    Returns:
+        str: The format of the container.
+
+    Raises:
+        ValueError: If the format is unknown.
+    """
+    if format is None:
+        format = formats.get(os.path.splitext(os.fspath(path).rstrip("/\\"))[1].lower())
+    if format not in formats.values():
+        raise ValueError(f"Unknown map container format for '{path}', use one of {sorted(formats)}")
+    return format
+
+
+def chunk_shape(shape, chunk_size=default_chunk_size):
+    """
+    Args:
+        shape (tuple): Shape of an array, (H, W) or (H, W, C).
+        chunk_size (int, optional): Height and width of the chunks.
+
+    Returns:
+        tuple: Shape of the chunks: square tiles of every channel.
+    """
+    return tuple(min(chunk_size, size) if axis < 2 else size for axis, size in enumerate(shape))
+
+
+def _json_attributes(attributes):
+    '''Attributes as JSON-compatible values, e.g. numpy scalars as Python numbers'''
+    return json.loads(json.dumps(attributes or {}, default=lambda value: value.item()))
+
+
+class _HDF5Container:
+    def __init__(self, path, chunk_size, compression_level):
+        self.file = h5py.File(path, 'w')
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+
+    def write(self, name, array, attributes):
+        dataset = self.file.create_dataset(name, data=array, chunks=chunk_shape(array.shape, self.chunk_size),
+                                           compression='gzip', compression_opts=self.compression_level, shuffle=True)
+        dataset.attrs.update(attributes)
+
+    def close(self):
+        self.file.close()
+
+
+class _ZarrContainer:
+    def __init__(self, path, chunk_size, compression_level):
+        self.group = zarr.open_group(path, mode='w')
+        self.chunk_size = chunk_size
+
+    def write(self, name, array, attributes):
+        # Zarr compresses the chunks with its default compressor
+        chunks = chunk_shape(array.shape, self.chunk_size)
+        if hasattr(self.group, 'create_array'):
+            # Zarr 3, where create_dataset is deprecated
+            stored = self.group.create_array(name, shape=array.shape, dtype=array.dtype, chunks=chunks)
+            stored[...] = array
+        else:
+            stored = self.group.create_dataset(name, data=array, chunks=chunks)
+        stored.attrs.update(attributes)
+
+    def close(self):
+        pass
+
+
+class _NPZContainer:
+    def __init__(self, path, chunk_size, compression_level):
+        self.archive = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=compression_level)
+        self.attributes = {}
+
+    def write(self, name, array, attributes):
+        with self.archive.open(f"{name}.npy", 'w', force_zip64=True) as entry:
+            np.lib.format.write_array(entry, np.ascontiguousarray(array), allow_pickle=False)
+        self.attributes[name] = attributes
+
+    def close(self):
+        self.archive.writestr(npz_attributes_name, json.dumps(self.attributes))
+        self.archive.close()
+
+
+_containers = {
+    'hdf5': _HDF5Container,
+    'zarr': _ZarrContainer,
+    'npz': _NPZContainer,
+}
+
+
+class MapWriter:
+    """
+    Writer of maps and differences to one container, in a background thread.
+
+    Arrays are named by paths such as 'maps/HSV/SSIM'; a name is written once per container.
+    Errors of the writer thread are raised by the next call to write or close.
+    """
+
+    def __init__(self, path, format=None, chunk_size=default_chunk_size,
+                 compression_level=default_compression_level, queue_size=4):
+        """
+        Args:
+            path (str): Path of the container, overwritten if it exists.
+            format (str, optional): 'hdf5', 'zarr' or 'npz'; taken from the extension of path if None.
+            chunk_size (int, optional): Height and width of the chunks of HDF5 and Zarr arrays.
+                Default is 256.
+            compression_level (int, optional): gzip level of HDF5 arrays and deflate level of
+                NPZ arrays. Default is 4.
+            queue_size (int, optional): Number of arrays waiting to be written before write
+                blocks. Default is 4.
+        """
+        self.path = os.fspath(path)
+        self.format = container_format(path, format)
+        self._container = _containers[self.format](self.path, chunk_size, compression_level)
+        self._queue = queue.Queue(maxsize=max(1, queue_size))
+        self._error = None
+        self._names = set()
+        self._thread = threading.Thread(target=self._run, name="libra-map-writer", daemon=True)
+        self._thread.start()
+
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            name, array, attributes = item
+            try:
+                with profiling.stage('map_write'):
+                    self._container.write(name, array, attributes)
+            except Exception as e:
+                self._error = e
+
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+    def write(self, name, array, attributes=None):
+        """
+        Queue an array to be written.
+
+        Args:
+            name (str): Name of the array, e.g. 'maps/HSV/SSIM'.
+            array (numpy.ndarray): The array; it must not be modified after the call.
+            attributes (dict, optional): JSON-compatible values saved with the array, e.g. the
+                metadata of compute_metric_map.
+
+        Raises:
+            ValueError: If the name was already written, or the writer is closed.
+        """
+        self._raise_error()
+        if self._thread is None:
+            raise ValueError("The map writer is closed")
+        if name in self._names:
+            raise ValueError(f"'{name}' was already written to {self.path}")
+        self._names.add(name)
+        self._queue.put((name, np.asarray(array), _json_attributes(attributes)))
+
+
+    def close(self):
+        """
+        Write the queued arrays and close the container.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._container.close()
+        self._raise_error()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MapReader:
+    """
+    Reader of the arrays of a container written by MapWriter.
+
+    Arrays of HDF5 and Zarr containers are returned as datasets read on slicing, e.g.
+    reader['maps/HSV/SSIM'][:100, :100] only decompresses the chunks of this region;
+    arrays of NPZ containers are read whole.
+    """
+
+    def __init__(self, path, format=None):
+        """
+        Args:
+            path (str): Path of the container.
+            format (str, optional): 'hdf5', 'zarr' or 'npz'; taken from the extension of path if None.
+        """
+        self.path = os.fspath(path)
+        self.format = container_format(path, format)
+        if self.format == 'hdf5':
+            self._root = h5py.File(self.path, 'r')
+        elif self.format == 'zarr':
+            self._root = zarr.open_group(self.path, mode='r')
+        else:
+            self._root = np.load(self.path, allow_pickle=False)
+            self._attributes = json.loads(self._root.zip.read(npz_attributes_name))
+
+
+    def keys(self):
+        """
+        Returns:
+            list of str: Names of the arrays, e.g. 'maps/HSV/SSIM'.
+        """
+        if self.format == 'npz':
+            return list(self._attributes)
+
+        names = []
+        def visit(group, prefix):
+            # Zarr 3 groups have no items()
+            for key in group.keys():
+                item = group[key]
+                if hasattr(item, 'shape'):
+                    names.append(prefix + key)
+                else:
+                    visit(item, prefix + key + "/")
+        visit(self._root, "")
+        return names
+
+
+    def __getitem__(self, name):
+        if self.format == 'npz':
+            if name not in self._attributes:
+                raise KeyError(name)
+            with profiling.stage('map_read'):
+                return self._root[name]
+        return self._root[name]
+
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+
+    def attributes(self, name):
+        """
+        Args:
+            name (str): Name of an array.
+
+        Returns:
+            dict: The attributes written with the array.
+        """
+        if self.format == 'npz':
+            return dict(self._attributes[name])
+        return {key: value.item() if isinstance(value, np.generic) else value
+                for key, value in self._root[name].attrs.items()}
+
+
+    def close(self):
+        if self.format != 'zarr':
+            self._root.close()
+
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_maps(path, format=None):
+    """
+    Args:
+        path (str): Path of a container written by MapWriter.
+        format (str, optional): 'hdf5', 'zarr' or 'npz'; taken from the extension of path if None.
+
+    Returns:
+        MapReader: Reader of the arrays of the container.
+    """
+    return MapReader(path, format)
+
+
+def __dir__():
+    return ["MapWriter", "MapReader", "open_maps", "container_format"]
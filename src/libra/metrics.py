@@ -1,20 +1,50 @@
 import cv2
 import numpy as np
-import torch
-import piq
-import pyiqa
-import torchvision.transforms as transforms
-from PIL import Image
-from piq import CLIPIQA
 
 from .utils import *
+from . import profiling
+from . import inference
+from .model_registry import get_model, register_model
+from .phash_index import image_hash, hamming_distance
 
+# Heavy dependencies are imported when a metric needing them is first used
+torch = lazy_import('torch')
+piq = lazy_import('piq')
+pyiqa = lazy_import('pyiqa')
 
-def preprocess_image(image):
-    '''Normalize the image to the range [0, 1] and convert to a PyTorch tensor'''
-    image = image.astype(np.float32) / 255.0
-    image_tensor = torch.tensor(image).permute(2, 0, 1).unsqueeze(0).float()
-    return image_tensor
+
+def preprocess_image(image, out=None):
+    """
+    Normalize the image to the range [0, 1] and convert to a PyTorch tensor.
+
+    The image is read through a view and converted once, into a single float32 buffer that
+    is normalized in place. The tensor is a (1, C, H, W) view of this (H, W, C) buffer, so it
+    keeps the channels-last layout of the image.
+
+    Args:
+        image (numpy.ndarray or torch.Tensor): (H, W, C) image, returned as is if already a tensor.
+        out (torch.Tensor, optional): Tensor returned by a previous call, no longer used, whose
+            buffer is reused if it has the same shape.
+
+    Returns:
+        torch.Tensor: The normalized image, shaped (1, C, H, W).
+    """
+    if isinstance(image, torch.Tensor):
+        # already preprocessed
+        return image
+    with profiling.stage('preprocess'):
+        source = torch.from_numpy(np.ascontiguousarray(image))
+        buffer = None
+        if out is not None and out.dtype == torch.float32 and out.device.type == 'cpu' and out.dim() == 4:
+            buffer = out[0].permute(1, 2, 0)
+            if buffer.shape != source.shape or not buffer.is_contiguous():
+                buffer = None
+        if buffer is None:
+            buffer = torch.empty(source.shape, dtype=torch.float32)
+        buffer.copy_(source)
+        buffer.div_(255.0)
+        image_tensor = buffer.permute(2, 0, 1).unsqueeze(0)
+    return inference.prepare_input(image_tensor)
 
 ############## FULL REFERENCE METRICS ##########################
 
@@ -27,6 +57,12 @@ def compute_mse(im1, im2):
     err /= float(hsv_img1.shape[0] * hsv_img1.shape[1])
     return err
 
+def compute_mae(im1, im2):
+    '''Compute the mean absolute error'''
+    err = np.abs(im1.astype("float") - im2.astype("float"))
+    return err.mean()
+
+@inference.run('SSIM')
 def compute_ssim(im1, im2):
     '''Compute SSIM'''
     img1_torch = preprocess_image(im1)
@@ -34,6 +70,7 @@ def compute_ssim(im1, im2):
     index = piq.ssim(img1_torch, img2_torch)
     return index.item()
 
+@inference.run('FSIM')
 def compute_fsim(im1, im2):
     '''Compute FSIM'''
     img1_torch = preprocess_image(im1)
@@ -41,6 +78,7 @@ def compute_fsim(im1, im2):
     index = piq.fsim(img1_torch, img2_torch, data_range=img1_torch.max() - img1_torch.min())
     return index.item()
 
+@inference.run('VIFp')
 def compute_vifp(im1, im2):
     '''Compute VIFp'''
     img1_torch = preprocess_image(im1)
@@ -48,6 +86,7 @@ def compute_vifp(im1, im2):
     index = piq.vif_p(img1_torch, img2_torch)
     return index.item()
 
+@inference.run('IW-SSIM')
 def compute_iw_ssim(im1, im2):
     '''Compute IW_SSIM'''
     img1_torch = preprocess_image(im1)
@@ -55,6 +94,7 @@ def compute_iw_ssim(im1, im2):
     index = piq.information_weighted_ssim(img1_torch, img2_torch)
     return index.item()
 
+@inference.run('MS-SSIM')
 def compute_ms_ssim(im1, im2):
     '''Compute MS-SSIM'''
     img1_torch = preprocess_image(im1)
@@ -62,6 +102,7 @@ def compute_ms_ssim(im1, im2):
     index = piq.multi_scale_ssim(img1_torch, img2_torch)
     return index.item()
 
+@inference.run('PSNR')
 def compute_psnr(im1, im2):
     '''Compute PSNR'''
     img1_torch = preprocess_image(im1)
@@ -69,6 +110,7 @@ def compute_psnr(im1, im2):
     index = piq.psnr(img1_torch, img2_torch)
     return index.item()
 
+@inference.run('HaarPSI')
 def compute_haarpsi(im1, im2):
     '''Compute HaarPSI'''
     img1_torch = preprocess_image(im1)
@@ -76,6 +118,7 @@ def compute_haarpsi(im1, im2):
     index = piq.haarpsi(img1_torch, img2_torch)
     return index.item()
 
+@inference.run('VSI')
 def compute_vsi(im1, im2):
     '''Compute VSI'''
     img1_torch = preprocess_image(im1)
@@ -83,6 +126,7 @@ def compute_vsi(im1, im2):
     index = piq.vsi(img1_torch, img2_torch)
     return index.item()
 
+@inference.run('SR-SIM')
 def compute_srsim(im1, im2):
     '''Compute SR-SIM'''
     img1_torch = preprocess_image(im1)
@@ -90,6 +134,7 @@ def compute_srsim(im1, im2):
     index = piq.srsim(img1_torch, img2_torch)
     return index.item()
 
+@inference.run('GMSD')
 def compute_gmsd(im1, im2):
     '''Compute GMSD'''
     img1_torch = preprocess_image(im1)
@@ -97,6 +142,7 @@ def compute_gmsd(im1, im2):
     index = piq.gmsd(img1_torch, img2_torch)
     return index.item()
 
+@inference.run('MS-GMSD')
 def compute_msgmsd(im1, im2):
     '''Compute MS-GMSD'''
     img1_torch = preprocess_image(im1)
@@ -104,27 +150,31 @@ def compute_msgmsd(im1, im2):
     index = piq.multi_scale_gmsd(img1_torch, img2_torch)
     return index.item()
 
+@inference.run('LPIPS')
 def compute_lpips(im1, im2):
     '''Compute LPIPS'''
     img1_torch = preprocess_image(im1)
     img2_torch = preprocess_image(im2)
-    lpips_index = piq.LPIPS(replace_pooling=True)(img1_torch, img2_torch)
+    lpips_index = get_model('LPIPS')(img1_torch, img2_torch)
     return lpips_index.item()
 
+@inference.run('PieAPP')
 def compute_pieapp(im1, im2):
     '''Compute PieAPP'''
     img1_torch = preprocess_image(im1)
     img2_torch = preprocess_image(im2)
-    pieapp_index = piq.PieAPP()(img1_torch, img2_torch)
+    pieapp_index = get_model('PieAPP')(img1_torch, img2_torch)
     return pieapp_index.item()
 
+@inference.run('DISTS')
 def compute_dists(im1, im2):
     '''Compute DISTS'''
     img1_torch = preprocess_image(im1)
     img2_torch = preprocess_image(im2)
-    dists_index = piq.DISTS()(img1_torch, img2_torch)
+    dists_index = get_model('DISTS')(img1_torch, img2_torch)
     return dists_index.item()
 
+@inference.run('MDSI')
 def compute_mdsi(im1, im2):
     ''' Compute MDSI'''
     img1_torch = preprocess_image(im1)
@@ -132,6 +182,7 @@ def compute_mdsi(im1, im2):
     mdsi_index = piq.mdsi(img1_torch, img2_torch)
     return mdsi_index.item()
 
+@inference.run('DSS')
 def compute_dss(im1, im2):
     '''Compute DSS'''
     img1_torch = preprocess_image(im1)
@@ -141,21 +192,9 @@ def compute_dss(im1, im2):
 
 def compute_phash(img1, img2):
     """Compute the perceptual hash (pHash) of two images and return the Hamming distance."""
-
-    from imagehash import phash
-    from PIL import Image
     try:
-        # Convert NumPy arrays to PIL Images (assuming they are already in RGB format)
-        img1_pil = Image.fromarray(img1)
-        img2_pil = Image.fromarray(img2)
-        
-        # Compute pHash
-        phash1 = phash(img1_pil)
-        phash2 = phash(img2_pil)
-        
-        # Calculate Hamming distance
-        distance = phash1 - phash2
-        return distance
+        # The images are assumed to be already in RGB format
+        return int(hamming_distance(image_hash(img1), image_hash(img2)))
     except Exception as e:
         print(f"Error computing pHash: {e}")
         return None
@@ -164,62 +203,60 @@ def compute_phash(img1, img2):
 
 ##################### NO REFERENCE METRICS ###########################################
 
-# Use cuda enabled device if available
-device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-
 def convert_to_tensor(image):
     """
     Converts an OpenCV image to a PyTorch tensor.
     """
     image = preprocess_image(image)
-    return image.to(device)
+    return image.to(get_device())
 
+@inference.run('BRISQUE')
 def compute_brisque(image):
     """
     Computes the BRISQUE score for the given image.
     """
     image = convert_to_tensor(image)
-    model = pyiqa.create_metric('brisque', device=device).eval()
-    with torch.no_grad():
-        score = model(image)
+    model = get_model('BRISQUE')
+    score = model(image)
     return score.item()
 
+@inference.run('NIQE')
 def compute_niqe(image):
     """
     Computes the NIQE score for the given image.
     """
     image = convert_to_tensor(image)
-    model = pyiqa.create_metric('niqe', device=device).eval()
-    with torch.no_grad():
-        score = model(image)
+    model = get_model('NIQE')
+    score = model(image)
     return score.item()
 
+@inference.run('MUSIQ')
 def compute_musiq(image):
     """
     Computes the MUSIQ score for the given image.
     """
     image = convert_to_tensor(image)
-    model = pyiqa.create_metric('musiq', device=device).eval()
-    with torch.no_grad():
-        score = model(image)
+    model = get_model('MUSIQ')
+    score = model(image)
     return score.item()
 
+@inference.run('NIMA')
 def compute_nima(image):
     """
     Computes the NIMA score for the given image.
     """
     image = convert_to_tensor(image)
-    model = pyiqa.create_metric('nima', device=device).eval()
-    with torch.no_grad():
-        score = model(image)
+    model = get_model('NIMA')
+    score = model(image)
     return score.item()
 
+@inference.run('CLIPIQA')
 def compute_clip_iqa(image):
     """
     Computes the CLIPIQA score for the given image.
     """
     image = convert_to_tensor(image)
-    clip_iqa = CLIPIQA(data_range=1.0)  # Set data_range to 1.0 because image is normalized
+    clip_iqa = get_model('CLIPIQA')
 
     # Compute the CLIPIQA score
     score = clip_iqa(image).item()
@@ -227,8 +264,89 @@ def compute_clip_iqa(image):
 
 
 
+##################### MODELS ###########################################
+
+def _build_pyiqa_model(metric_name):
+    '''Return a factory building the given pyiqa metric'''
+    def factory(device, **params):
+        return pyiqa.create_metric(metric_name, device=device, **params).eval()
+    return factory
+
+
+register_model('LPIPS', lambda device, **params: piq.LPIPS(replace_pooling=True, **params).to(device))
+register_model('PieAPP', lambda device, **params: piq.PieAPP(**params).to(device))
+register_model('DISTS', lambda device, **params: piq.DISTS(**params).to(device))
+register_model('BRISQUE', _build_pyiqa_model('brisque'), get_device)
+register_model('NIQE', _build_pyiqa_model('niqe'), get_device)
+register_model('MUSIQ', _build_pyiqa_model('musiq'), get_device)
+register_model('NIMA', _build_pyiqa_model('nima'), get_device)
+# Set data_range to 1.0 because image is normalized
+register_model('CLIPIQA', lambda device, **params: piq.CLIPIQA(data_range=1.0, **params).to(device))
+
+
+##################### BATCHED METRICS ###########################################
+
+# Each function takes (N, C, H, W) tensors and returns one value per image, so that many
+# patches can be evaluated in a single forward pass
+
+def _batched_fsim(x, y):
+    '''FSIM with the same per-image data range as compute_fsim'''
+    data_range = (x.amax(dim=(1, 2, 3)) - x.amin(dim=(1, 2, 3))).view(-1, 1, 1, 1)
+    return piq.fsim(x / data_range, y / data_range, data_range=1.0, reduction='none')
+
+def _batched_model(metric_name):
+    '''Return a batched function running the model of the given full-reference metric'''
+    def batched_fn(x, y):
+        model = get_model(metric_name, reduction='none')
+        return model(x, y)
+    return batched_fn
+
+def _batched_no_reference_model(metric_name):
+    '''Return a batched function running the model of the given no-reference metric'''
+    def batched_fn(x):
+        model = get_model(metric_name)
+        return model(x.to(get_device())).flatten()
+    return batched_fn
+
+
+batched_metrics = {
+    'SSIM': lambda x, y: piq.ssim(x, y, reduction='none'),
+    'FSIM': _batched_fsim,
+    'MS-SSIM': lambda x, y: piq.multi_scale_ssim(x, y, reduction='none'),
+    'PSNR': lambda x, y: piq.psnr(x, y, reduction='none'),
+    'VSI': lambda x, y: piq.vsi(x, y, reduction='none'),
+    'SR-SIM': lambda x, y: piq.srsim(x, y, reduction='none'),
+    'MS-GMSD': lambda x, y: piq.multi_scale_gmsd(x, y, reduction='none'),
+    'LPIPS': _batched_model('LPIPS'),
+    'PieAPP': _batched_model('PieAPP'),
+    'DISTS': _batched_model('DISTS'),
+    "MDSI": lambda x, y: piq.mdsi(x, y, reduction='none'),
+    "DSS": lambda x, y: piq.dss(x, y, reduction='none'),
+    "IW-SSIM": lambda x, y: piq.information_weighted_ssim(x, y, reduction='none'),
+    "VIFp": lambda x, y: piq.vif_p(x, y, reduction='none'),
+    "GMSD": lambda x, y: piq.gmsd(x, y, reduction='none'),
+    "HaarPSI": lambda x, y: piq.haarpsi(x, y, reduction='none'),
+    "BRISQUE": _batched_no_reference_model('BRISQUE'),
+    "NIQE": _batched_no_reference_model('NIQE'),
+    "MUSIQ": _batched_no_reference_model('MUSIQ'),
+    "NIMA": _batched_no_reference_model('NIMA'),
+    "CLIPIQA": _batched_no_reference_model('CLIPIQA'),
+}
+
+
+# Metrics computed on the distorted image only
+no_reference_metrics = ["BRISQUE", "NIQE", "MUSIQ", "NIMA", "CLIPIQA"]
+
+# Metrics working on the OpenCV images rather than on tensors
+array_metrics = ["MSE", "MAE", "PHASH"]
+
+# Metrics whose value decreases as quality improves; quality increases with the others
+lower_is_better_metrics = ["MSE", "MAE", "MS-GMSD", "LPIPS", "PieAPP", "DISTS", "MDSI", "GMSD", "BRISQUE", "NIQE", "PHASH"]
+
+
 metrics = {
     'MSE': compute_mse,
+    'MAE': compute_mae,
     'SSIM': compute_ssim,
     'FSIM': compute_fsim,
     'MS-SSIM': compute_ms_ssim,
@@ -253,5 +371,12 @@ metrics = {
     "PHASH": compute_phash
 }
 
+def __getattr__(name):
+    # device is resolved on first use so that importing libra does not import torch
+    if name == "device":
+        return get_device()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def __dir__():
     return [""]
\ No newline at end of file
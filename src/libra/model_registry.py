@@ -0,0 +1,253 @@
+"""
+This module provides a process-wide registry for the neural network models used by the
+learned metrics (LPIPS, PieAPP, DISTS, BRISQUE, NIQE, MUSIQ, NIMA and CLIPIQA).
+
+Models are built lazily the first time they are requested and are then reused by every
+later call in the same process. The registry is thread-safe, can be filled up front with
+warmup(), emptied with evict(), and can be capped in memory, in which case the least
+recently used models are dropped first.
+"""
+
+import threading
+from collections import OrderedDict
+
+from . import profiling
+from . import inference
+
+
+# metric name -> (factory, default device)
+model_factories = {}
+
+
+def register_model(metric_name, factory, device='cpu'):
+    """
+    Register the function used to build the model of a metric.
+
+    Args:
+        metric_name (str): Name of the metric, as used in the metrics dictionary.
+        factory (callable): Called as factory(device, **params) and returns the model.
+        device (str or callable, optional): Device the model is built on when none is
+            requested, or a function returning it.
+    """
+    model_factories[metric_name] = (factory, device)
+
+
+def model_size(model):
+    """
+    Estimate the memory used by a model from its parameters and buffers.
+
+    Args:
+        model (object): The model, usually a torch.nn.Module.
+
+    Returns:
+        int: Size in bytes, 0 if it cannot be estimated.
+    """
+    size = 0
+    for name in ('parameters', 'buffers'):
+        tensors = getattr(model, name, None)
+        if tensors is None:
+            continue
+        for tensor in tensors():
+            size += tensor.numel() * tensor.element_size()
+    return size
+
+
+class ModelRegistry:
+    """
+    Thread-safe cache of models keyed by (metric name, device, params).
+    """
+
+    def __init__(self, max_bytes=None):
+        """
+        Args:
+            max_bytes (int, optional): Memory cap for the cached models. None means unbounded.
+        """
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()    # key -> (model, size)
+        self._build_locks = {}          # key -> lock held while the model is built
+        self._lock = threading.RLock()
+
+
+    @staticmethod
+    def make_key(metric_name, device, params):
+        return (metric_name, str(device), tuple(sorted(params.items())))
+
+
+    def get(self, metric_name, device=None, **params):
+        """
+        Return the model of a metric, building it on first use.
+
+        Args:
+            metric_name (str): Name of the metric.
+            device (str, optional): Device of the model; the registered default if None.
+            **params: Extra arguments forwarded to the model factory.
+
+        Returns:
+            object: The model.
+
+        Raises:
+            KeyError: If no factory is registered for the metric.
+        """
+        if metric_name not in model_factories:
+            raise KeyError(f"No model registered for metric '{metric_name}'")
+
+        factory, default_device = model_factories[metric_name]
+        if device is None:
+            device = default_device() if callable(default_device) else default_device
+        key = self.make_key(metric_name, device, params)
+
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        # Build outside of the registry lock so that different models can load in parallel,
+        # while concurrent requests for the same model wait for a single build
+        with build_lock:
+            try:
+                with self._lock:
+                    if key in self._models:
+                        self._models.move_to_end(key)
+                        return self._models[key][0]
+
+                with profiling.stage('model_build'):
+                    model = inference.prepare_model(metric_name, factory(device, **params))
+
+                with self._lock:
+                    self._models[key] = (model, model_size(model))
+                    self._enforce_limit()
+            finally:
+                # Also when the factory raises, so that no lock is left behind
+                with self._lock:
+                    self._build_locks.pop(key, None)
+
+        return model
+
+
+    def evict(self, metric_name=None, device=None):
+        """
+        Drop cached models.
+
+        Args:
+            metric_name (str, optional): Only drop the models of this metric.
+            device (str, optional): Only drop the models on this device.
+
+        Returns:
+            int: Number of models dropped.
+        """
+        with self._lock:
+            keys = [key for key in self._models
+                    if (metric_name is None or key[0] == metric_name)
+                    and (device is None or key[1] == str(device))]
+            for key in keys:
+                del self._models[key]
+        return len(keys)
+
+
+    def size(self):
+        """
+        Returns:
+            int: Memory used by the cached models in bytes.
+        """
+        with self._lock:
+            return sum(size for _, size in self._models.values())
+
+
+    def keys(self):
+        """
+        Returns:
+            list: Keys of the cached models, least recently used first.
+        """
+        with self._lock:
+            return list(self._models.keys())
+
+
+    def set_memory_limit(self, max_bytes):
+        """
+        Cap the memory used by the cached models, dropping the least recently used ones.
+
+        Args:
+            max_bytes (int or None): Memory cap in bytes; None removes the cap.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._enforce_limit()
+
+
+    def _enforce_limit(self):
+        '''Drop the least recently used models until the cache fits in max_bytes'''
+        if self.max_bytes is None:
+            return
+        # Always keep the most recent model, even if it alone exceeds the limit
+        while len(self._models) > 1 and self.size() > self.max_bytes:
+            self._models.popitem(last=False)
+
+
+registry = ModelRegistry()
+
+
+def get_model(metric_name, device=None, **params):
+    """
+    Return the model of a metric from the process-wide registry, building it on first use.
+
+    Args:
+        metric_name (str): Name of the metric e.g. 'LPIPS'.
+        device (str, optional): Device of the model; the registered default if None.
+        **params: Extra arguments forwarded to the model factory.
+
+    Returns:
+        object: The model.
+    """
+    return registry.get(metric_name, device, **params)
+
+
+def warmup(metric_names=None, device=None):
+    """
+    Build the models of the given metrics up front.
+
+    Args:
+        metric_names (list of str, optional): Metrics to load; all metrics with a model if None.
+            Metrics that do not use a model are ignored.
+        device (str, optional): Device of the models; the registered default if None.
+
+    Returns:
+        list: Names of the metrics whose models are loaded.
+    """
+    if metric_names is None:
+        metric_names = list(model_factories.keys())
+
+    loaded = []
+    for metric_name in metric_names:
+        if metric_name in model_factories:
+            registry.get(metric_name, device)
+            loaded.append(metric_name)
+    return loaded
+
+
+def evict(metric_name=None, device=None):
+    """
+    Drop models from the process-wide registry.
+
+    Args:
+        metric_name (str, optional): Only drop the models of this metric; all models if None.
+        device (str, optional): Only drop the models on this device.
+
+    Returns:
+        int: Number of models dropped.
+    """
+    return registry.evict(metric_name, device)
+
+
+def set_memory_limit(max_bytes):
+    """
+    Cap the memory used by the cached models, dropping the least recently used ones.
+
+    Args:
+        max_bytes (int or None): Memory cap in bytes; None removes the cap.
+    """
+    registry.set_memory_limit(max_bytes)
+
+
+def __dir__():
+    return ["get_model", "warmup", "evict", "set_memory_limit", "register_model"]
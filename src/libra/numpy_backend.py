@@ -0,0 +1,241 @@
+"""
+This module computes the classical metrics with NumPy and OpenCV only, without torch.
+
+MSE, PSNR, SSIM, GMSD and PHASH do not need a network, so they can run where torch, piq
+and pyiqa are not installed, e.g. in slim CI containers or on edge nodes, with the import
+time of libra alone. The computations follow the torch ones step by step:
+
+- MSE is computed by the same function in both backends.
+- PSNR, SSIM and GMSD follow piq.psnr, piq.ssim and piq.gmsd, with the Gaussian and
+  Prewitt filters applied by OpenCV. Their values agree with piq to float32 rounding,
+  within numpy_tolerance.
+- PHASH follows imagehash.phash, with the luma conversion and the Lanczos resampling of
+  Pillow reproduced in integer arithmetic, so the hashes are those of imagehash.
+
+The backend is selected per call with backend='numpy', or process-wide with the
+classical_backend inference setting; by default it is used when torch is not installed.
+
+Example:
+    libra.compute_metric("compressed.png", "orig.png", "SSIM", "RGB", backend='numpy')
+"""
+
+import importlib.util
+
+import cv2
+import numpy as np
+
+from .utils import *
+from .inference import classical_backends
+from .metrics import compute_mse
+from .fused_metrics import ssim_kernel_size, ssim_kernel_sigma, ssim_k1, ssim_k2, gms_constant, yiq_luma_weights
+from .phash_index import hash_bits, hamming_distance
+
+
+# Largest absolute difference to the torch backend expected from float32 rounding
+numpy_tolerance = 1e-4
+
+# Constant added to the mean squared error of PSNR, as in piq
+psnr_eps = 1e-8
+
+# Size of the image whose DCT gives the hash, and fixed point precision of Pillow's resampling
+phash_image_size = 32
+resample_precision_bits = 32 - 8 - 2
+
+
+def torch_available():
+    """
+    Returns:
+        bool: Whether torch is installed, found without importing it.
+    """
+    return importlib.util.find_spec('torch') is not None
+
+
+def resolve_backend(backend, metric_name):
+    """
+    Args:
+        backend (str): 'auto', 'torch' or 'numpy', as the classical_backend inference setting.
+        metric_name (str): Name of the metric.
+
+    Returns:
+        str: 'numpy' if the metric is computed with NumPy and OpenCV, else 'torch'.
+
+    Raises:
+        ValueError: If the backend does not exist, or the numpy backend does not compute the metric.
+    """
+    if backend not in classical_backends:
+        raise ValueError(f"Unknown classical backend '{backend}', expected one of {classical_backends}")
+    if backend == 'numpy' and metric_name not in numpy_metrics:
+        raise ValueError(f"The numpy backend computes {list(numpy_metrics)} only, not '{metric_name}'")
+    if backend == 'auto':
+        return 'numpy' if metric_name in numpy_metrics and not torch_available() else 'torch'
+    return backend
+
+
+def _normalized(image):
+    '''Image as float32 in [0, 1], shaped (H, W, C)'''
+    image = image.astype(np.float32) / 255.0
+    return image if image.ndim == 3 else image[:, :, None]
+
+
+def _filter(image, kernel_x, kernel_y):
+    '''Correlation of each channel with a separable kernel, with zero padding'''
+    filtered = cv2.sepFilter2D(image, cv2.CV_32F, kernel_x, kernel_y, borderType=cv2.BORDER_CONSTANT)
+    return filtered.reshape(image.shape)
+
+
+def _average_pool(image, factor):
+    '''Mean of the factor x factor blocks of an (H, W, C) image, dropping incomplete blocks'''
+    height, width = image.shape[0] // factor, image.shape[1] // factor
+    blocks = image[:height * factor, :width * factor].reshape(height, factor, width, factor, -1)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
+
+
+def numpy_psnr(im1, im2):
+    '''Compute PSNR, as piq.psnr'''
+    x, y = _normalized(im1), _normalized(im2)
+    mse = np.mean((x - y) ** 2, dtype=np.float64)
+    return float(10 * np.log10(1.0 / (mse + psnr_eps)))
+
+
+def numpy_ssim(im1, im2):
+    '''Compute SSIM, as piq.ssim'''
+    x, y = _normalized(im1), _normalized(im2)
+
+    # Images are average pooled when they are large enough
+    f = max(1, round(min(x.shape[:2]) / 256))
+    if f > 1:
+        x, y = _average_pool(x, f), _average_pool(y, f)
+    if min(x.shape[:2]) < ssim_kernel_size:
+        raise ValueError(f"Kernel size can't be greater than actual input size. "
+                         f"Input size: {x.shape[:2]}. Kernel size: {ssim_kernel_size}")
+
+    coords = np.arange(ssim_kernel_size, dtype=np.float64) - (ssim_kernel_size - 1) / 2.
+    kernel = np.exp(-coords ** 2 / (2 * ssim_kernel_sigma ** 2))
+    kernel = (kernel / kernel.sum()).astype(np.float32)
+
+    # Valid filtering: the margins of the filtered images depend on the padding
+    margin = ssim_kernel_size // 2
+    valid = (slice(margin, x.shape[0] - margin), slice(margin, x.shape[1] - margin))
+    def filtered(image):
+        return _filter(image, kernel, kernel)[valid]
+
+    c1, c2 = ssim_k1 ** 2, ssim_k2 ** 2
+    mu_x, mu_y = filtered(x), filtered(y)
+    mu_xx, mu_yy, mu_xy = mu_x ** 2, mu_y ** 2, mu_x * mu_y
+    sigma_xx = filtered(x * x) - mu_xx
+    sigma_yy = filtered(y * y) - mu_yy
+    sigma_xy = filtered(x * y) - mu_xy
+
+    cs = (2. * sigma_xy + c2) / (sigma_xx + sigma_yy + c2)
+    ss = (2. * mu_xy + c1) / (mu_xx + mu_yy + c1) * cs
+    return float(ss.mean(axis=(0, 1), dtype=np.float64).mean())
+
+
+def _gmsd_luma(image):
+    '''YIQ luma of an image in [0, 1], padded to even sizes with zeros and halved'''
+    image = _normalized(image)
+    if image.shape[2] == 3:
+        luma = image @ np.array(yiq_luma_weights, dtype=np.float32)
+    else:
+        luma = image[:, :, 0]
+    down_pad = max(luma.shape[0] % 2, luma.shape[1] % 2)
+    luma = np.pad(luma, ((0, down_pad), (0, down_pad)))
+    return _average_pool(luma[:, :, None], 2)[:, :, 0]
+
+
+def numpy_gmsd(im1, im2):
+    '''Compute GMSD, as piq.gmsd'''
+    smooth = np.full(3, 1 / 3, dtype=np.float32)
+    derivative = np.array([-1, 0, 1], dtype=np.float32)
+
+    def gradients(image):
+        luma = _gmsd_luma(image)
+        # Prewitt filters of piq, as separable correlations with zero padding
+        grad_x = _filter(luma, derivative, smooth)
+        grad_y = _filter(luma, smooth, derivative)
+        return np.sqrt(grad_x ** 2 + grad_y ** 2)
+
+    x_grad, y_grad = gradients(im1), gradients(im2)
+    gms = (2.0 * x_grad * y_grad + gms_constant) / (x_grad ** 2 + y_grad ** 2 + gms_constant)
+    return float(np.sqrt(np.mean((gms - gms.mean(dtype=np.float64)) ** 2, dtype=np.float64)))
+
+
+def _lanczos(x):
+    '''Lanczos filter of Pillow, with a support of 3'''
+    return np.where((x >= -3.0) & (x < 3.0), np.sinc(x) * np.sinc(x / 3), 0.0)
+
+
+def _resample_coefficients(in_size, out_size):
+    '''Fixed point coefficients of Pillow's Lanczos resampling of an axis, as an (out_size, in_size) matrix'''
+    scale = in_size / out_size
+    filter_scale = max(scale, 1.0)
+    support = 3.0 * filter_scale
+
+    coefficients = np.zeros((out_size, in_size), dtype=np.int64)
+    for out_index in range(out_size):
+        center = (out_index + 0.5) * scale
+        start = max(int(center - support + 0.5), 0)
+        stop = min(int(center + support + 0.5), in_size)
+        weights = _lanczos((np.arange(start, stop) - center + 0.5) / filter_scale)
+        weights = weights / weights.sum() * (1 << resample_precision_bits)
+        coefficients[out_index, start:stop] = np.trunc(weights + np.where(weights < 0, -0.5, 0.5))
+    return coefficients
+
+
+def _resample(image, coefficients):
+    '''Resample a uint8 image along its first axis with fixed point coefficients, rounding to uint8 as Pillow'''
+    total = coefficients @ image.astype(np.int64) + (1 << (resample_precision_bits - 1))
+    return np.clip(total >> resample_precision_bits, 0, 255).astype(np.uint8)
+
+
+def numpy_image_hash(image):
+    """
+    Perceptual hash of an image, as phash_index.image_hash.
+
+    Args:
+        image (numpy.ndarray): The image, already converted to its color space.
+
+    Returns:
+        numpy.uint64: The 64 bits of the hash.
+    """
+    if image.ndim == 3:
+        # Luma of Pillow's convert('L'), in 16 bits fixed point
+        channels = image[:, :, :3].astype(np.uint32)
+        image = ((channels[:, :, 0] * 19595 + channels[:, :, 1] * 38470 + channels[:, :, 2] * 7471 + 0x8000) >> 16)
+        image = image.astype(np.uint8)
+
+    # Horizontal then vertical pass of Pillow's resize
+    height, width = image.shape
+    if width != phash_image_size:
+        image = _resample(image.T, _resample_coefficients(width, phash_image_size)).T
+    if height != phash_image_size:
+        image = _resample(image, _resample_coefficients(height, phash_image_size))
+
+    # Unnormalized type II DCT of both axes, as scipy.fftpack.dct
+    n = np.arange(phash_image_size)
+    dct = 2 * np.cos(np.pi * n[:, None] * (2 * n[None, :] + 1) / (2 * phash_image_size))
+    coefficients = dct @ image.astype(np.float64) @ dct.T
+
+    hash_size = int(np.sqrt(hash_bits))
+    low_frequencies = coefficients[:hash_size, :hash_size]
+    bits = (low_frequencies > np.median(low_frequencies)).flatten()
+    return np.packbits(bits).view('>u8')[0].astype(np.uint64)
+
+
+def numpy_phash(im1, im2):
+    '''Compute the Hamming distance between the perceptual hashes of two images'''
+    return int(hamming_distance(numpy_image_hash(im1), numpy_image_hash(im2)))
+
+
+# Metrics computed with NumPy and OpenCV, from the images converted to their color space
+numpy_metrics = {
+    'MSE': compute_mse,
+    'PSNR': numpy_psnr,
+    'SSIM': numpy_ssim,
+    'GMSD': numpy_gmsd,
+    'PHASH': numpy_phash,
+}
+
+
+def __dir__():
+    return ["numpy_metrics", "resolve_backend", "torch_available", "numpy_image_hash"]
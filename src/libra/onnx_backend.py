@@ -0,0 +1,216 @@
+"""
+This module runs the networks of the learned metrics with ONNX Runtime instead of torch.
+
+The network of a metric is exported to ONNX the first time it is used, saved in a local
+cache directory, and run by the CPU execution provider of onnxruntime, optionally after
+int8 dynamic quantization of the weights of its matrix multiplications; convolutions are
+kept in float32, as int8 convolutions are slower than float32 ones on CPU. Only the
+networks are exported: the feature extractors of LPIPS, DISTS and PieAPP, whose features
+are then compared in torch as before, and the whole forward pass of MUSIQ, NIMA and CLIPIQA.
+
+The backend is selected with the inference settings, and applied to the models when the
+model registry builds them.
+
+Example:
+    from libra import inference
+
+    inference.configure(backend='onnx', int8=True)
+    libra.compute_metric("compressed.png", "orig.png", "LPIPS", "RGB")
+
+onnxruntime, and onnx and onnxscript to export the networks, are optional dependencies.
+"""
+
+import os
+import json
+import hashlib
+import threading
+
+from .utils import *
+from .result_cache import package_versions
+from . import profiling
+
+torch = lazy_import('torch')
+onnxruntime = lazy_import('onnxruntime')
+quantization = lazy_import('onnxruntime.quantization')
+onnx = lazy_import('onnx')
+
+
+# Metric -> method of its model run by onnxruntime
+exported_methods = {
+    'LPIPS': 'get_features',
+    'DISTS': 'get_features',
+    'PieAPP': 'get_features',
+    'MUSIQ': 'forward',
+    'NIMA': 'forward',
+    'CLIPIQA': 'forward',
+}
+
+# Networks exported with a dynamic height and width; the others are exported for each
+# image size, as their preprocessing depends on it
+dynamic_size_metrics = ['LPIPS', 'DISTS']
+
+default_onnx_dir = os.path.join("~", ".cache", "libra", "onnx")
+
+# Operators whose weights are quantized with int8
+int8_op_types = ['MatMul', 'Gemm']
+
+
+def _flatten(outputs):
+    '''Tensors of the outputs of a method, and their structure to rebuild them'''
+    if isinstance(outputs, torch.Tensor):
+        return [outputs], 'tensor'
+    return list(outputs), type(outputs).__name__
+
+
+class _Exported(torch.nn.Module):
+    '''Module running a torch method of a model, without the outputs that are the input itself'''
+
+    def __init__(self, model, method, input_positions):
+        super().__init__()
+        self.model = model
+        self.method = method
+        self.input_positions = input_positions
+
+    def forward(self, x):
+        outputs, _ = _flatten(self.method(x))
+        return tuple(output for position, output in enumerate(outputs) if position not in self.input_positions)
+
+
+class OnnxMethod:
+    """
+    A method of a model run by onnxruntime, exported to ONNX on first use.
+
+    The method takes one image tensor and returns a tensor, or a list or tuple of tensors,
+    as the torch method it replaces.
+    """
+
+    def __init__(self, metric_name, model, method_name, int8=False, onnx_dir=None):
+        """
+        Args:
+            metric_name (str): Name of the metric e.g. 'LPIPS'.
+            model (torch.nn.Module): The model of the metric.
+            method_name (str): Method of the model to run, 'get_features' or 'forward'.
+            int8 (bool, optional): Quantize the weights of the network to int8. Default is False.
+            onnx_dir (str, optional): Directory of the exported networks; default_onnx_dir if None.
+        """
+        self.metric_name = metric_name
+        self.model = model
+        self.method = getattr(model, method_name)
+        self.method_name = method_name
+        self.int8 = int8
+        self.onnx_dir = os.path.abspath(os.path.expanduser(onnx_dir or default_onnx_dir))
+        self._sessions = {}     # input shape key -> (session, structure, input positions)
+        self._lock = threading.Lock()
+
+
+    def _shape_key(self, x):
+        '''Input shapes sharing a network: the batch size is always dynamic'''
+        if self.metric_name in dynamic_size_metrics:
+            return (x.shape[1],)
+        return tuple(x.shape[1:])
+
+
+    def onnx_path(self, x):
+        """
+        Args:
+            x (torch.Tensor): An input of the method.
+
+        Returns:
+            str: Path of the exported network running this input, keyed by the metric, the
+                model, the input shape, quantization and the versions of the packages.
+        """
+        versions = package_versions()
+        fields = [self.metric_name, type(self.model).__name__, self.method_name, self._shape_key(x),
+                  versions['libra'], versions['piq'], versions['pyiqa'], versions['torch']]
+        key = hashlib.sha256(json.dumps(fields).encode()).hexdigest()[:32]
+        suffix = ".int8.onnx" if self.int8 else ".onnx"
+        return os.path.join(self.onnx_dir, f"{self.metric_name}-{key}{suffix}")
+
+
+    def _export(self, x, path):
+        '''Export the method to path, and return the structure of its outputs'''
+        outputs, structure = _flatten(self.method(x))
+        input_positions = [position for position, output in enumerate(outputs) if output is x]
+
+        float_path = path.replace(".int8.onnx", ".onnx")
+        if not os.path.exists(float_path):
+            dynamic_axes = {0: 'batch'}
+            if self.metric_name in dynamic_size_metrics:
+                dynamic_axes.update({2: 'height', 3: 'width'})
+            # Export with a batch of 2 images, as a batch of 1 would be exported as a constant size
+            example = x[:1].expand(2, *x.shape[1:]).contiguous()
+            # Export to a temporary file first, so that concurrent runs never read a partial network
+            temp_path = f"{float_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            torch.onnx.export(_Exported(self.model, self.method, input_positions).eval(), (example,), temp_path,
+                              input_names=['x'], dynamic_axes={'x': dynamic_axes}, dynamo=True, external_data=False,
+                              verbose=False)
+            os.replace(temp_path, float_path)
+
+        if self.int8 and not os.path.exists(path):
+            # Shapes recorded by the exporter can contradict the shape inference of the quantizer
+            float_model = onnx.load(float_path)
+            del float_model.graph.value_info[:]
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            quantization.quantize_dynamic(float_model, temp_path, op_types_to_quantize=int8_op_types,
+                                          weight_type=quantization.QuantType.QInt8)
+            os.replace(temp_path, path)
+        return structure, input_positions
+
+
+    def _session(self, x):
+        '''Session running the network for the shape of x, exported if needed'''
+        shape_key = self._shape_key(x)
+        with self._lock:
+            if shape_key in self._sessions:
+                return self._sessions[shape_key]
+
+            path = self.onnx_path(x)
+            os.makedirs(self.onnx_dir, exist_ok=True)
+            with profiling.stage('model_build'):
+                # The structure of the outputs is always taken from the torch method
+                structure, input_positions = self._export(x, path)
+
+                # Run with as many threads as torch, e.g. as set by the inference settings
+                options = onnxruntime.SessionOptions()
+                options.intra_op_num_threads = torch.get_num_threads()
+                session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+            self._sessions[shape_key] = (session, structure, input_positions)
+            return self._sessions[shape_key]
+
+
+    def __call__(self, x):
+        session, structure, input_positions = self._session(x)
+        outputs = session.run(None, {'x': x.detach().float().cpu().contiguous().numpy()})
+        outputs = [torch.from_numpy(output).to(x.device) for output in outputs]
+        for position in input_positions:
+            outputs.insert(position, x)
+
+        if structure == 'tensor':
+            return outputs[0]
+        return tuple(outputs) if structure == 'tuple' else outputs
+
+
+def prepare_model(metric_name, model, int8=False, onnx_dir=None):
+    """
+    Run the network of a model with onnxruntime.
+
+    Args:
+        metric_name (str): Name of the metric e.g. 'LPIPS'.
+        model (torch.nn.Module): The model of the metric.
+        int8 (bool, optional): Quantize the weights of the network to int8. Default is False.
+        onnx_dir (str, optional): Directory of the exported networks; default_onnx_dir if None.
+
+    Returns:
+        torch.nn.Module: The model, whose network is run by onnxruntime if the metric is one of
+            exported_methods, else unchanged.
+    """
+    if metric_name not in exported_methods:
+        return model
+    method_name = exported_methods[metric_name]
+    setattr(model, method_name, OnnxMethod(metric_name, model, method_name, int8, onnx_dir))
+    return model
+
+
+def __dir__():
+    return ["exported_methods", "OnnxMethod", "prepare_model"]
@@ -0,0 +1,383 @@
+"""
+This module provides an index of perceptual hashes for near-duplicate search over large
+image collections.
+
+Images are hashed in bulk by a pool of worker processes, with the same pHash as the PHASH
+metric, and the 64 bits of each hash are packed into a uint64. Hamming distances are
+computed on whole arrays of hashes with a popcount lookup table.
+
+Searches use multi-index hashing: the 64 bits are split into disjoint chunks, and two hashes
+within distance k are within distance r of each other on at least one of k // (r + 1) + 1
+chunks. Only the hashes whose chunk is within r of a chunk of the query are compared, so
+finding all the images within distance k of an image, or all the near-duplicate pairs of the
+collection, does not compare every pair of hashes. The chunk radius r (0 or 1) is chosen for
+each search from the expected number of comparisons.
+
+Example:
+    from libra.phash_index import PHashIndex
+
+    index = PHashIndex.from_images(glob.glob("archive/*.png"), workers=8)
+    index.query("frame_0420.png", 4)     # [(name, distance), ...] closest first
+    index.near_duplicates(2)             # (i, j, distance) rows, i < j
+    index.save("archive_phash.npz")
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from .utils import *
+
+imagehash = lazy_import('imagehash')
+Image = lazy_import('PIL.Image')
+
+
+hash_bits = 64
+
+# Number of set bits of each 16 bits value
+_popcount_lut = np.unpackbits(np.arange(1 << 16, dtype=np.uint16).view(np.uint8)).reshape(-1, 16).sum(axis=1, dtype=np.uint8)
+
+
+
+def image_hash(image):
+    """
+    Perceptual hash of an image, as used by the PHASH metric.
+
+    Args:
+        image (numpy.ndarray): The image, already converted to its color space.
+
+    Returns:
+        numpy.uint64: The 64 bits of the hash.
+    """
+    bits = imagehash.phash(Image.fromarray(image)).hash.flatten()
+    return np.packbits(bits).view('>u8')[0].astype(np.uint64)
+
+
+def hamming_distance(hashes1, hashes2):
+    """
+    Hamming distances between packed hashes.
+
+    Args:
+        hashes1 (numpy.uint64 or numpy.ndarray): Hashes.
+        hashes2 (numpy.uint64 or numpy.ndarray): Hashes, broadcast with hashes1.
+
+    Returns:
+        numpy.ndarray: Number of differing bits of each pair of hashes, a scalar for two scalars.
+    """
+    xor = np.bitwise_xor(np.asarray(hashes1, dtype=np.uint64), np.asarray(hashes2, dtype=np.uint64))
+    # The 16 bits words are counted on a flat copy, then shaped back as the broadcast hashes, 0-d for scalars
+    words = np.ascontiguousarray(xor).reshape(-1).view(np.uint16)
+    return _popcount_lut[words].reshape(np.shape(xor) + (4,)).sum(axis=-1, dtype=np.int64)
+
+
+def hash_image_source(source, color_space_name='RGB'):
+    """
+    Args:
+        source (str, bytes or numpy.ndarray): Path to the image, content of an image file,
+            or a BGR image.
+        color_space_name (str, optional): Color space the image is converted to. Default is RGB.
+
+    Returns:
+        numpy.uint64: The perceptual hash of the image.
+    """
+    return image_hash(cv2.cvtColor(decode_image(source), color_spaces[color_space_name]))
+
+
+def _hash_or_error(source, color_space_name):
+    '''Hash of an image, or the error message if it cannot be hashed'''
+    try:
+        return hash_image_source(source, color_space_name), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def hash_images(sources, color_space_name='RGB', workers=None, chunksize=64):
+    """
+    Hash many images with a pool of worker processes.
+
+    Args:
+        sources (list): Images as paths, contents of image files, or BGR images.
+        color_space_name (str, optional): Color space the images are converted to. Default is RGB.
+        workers (int, optional): Number of worker processes; the number of CPUs if None.
+            With 1 worker, images are hashed in the current process.
+        chunksize (int, optional): Number of images sent to a worker at once. Default is 64.
+
+    Returns:
+        tuple: (uint64 array of the hashes, list of (position, error message) of the images
+            that could not be hashed, whose hash is 0)
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    color_space_names = [color_space_name] * len(sources)
+    if workers <= 1:
+        results = map(_hash_or_error, sources, color_space_names)
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        results = executor.map(_hash_or_error, sources, color_space_names, chunksize=chunksize)
+
+    hashes = np.zeros(len(sources), dtype=np.uint64)
+    errors = []
+    try:
+        for position, (value, error) in enumerate(results):
+            if error is None:
+                hashes[position] = value
+            else:
+                errors.append((position, error))
+    finally:
+        if workers > 1:
+            executor.shutdown()
+    return hashes, errors
+
+
+def _chunk_bounds(num_chunks):
+    '''(shift, width) of each of num_chunks disjoint chunks covering the 64 bits, as even as possible'''
+    bounds = np.linspace(0, hash_bits, num_chunks + 1).round().astype(int)
+    return [(int(start), int(end - start)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _pairs_within_groups(sorted_values, block_pairs):
+    '''Yield blocks of position pairs (i, j), i < j, of the equal elements of a sorted array'''
+    starts = np.flatnonzero(np.r_[True, sorted_values[1:] != sorted_values[:-1]])
+    sizes = np.diff(np.r_[starts, len(sorted_values)])
+    starts, sizes = starts[sizes > 1], sizes[sizes > 1]
+    if len(starts) == 0:
+        return
+
+    # Groups are processed in batches of about block_pairs pairs to bound memory
+    pair_counts = sizes * (sizes - 1) // 2
+    batches = (np.cumsum(pair_counts) - pair_counts) // block_pairs
+    for batch in np.unique(batches):
+        batch_starts, batch_sizes = starts[batches == batch], sizes[batches == batch]
+
+        # Each element is paired with the elements after it in its group
+        offsets = np.arange(batch_sizes.sum()) - np.repeat(np.cumsum(batch_sizes) - batch_sizes, batch_sizes)
+        elements = np.repeat(batch_starts, batch_sizes) + offsets
+        counts = np.repeat(batch_sizes, batch_sizes) - 1 - offsets
+        left = np.repeat(elements, counts)
+        steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + 1
+        yield left, left + steps
+
+
+class PHashIndex:
+    """
+    Index of the perceptual hashes of an image collection.
+
+    Identical hashes, e.g. repeated frames, are stored once with the list of their images,
+    and the unique hashes are searched with multi-index hashing.
+    """
+
+    def __init__(self, hashes, names=None, color_space_name='RGB'):
+        """
+        Args:
+            hashes (numpy.ndarray): uint64 hashes of the images.
+            names (list of str, optional): Name of each image, its position if None.
+            color_space_name (str, optional): Color space the images were hashed in. Default is RGB.
+        """
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.names = list(range(len(self.hashes))) if names is None else list(names)
+        self.color_space_name = color_space_name
+
+        # Images of each unique hash
+        self._unique, inverse = np.unique(self.hashes, return_inverse=True)
+        self._member_order = np.argsort(inverse, kind='stable')   # images sorted by unique hash, then position
+        self._member_counts = np.bincount(inverse.ravel(), minlength=len(self._unique))
+        self._members = np.split(self._member_order, np.cumsum(self._member_counts)[:-1])
+        self._chunk_tables = {}   # number of chunks -> sorted chunk values and their unique hash of each chunk
+
+
+    @classmethod
+    def from_images(cls, sources, color_space_name='RGB', workers=None):
+        """
+        Hash images with a pool of workers and index them. Images that cannot be read are
+        reported and left out.
+
+        Args:
+            sources (list): Images as paths, contents of image files, or BGR images.
+            color_space_name (str, optional): Color space the images are converted to. Default is RGB.
+            workers (int, optional): Number of worker processes; the number of CPUs if None.
+
+        Returns:
+            PHashIndex: The index, naming images by their path, or by their position for
+                other sources.
+        """
+        hashes, errors = hash_images(sources, color_space_name, workers)
+        failed = set()
+        for position, error in errors:
+            print(f"Error hashing image {position}: {error}")
+            failed.add(position)
+
+        kept = [position for position in range(len(sources)) if position not in failed]
+        names = [sources[position] if isinstance(sources[position], str) else position for position in kept]
+        return cls(hashes[kept], names, color_space_name)
+
+
+    def save(self, path):
+        """
+        Args:
+            path (str): Path of the .npz file holding the hashes and names.
+        """
+        np.savez(path, hashes=self.hashes, names=np.array([str(name) for name in self.names]),
+                 color_space_name=self.color_space_name)
+
+
+    @classmethod
+    def load(cls, path):
+        """
+        Args:
+            path (str): Path of a .npz file written by save.
+
+        Returns:
+            PHashIndex: The index.
+        """
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['hashes'], data['names'].tolist(), str(data['color_space_name']))
+
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+    def _search_plan(self, max_distance):
+        '''(number of chunks, chunk radius) of the cheapest search, None if comparing all hashes is cheaper'''
+        num_unique = max(len(self._unique), 1)
+        plans = []
+        for radius in (0, 1):
+            num_chunks = max_distance // (radius + 1) + 1
+            width = hash_bits / num_chunks
+            probes = 1 if radius == 0 else 1 + width
+            # Per hash: one pass over the hashes per probe, and the expected number of candidates
+            cost = num_chunks * probes * (1 + num_unique / 2 ** width)
+            plans.append((cost, num_chunks, radius))
+
+        cost, num_chunks, radius = min(plans)
+        return None if cost >= num_unique else (num_chunks, radius)
+
+
+    def _chunk_table(self, num_chunks):
+        '''For each chunk: (shift, width, chunk values of the unique hashes, the values sorted, their sort order)'''
+        if num_chunks not in self._chunk_tables:
+            table = []
+            for shift, width in _chunk_bounds(num_chunks):
+                values = (self._unique >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+                order = np.argsort(values, kind='stable')
+                table.append((shift, width, values, values[order], order))
+            self._chunk_tables[num_chunks] = table
+        return self._chunk_tables[num_chunks]
+
+
+    def _unique_within(self, query_hash, max_distance):
+        '''Indices of the unique hashes within max_distance of a hash, and their distances'''
+        plan = self._search_plan(max_distance)
+        if plan is None:
+            candidates = np.arange(len(self._unique))
+        else:
+            num_chunks, radius = plan
+            candidates = []
+            for shift, width, _, sorted_values, order in self._chunk_table(num_chunks):
+                value = (query_hash >> np.uint64(shift)) & np.uint64((1 << width) - 1)
+                probes = [value] + ([value ^ np.uint64(1 << bit) for bit in range(width)] if radius else [])
+                for probe in probes:
+                    start = np.searchsorted(sorted_values, probe, side='left')
+                    end = np.searchsorted(sorted_values, probe, side='right')
+                    candidates.append(order[start:end])
+            candidates = np.unique(np.concatenate(candidates))
+
+        distances = hamming_distance(self._unique[candidates], query_hash)
+        within = distances <= max_distance
+        return candidates[within], distances[within]
+
+
+    def query(self, image, max_distance):
+        """
+        Find the images within a Hamming distance of an image.
+
+        Args:
+            image (str, bytes, numpy.ndarray or numpy.uint64): The image, as a path, the
+                content of an image file, or a BGR image, or its hash.
+            max_distance (int): Largest Hamming distance, between 0 and 64.
+
+        Returns:
+            list: (name, distance) tuples, closest first.
+        """
+        if isinstance(image, (np.uint64, int)):
+            query_hash = np.uint64(image)
+        else:
+            query_hash = hash_image_source(image, self.color_space_name)
+
+        unique_indices, distances = self._unique_within(query_hash, max_distance)
+        matches = [(self.names[member], int(distance))
+                   for unique_index, distance in zip(unique_indices, distances)
+                   for member in self._members[unique_index]]
+        return sorted(matches, key=lambda match: match[1])
+
+
+    def _candidate_pairs(self, max_distance, block_pairs):
+        '''Yield blocks of pairs of unique hash indices that may be within max_distance; pairs may repeat'''
+        num_unique = len(self._unique)
+        plan = self._search_plan(max_distance)
+        if plan is None:
+            rows = max(1, block_pairs // max(num_unique, 1))
+            for start in range(0, num_unique, rows):
+                left, right = np.nonzero(np.arange(start, min(start + rows, num_unique))[:, None] < np.arange(num_unique))
+                yield left + start, right
+            return
+
+        num_chunks, radius = plan
+        for shift, width, values, sorted_values, order in self._chunk_table(num_chunks):
+            # Pairs with equal chunks, then with chunks equal but for each bit
+            yield from ((order[left], order[right]) for left, right in _pairs_within_groups(sorted_values, block_pairs))
+            for bit in range(width if radius else 0):
+                cleared = values & ~np.uint64(1 << bit)
+                cleared_order = np.argsort(cleared, kind='stable')
+                for left, right in _pairs_within_groups(cleared[cleared_order], block_pairs):
+                    yield cleared_order[left], cleared_order[right]
+
+
+    def near_duplicates(self, max_distance, block_pairs=1 << 22):
+        """
+        Find all the pairs of images within a Hamming distance of each other.
+
+        Args:
+            max_distance (int): Largest Hamming distance, between 0 and 64.
+            block_pairs (int, optional): Number of candidate pairs compared at once, to bound
+                memory. Default is about 4 million.
+
+        Returns:
+            numpy.ndarray: (P, 3) int64 array of (i, j, distance) rows with i < j, the
+                positions of the images in the index, sorted by distance then position.
+        """
+        # Pairs of distinct unique hashes within the distance, found once or more
+        num_unique = len(self._unique)
+        codes = [np.empty(0, dtype=np.int64)]
+        for left, right in self._candidate_pairs(max_distance, block_pairs):
+            within = hamming_distance(self._unique[left], self._unique[right]) <= max_distance
+            left, right = left[within], right[within]
+            codes.append(np.minimum(left, right).astype(np.int64) * num_unique + np.maximum(left, right))
+        codes = np.unique(np.concatenate(codes))
+        left, right = codes // num_unique, codes % num_unique
+        distances = hamming_distance(self._unique[left], self._unique[right])
+
+        # Expand each pair of hashes to every pair of their images
+        starts = np.cumsum(self._member_counts) - self._member_counts
+        left_counts, right_counts = self._member_counts[left], self._member_counts[right]
+        pair_counts = left_counts * right_counts
+        pair = np.repeat(np.arange(len(left)), pair_counts)
+        offsets = np.arange(pair_counts.sum()) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+        i = self._member_order[starts[left][pair] + offsets // right_counts[pair]]
+        j = self._member_order[starts[right][pair] + offsets % right_counts[pair]]
+        blocks = [np.stack([np.minimum(i, j), np.maximum(i, j), distances[pair]], axis=1)]
+
+        # Add the pairs of images sharing a hash
+        sorted_hashes = np.repeat(np.arange(num_unique), self._member_counts)
+        for left, right in _pairs_within_groups(sorted_hashes, block_pairs):
+            blocks.append(np.stack([self._member_order[left], self._member_order[right], np.zeros_like(left)], axis=1))
+
+        rows = np.concatenate(blocks).astype(np.int64)
+        return rows[np.lexsort((rows[:, 1], rows[:, 0], rows[:, 2]))]
+
+
+def __dir__():
+    return ["image_hash", "hamming_distance", "hash_images", "PHashIndex"]
@@ -0,0 +1,245 @@
+"""
+This module provides opt-in timers and counters for the stages of the pipeline: reading
+images, color space conversion, preprocessing, model construction, metric evaluation,
+map rendering and saving.
+
+Profiling is disabled by default and then costs a single flag check per stage. Once enabled,
+every stage records its start and duration, and the run can be reported as a table, as
+per-stage totals (e.g. for extra CSV columns), or as a Chrome trace that can be opened in
+chrome://tracing or https://ui.perfetto.dev.
+
+Example:
+    from libra import profiling
+
+    profiling.enable()
+    libra.compute_metric("compressed.png", "orig.png", "SSIM", "LAB")
+    print(profiling.report())
+    profiling.write_chrome_trace("trace.json")
+"""
+
+import os
+import json
+import time
+import threading
+
+
+# Stages recorded by libra, in pipeline order, as shown in reports
+stages = ['imread', 'cvtColor', 'preprocess', 'model_build', 'forward', 'diff', 'render', 'savefig', 'imwrite']
+
+# Events beyond this number are only counted in the totals, not kept for the trace
+max_events = 1000000
+
+_enabled = False
+_lock = threading.Lock()
+_local = threading.local()
+_events = []        # (name, start, duration, thread id)
+_totals = {}        # name -> [calls, total time, self time, max time]
+_counters = {}      # name -> count
+_origin = time.perf_counter()
+
+
+class _Stage:
+    '''Context manager timing one stage'''
+
+    __slots__ = ('name', 'start', 'child_time')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(self)
+        self.child_time = 0.0
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter() - self.start
+        stack = _local.stack
+        stack.pop()
+        if stack:
+            stack[-1].child_time += duration
+
+        with _lock:
+            total = _totals.setdefault(self.name, [0, 0.0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += duration
+            total[2] += duration - self.child_time
+            total[3] = max(total[3], duration)
+            if len(_events) < max_events:
+                _events.append((self.name, self.start, duration, threading.get_ident()))
+        return False
+
+
+class _NullStage:
+    '''Context manager doing nothing, used while profiling is disabled'''
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def stage(name):
+    """
+    Time a stage of the pipeline.
+
+    Stages can be nested; the self time of a stage excludes the stages nested in it.
+
+    Args:
+        name (str): Name of the stage e.g. 'cvtColor'.
+
+    Returns:
+        context manager: Records the stage on exit if profiling is enabled.
+
+    Example:
+        with profiling.stage('imread'):
+            image = cv2.imread(path)
+    """
+    return _Stage(name) if _enabled else _null_stage
+
+
+def count(name, n=1):
+    """
+    Increment a counter if profiling is enabled.
+
+    Args:
+        name (str): Name of the counter e.g. 'patches'.
+        n (int, optional): Increment. Default is 1.
+    """
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def enable(reset_records=True):
+    """
+    Start profiling.
+
+    Args:
+        reset_records (bool, optional): Drop the records of previous runs. Default is True.
+    """
+    global _enabled
+    if reset_records:
+        reset()
+    _enabled = True
+
+
+def disable():
+    '''Stop profiling, keeping the records'''
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    '''Drop all records'''
+    global _origin
+    with _lock:
+        _events.clear()
+        _totals.clear()
+        _counters.clear()
+        _origin = time.perf_counter()
+
+
+def totals(self_time=True):
+    """
+    Args:
+        self_time (bool, optional): Exclude the time of nested stages. Default is True.
+
+    Returns:
+        dict: Stage name -> time in seconds spent in the stage so far.
+    """
+    with _lock:
+        return {name: total[2] if self_time else total[1] for name, total in _totals.items()}
+
+
+def counters():
+    """
+    Returns:
+        dict: Counter name -> count, including the number of calls of each stage.
+    """
+    with _lock:
+        result = {f"{name} calls": total[0] for name, total in _totals.items()}
+        result.update(_counters)
+        return result
+
+
+def summary():
+    """
+    Returns:
+        list: One dictionary per stage with its 'Stage' name, number of 'Calls', 'Total (s)'
+            and 'Self (s)' times, 'Mean (ms)' and 'Max (ms)' durations, stages of the
+            pipeline first.
+    """
+    with _lock:
+        names = [name for name in stages if name in _totals]
+        names += sorted(name for name in _totals if name not in stages)
+        return [{
+            'Stage': name,
+            'Calls': _totals[name][0],
+            'Total (s)': _totals[name][1],
+            'Self (s)': _totals[name][2],
+            'Mean (ms)': 1000 * _totals[name][1] / _totals[name][0],
+            'Max (ms)': 1000 * _totals[name][3],
+        } for name in names]
+
+
+def report():
+    """
+    Returns:
+        str: Table of the time spent in each stage, and of the counters.
+    """
+    rows = summary()
+    lines = [f"{'Stage':<16} {'Calls':>8} {'Total (s)':>10} {'Self (s)':>10} {'Mean (ms)':>10} {'Max (ms)':>10}"]
+    for row in rows:
+        lines.append(f"{row['Stage']:<16} {row['Calls']:>8} {row['Total (s)']:>10.3f} {row['Self (s)']:>10.3f} "
+                     f"{row['Mean (ms)']:>10.2f} {row['Max (ms)']:>10.2f}")
+
+    with _lock:
+        counter_items = sorted(_counters.items())
+    for name, value in counter_items:
+        lines.append(f"{name:<16} {value:>8}")
+    return "\n".join(lines)
+
+
+def write_chrome_trace(path):
+    """
+    Write the recorded stages in the Chrome trace event format.
+
+    Args:
+        path (str): Path of the JSON file.
+    """
+    pid = os.getpid()
+    with _lock:
+        events = [{
+            'name': name,
+            'cat': 'libra',
+            'ph': 'X',
+            'ts': (start - _origin) * 1e6,
+            'dur': duration * 1e6,
+            'pid': pid,
+            'tid': tid,
+        } for name, start, duration, tid in _events]
+        end = (time.perf_counter() - _origin) * 1e6
+        events += [{'name': name, 'ph': 'C', 'ts': end, 'pid': pid, 'args': {name: value}}
+                   for name, value in _counters.items()]
+
+    with open(path, 'w') as file:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, file)
+
+
+def __dir__():
+    return ["stage", "count", "enable", "disable", "is_enabled", "reset", "totals", "counters",
+            "summary", "report", "write_chrome_trace"]
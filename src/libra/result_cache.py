@@ -0,0 +1,327 @@
+"""
+This module provides an opt-in persistent cache of metric values and metric maps.
+
+Results are stored in a SQLite database, keyed by the content hashes of both images, the
+metric, the color space, the map window and step, a hash of the sources of libra, the
+versions of the packages computing the metrics, and the inference settings changing the
+values of the metric. Rerunning a configuration over mostly unchanged images then only
+computes the new or changed combinations, and changing the code of libra invalidates its
+results. The least recently used results are evicted when the database grows beyond its
+size limit.
+
+Example:
+    import libra
+
+    libra.enable_cache("~/.cache/libra/results.sqlite", max_bytes=1024**3)
+    libra.compute_metric("compressed.png", "orig.png", "SSIM", "LAB")   # computed
+    libra.compute_metric("compressed.png", "orig.png", "SSIM", "LAB")   # read from the cache
+"""
+
+import io
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from importlib import metadata
+
+import cv2
+import numpy as np
+
+from . import inference
+
+
+# Bumped when the way results are computed changes, to invalidate older entries
+cache_format_version = 2
+
+default_cache_path = os.path.join("~", ".cache", "libra", "results.sqlite")
+default_cache_max_bytes = 1024 * 1024 * 1024
+
+# Packages whose version is part of every key
+versioned_packages = ["piq", "pyiqa", "torch", "scikit-image", "ImageHash"]
+
+
+_source_hash = None
+
+def source_hash():
+    """
+    Hash the Python sources of libra, which change with its code even when its version
+    does not, or when it is run from a source checkout without being installed.
+
+    Returns:
+        str: Hex digest of the sources, computed once per process.
+    """
+    global _source_hash
+    if _source_hash is None:
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        digest = hashlib.blake2b(digest_size=20)
+        for name in sorted(os.listdir(package_dir)):
+            if name.endswith('.py'):
+                digest.update(name.encode())
+                with open(os.path.join(package_dir, name), 'rb') as file:
+                    digest.update(file.read())
+        _source_hash = digest.hexdigest()
+    return _source_hash
+
+
+def package_versions():
+    """
+    Returns:
+        dict: Package name -> installed version, None if not installed, and 'libra' -> the
+            hash of its sources.
+    """
+    versions = {'libra': source_hash()}
+    for package in versioned_packages:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    # OpenCV is distributed under several package names
+    versions['opencv'] = cv2.__version__
+    return versions
+
+
+_file_hashes = {}   # (path, modification time, size) -> hash
+
+def content_hash(source):
+    """
+    Hash the content of an image, without decoding it.
+
+    Files are hashed from their bytes, and their hash is remembered for as long as their
+    modification time and size do not change.
+
+    Args:
+        source (str, bytes or numpy.ndarray): Path to the image, content of an image file,
+            or a decoded image.
+
+    Returns:
+        str: Hex digest of the content.
+
+    Raises:
+        OSError: If the file cannot be read.
+    """
+    if isinstance(source, np.ndarray):
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(f"{source.dtype}{source.shape}".encode())
+        digest.update(np.ascontiguousarray(source).data)
+        return digest.hexdigest()
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return hashlib.blake2b(source, digest_size=20).hexdigest()
+
+    path = os.path.abspath(os.fspath(source))
+    stat = os.stat(path)
+    file_key = (path, stat.st_mtime_ns, stat.st_size)
+    if file_key not in _file_hashes:
+        digest = hashlib.blake2b(digest_size=20)
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                digest.update(chunk)
+        _file_hashes[file_key] = digest.hexdigest()
+    return _file_hashes[file_key]
+
+
+class ResultCache:
+    """
+    SQLite store of metric values and maps with least recently used eviction.
+
+    Each thread and process opens its own connection, so the cache can be shared by the
+    workers of a batch run.
+    """
+
+    def __init__(self, path=default_cache_path, max_bytes=default_cache_max_bytes):
+        """
+        Args:
+            path (str, optional): Path of the SQLite database, created if needed.
+            max_bytes (int, optional): Size above which the least recently used results are
+                evicted. None means unbounded. Default is 1 GB.
+        """
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_bytes = max_bytes
+        self.versions = package_versions()
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS results "
+                               "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+
+    def _connection(self):
+        '''Connection of the current thread and process'''
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+
+    def make_key(self, kind, dist_hash, ref_hash, metric_name, color_space_name, patch_size=None, step=None,
+                 backend=None):
+        """
+        Build the key of a result, under the current inference settings.
+
+        Args:
+            kind (str): 'metric' or 'map'.
+            dist_hash (str): Content hash of the distorted image.
+            ref_hash (str): Content hash of the reference image, None for no-reference metrics.
+            metric_name (str): Name of the metric.
+            color_space_name (str): Name of the color space.
+            patch_size (int, optional): Window size of maps.
+            step (int, optional): Step size of maps.
+            backend (str, optional): Backend computing the result, if its values differ from
+                those of the default one, e.g. 'numpy' for the classical metrics.
+
+        Returns:
+            str: The key.
+        """
+        fields = [cache_format_version, kind, dist_hash, ref_hash, metric_name, color_space_name,
+                  patch_size, step, self.versions, inference.value_settings(metric_name)]
+        if backend is not None:
+            fields.append(backend)
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+
+    def get(self, key):
+        """
+        Args:
+            key (str): Key of the result.
+
+        Returns:
+            float or numpy.ndarray: The cached result, None if it is not in the cache.
+        """
+        connection = self._connection()
+        row = connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        with connection:
+            connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        value = np.load(io.BytesIO(row[0]), allow_pickle=False)
+        return value.item() if value.ndim == 0 else value
+
+
+    def put(self, key, value):
+        """
+        Store a result, evicting the least recently used ones if the cache is too large.
+
+        Args:
+            key (str): Key of the result.
+            value (float or numpy.ndarray): The result.
+        """
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(value), allow_pickle=False)
+        blob = buffer.getvalue()
+
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                               (key, blob, len(blob), time.time()))
+        self._enforce_limit()
+
+
+    def size(self):
+        """
+        Returns:
+            int: Size of the cached results in bytes.
+        """
+        return self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+    def clear(self):
+        '''Remove all the cached results'''
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM results")
+
+
+    def _enforce_limit(self):
+        '''Evict the least recently used results until the cache fits in max_bytes'''
+        if self.max_bytes is None:
+            return
+
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+
+        connection = self._connection()
+        with connection:
+            rows = connection.execute("SELECT key, size FROM results ORDER BY last_used").fetchall()
+            evicted = []
+            for key, size in rows:
+                if excess <= 0:
+                    break
+                evicted.append((key,))
+                excess -= size
+            connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+
+
+_cache = None
+
+def enable_cache(path=default_cache_path, max_bytes=default_cache_max_bytes):
+    """
+    Cache the results of compute_metric and compute_map on disk.
+
+    Args:
+        path (str, optional): Path of the SQLite database. Default is ~/.cache/libra/results.sqlite.
+        max_bytes (int, optional): Size above which the least recently used results are
+            evicted. None means unbounded. Default is 1 GB.
+
+    Returns:
+        ResultCache: The cache.
+    """
+    global _cache
+    _cache = ResultCache(path, max_bytes)
+    return _cache
+
+
+def disable_cache():
+    '''Stop caching results; the database is kept'''
+    global _cache
+    _cache = None
+
+
+def get_cache():
+    """
+    Returns:
+        ResultCache: The enabled cache, None if caching is disabled.
+    """
+    return _cache
+
+
+def cache_key(kind, dist, ref, metric_name, color_space_name, patch_size=None, step=None):
+    """
+    Key of a result in the enabled cache.
+
+    Args:
+        kind (str): 'metric' or 'map'.
+        dist (str, bytes or numpy.ndarray): Distorted image.
+        ref (str, bytes or numpy.ndarray): Reference image, None for no-reference metrics.
+        metric_name (str): Name of the metric.
+        color_space_name (str): Name of the color space.
+        patch_size (int, optional): Window size of maps.
+        step (int, optional): Step size of maps.
+
+    Returns:
+        str: The key, None if caching is disabled or an image cannot be read.
+    """
+    if _cache is None:
+        return None
+    try:
+        ref_hash = None if ref is None else content_hash(ref)
+        return _cache.make_key(kind, content_hash(dist), ref_hash, metric_name, color_space_name, patch_size, step)
+    except OSError:
+        # Missing images are reported by the computation itself
+        return None
+
+
+def __dir__():
+    return ["ResultCache", "enable_cache", "disable_cache", "get_cache", "content_hash"]
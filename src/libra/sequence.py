@@ -0,0 +1,299 @@
+"""
+This module compares two frame sequences frame by frame.
+
+Sequences are videos read with cv2.VideoCapture, directories of frames, or glob patterns of
+frames such as 'render/frame_*.png', sorted in natural order. A background thread decodes
+and prefetches the next frames while the metrics of the current ones are computed, and
+models are loaded once for the whole sequence. Per-frame metrics are streamed to a CSV file,
+and temporal aggregates (mean, min, max, percentiles and worst frames) are written to a
+summary CSV file at the end.
+
+Example:
+    from libra.sequence import compare_sequences
+
+    summary = compare_sequences("orig.mp4", "compressed.mp4", ["SSIM", "PSNR"], ["RGB"], "frames.csv")
+"""
+
+import os
+import re
+import csv
+import glob
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from .image_pair import ImagePair
+from .metrics import lower_is_better_metrics
+from .model_registry import warmup
+from . import profiling
+
+
+# Extensions of the frames listed from a directory
+frame_extensions = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".exr", ".npy")
+
+# Percentiles of the per-frame values in the summary
+default_percentiles = (5, 50, 95)
+
+
+def _natural_key(path):
+    '''Sort key comparing the numbers in file names by value, so that frame_2 comes before frame_10'''
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', path)]
+
+
+def list_frames(source):
+    """
+    List the frame files of a directory or of a glob pattern.
+
+    Args:
+        source (str): Directory of frames, or glob pattern e.g. 'render/frame_*.png'.
+
+    Returns:
+        list: Paths of the frames in natural order, None if source is neither a directory
+            nor a glob pattern.
+    """
+    if os.path.isdir(source):
+        paths = [os.path.join(source, name) for name in os.listdir(source)
+                 if name.lower().endswith(frame_extensions)]
+    elif glob.has_magic(source):
+        paths = glob.glob(source)
+    else:
+        return None
+    return sorted(paths, key=_natural_key)
+
+
+def iter_frames(source):
+    """
+    Read the frames of a sequence.
+
+    Args:
+        source (str): Video file, directory of frames, or glob pattern of frames.
+
+    Yields:
+        numpy.ndarray: The BGR frames in order.
+
+    Raises:
+        FileNotFoundError: If the source does not exist or has no frames.
+    """
+    paths = list_frames(source)
+    if paths is not None:
+        if not paths:
+            raise FileNotFoundError(f"No frames found for '{source}'")
+        for path in paths:
+            with profiling.stage('imread'):
+                frame = np.load(path) if path.endswith('.npy') else cv2.imread(path, cv2.IMREAD_COLOR)
+            if frame is None:
+                raise FileNotFoundError(f"Error: Unable to read frame '{path}'")
+            yield frame
+        return
+
+    if not os.path.isfile(source):
+        raise FileNotFoundError(f"Error: '{source}' does not exist")
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise FileNotFoundError(f"Error: Unable to open video '{source}'")
+    try:
+        while True:
+            with profiling.stage('imread'):
+                ok, frame = capture.read()
+            if not ok:
+                return
+            yield frame
+    finally:
+        capture.release()
+
+
+_end = object()
+
+def prefetch(iterable, depth=4):
+    """
+    Produce the items of an iterable in a background thread.
+
+    Args:
+        iterable (iterable): Items to produce, e.g. decoded frames.
+        depth (int, optional): Number of items produced ahead of the consumer. Default is 4.
+
+    Yields:
+        The items of the iterable. An error raised while producing them is raised again
+        in the consumer.
+    """
+    items = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                items.put(item)
+        except BaseException as e:
+            items.put(e)
+        items.put(_end)
+
+    thread = threading.Thread(target=produce, name="libra-prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _end:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        # Unblock the producer if the consumer stops early
+        stop.set()
+        while thread.is_alive():
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                thread.join(timeout=0.01)
+
+
+def iter_frame_pairs(ref_source, dist_source, prefetch_depth=4):
+    """
+    Read the frames of two sequences together, decoding ahead in a background thread.
+
+    The comparison stops at the end of the shorter sequence, with a warning if the
+    sequences have different lengths.
+
+    Args:
+        ref_source (str): Reference video, directory of frames, or glob pattern of frames.
+        dist_source (str): Distorted sequence, in the same forms.
+        prefetch_depth (int, optional): Number of frame pairs decoded ahead. Default is 4.
+
+    Yields:
+        tuple: (reference frame, distorted frame)
+    """
+    def pairs():
+        ref_frames, dist_frames = iter_frames(ref_source), iter_frames(dist_source)
+        for ref_frame in ref_frames:
+            dist_frame = next(dist_frames, None)
+            if dist_frame is None:
+                print(f"Warning: '{dist_source}' has fewer frames than '{ref_source}'")
+                return
+            yield ref_frame, dist_frame
+        if next(dist_frames, None) is not None:
+            print(f"Warning: '{dist_source}' has more frames than '{ref_source}'")
+
+    return prefetch(pairs(), prefetch_depth)
+
+
+def summarize(values, metric_name, percentiles=default_percentiles, worst_count=5):
+    """
+    Temporal aggregates of the per-frame values of a metric.
+
+    Args:
+        values (list of float): Value of each frame, nan for frames that failed.
+        metric_name (str): Name of the metric, to tell which frames are the worst.
+        percentiles (tuple of float, optional): Percentiles to compute. Default is (5, 50, 95).
+        worst_count (int, optional): Number of worst frames to list. Default is 5.
+
+    Returns:
+        dict: 'Frames', 'Mean', 'Min', 'Max', 'P<percentile>' for each percentile, and
+            'Worst frames' (space separated frame indices, worst first).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    frames = np.flatnonzero(np.isfinite(values))
+    summary = {'Frames': len(frames)}
+    if len(frames) == 0:
+        summary.update({'Mean': np.nan, 'Min': np.nan, 'Max': np.nan})
+        summary.update({f'P{p:g}': np.nan for p in percentiles})
+        summary['Worst frames'] = ""
+        return summary
+
+    valid = values[frames]
+    summary.update({'Mean': valid.mean(), 'Min': valid.min(), 'Max': valid.max()})
+    summary.update({f'P{p:g}': value for p, value in zip(percentiles, np.percentile(valid, percentiles))})
+
+    # Stable sort so that ties keep the earliest frames
+    order = np.argsort(valid, kind='stable')
+    if metric_name not in lower_is_better_metrics:
+        worst = order[:worst_count]
+    else:
+        worst = order[::-1][:worst_count]
+    summary['Worst frames'] = " ".join(str(frame) for frame in frames[worst])
+    return summary
+
+
+def summary_path(output_path):
+    '''Path of the summary CSV file next to the per-frame CSV file e.g. frames_summary.csv'''
+    root, ext = os.path.splitext(output_path)
+    return f"{root}_summary{ext or '.csv'}"
+
+
+def compare_sequences(ref_source, dist_source, metric_names, color_space_names, output_path,
+                      prefetch_depth=4, percentiles=default_percentiles, worst_count=5):
+    """
+    Compute metrics frame by frame between two sequences.
+
+    The per-frame CSV file has one row per frame and metric with the columns Frame, Metric,
+    one column per color space, and Error; rows are written as frames complete. The summary
+    CSV file, written next to it, has one row per metric and color space with the temporal
+    aggregates of summarize.
+
+    Args:
+        ref_source (str): Reference video, directory of frames, or glob pattern of frames.
+        dist_source (str): Distorted sequence, in the same forms.
+        metric_names (list of str): metrics to use e.g. ['SSIM', 'PSNR'].
+        color_space_names (list of str): color spaces to use e.g. ['RGB'].
+        output_path (str): Path of the per-frame CSV file.
+        prefetch_depth (int, optional): Number of frame pairs decoded ahead. Default is 4.
+        percentiles (tuple of float, optional): Percentiles of the summary. Default is (5, 50, 95).
+        worst_count (int, optional): Number of worst frames of the summary. Default is 5.
+
+    Returns:
+        list: One dictionary per metric and color space, holding 'Metric', 'Color space'
+            and the aggregates.
+    """
+    # Load the models once for all the frames
+    warmup(metric_names)
+
+    values = {(metric_name, color_space_name): []
+              for metric_name in metric_names for color_space_name in color_space_names}
+    columns = ["Frame", "Metric"] + list(color_space_names) + ["Error"]
+
+    with open(output_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+
+        # The tensors of each distorted frame reuse those of the previous one
+        buffers = {}
+        for frame_index, (ref_frame, dist_frame) in enumerate(iter_frame_pairs(ref_source, dist_source, prefetch_depth)):
+            try:
+                results = ImagePair(dist_frame, ref_frame, buffers).compute(metric_names, color_space_names)
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                print(f"Error comparing frame {frame_index}: {error}")
+                writer.writerow([frame_index, ""] + [""] * len(color_space_names) + [error])
+                for frame_values in values.values():
+                    frame_values.append(np.nan)
+                continue
+
+            for metric_result in results:
+                metric_name = metric_result['Metric']
+                row = [frame_index, metric_name]
+                for color_space_name in color_space_names:
+                    value = metric_result[color_space_name]
+                    values[(metric_name, color_space_name)].append(np.nan if value is None else value)
+                    row.append(value)
+                writer.writerow(row + [""])
+            file.flush()
+
+    summary = []
+    for (metric_name, color_space_name), frame_values in values.items():
+        row = {'Metric': metric_name, 'Color space': color_space_name}
+        row.update(summarize(frame_values, metric_name, percentiles, worst_count))
+        summary.append(row)
+
+    with open(summary_path(output_path), 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(summary[0].keys()) if summary else ['Metric', 'Color space'])
+        writer.writeheader()
+        writer.writerows(summary)
+
+    return summary
+
+
+def __dir__():
+    return ["list_frames", "iter_frames", "prefetch", "iter_frame_pairs", "summarize", "compare_sequences"]
@@ -0,0 +1,524 @@
+"""
+This module provides a long-running local comparison server, and a client for it.
+
+The server keeps the models loaded between requests, and computes metrics, metric maps and
+image differences for its clients. Concurrent metric requests sharing a metric, a color space
+and an image size are gathered for a short window and evaluated together in one forward pass
+of the batched metric, so that many small comparisons do not pay one forward pass each.
+
+Clients and server exchange one JSON object per line, over TCP on localhost or over a Unix
+socket. A request holds an 'id', an 'op' ('metric', 'map', 'diff' or 'stats') and its
+arguments; images are given as paths on the machine of the server, or as {'data': base64
+of the content of an image file}. Responses hold the 'id' of their request and either the
+result or an 'error', and are sent as soon as they are ready, so a client may send several
+requests without waiting.
+
+Example:
+    python src/app.py --serve 127.0.0.1:8765
+
+    from libra.server import ComparisonClient
+
+    with ComparisonClient("127.0.0.1:8765") as client:
+        ssim = client.compute_metric("compressed.png", "orig.png", "SSIM", "RGB")
+        metric_map, metadata = client.compute_metric_map("compressed.png", "orig.png", "PSNR", "RGB")
+"""
+
+import io
+import json
+import base64
+import socket
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from .utils import *
+from .metrics import batched_metrics, no_reference_metrics
+from .image_pair import ImagePair
+from .map_computation import compute_metric_map
+from .image_difference import diff_images
+from .model_registry import warmup
+from . import inference
+
+torch = lazy_import('torch')
+
+
+default_address = "127.0.0.1:8765"
+
+# Time waited for other requests to batch with, in seconds
+default_batch_window = 0.005
+default_max_batch_size = 32
+
+# Longest request line, with images sent inline
+max_line_bytes = 1024 * 1024 * 1024
+
+
+def parse_address(address):
+    """
+    Args:
+        address (str): 'host:port' for TCP, or the path of a Unix socket, optionally
+            prefixed with 'unix:'.
+
+    Returns:
+        tuple: ('tcp', host, port) or ('unix', path)
+    """
+    if address.startswith("unix:"):
+        return ('unix', address[len("unix:"):])
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit() and "/" not in address:
+        return ('tcp', host or "127.0.0.1", int(port))
+    return ('unix', address)
+
+
+def encode_image(image):
+    '''Image of a request: paths are sent as they are, arrays as PNG and bytes as they are'''
+    if isinstance(image, np.ndarray):
+        ok, encoded = cv2.imencode(".png", image)
+        if not ok:
+            raise ValueError("Unable to encode the image as PNG")
+        image = encoded.tobytes()
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return {'data': base64.b64encode(bytes(image)).decode('ascii')}
+    return str(image)
+
+
+def decode_request_image(image):
+    '''Path or content of an image of a request, as accepted by decode_image'''
+    if isinstance(image, dict):
+        return base64.b64decode(image['data'])
+    return image
+
+
+def encode_array(array):
+    '''Array of a response, as base64 of its NPY file'''
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return {'npy': base64.b64encode(buffer.getvalue()).decode('ascii')}
+
+
+def decode_array(encoded):
+    '''Array of a response'''
+    return np.load(io.BytesIO(base64.b64decode(encoded['npy'])), allow_pickle=False)
+
+
+class ComparisonServer:
+    """
+    Server computing metrics, maps and differences, with micro-batching of metric requests.
+
+    Example:
+        server = ComparisonServer(metric_names=["SSIM", "LPIPS"])
+        server.serve("127.0.0.1:8765")             # blocks
+
+        address = server.start("127.0.0.1:0")     # or in a background thread, on a free port
+        ...
+        server.stop()
+    """
+
+    def __init__(self, batch_window=default_batch_window, max_batch_size=default_max_batch_size,
+                 workers=4, metric_names=None):
+        """
+        Args:
+            batch_window (float, optional): Time in seconds a metric request waits for other
+                requests to batch with. Default is 5 ms.
+            max_batch_size (int, optional): Largest number of requests evaluated together.
+                Default is 32.
+            workers (int, optional): Threads decoding images and evaluating metrics. Default is 4.
+            metric_names (list of str, optional): Metrics whose models are loaded when the
+                server starts; the others are loaded on first use.
+        """
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.workers = workers
+        self.metric_names = metric_names or []
+        self.address = None
+        self._stats = {'requests': 0, 'errors': 0, 'batches': 0, 'batched requests': 0, 'largest batch': 0}
+        self._pending = {}      # (metric, color space, shapes) -> [(pair, dist tensor, ref tensor, future)]
+        self._executor = None
+        self._loop = None
+        self._stopped = None
+        self._thread = None
+
+
+    def stats(self):
+        """
+        Returns:
+            dict: Number of 'requests' and 'errors', of 'batches' evaluated and of 'batched
+                requests' in them, and the size of the 'largest batch'.
+        """
+        return dict(self._stats)
+
+
+    ##################### LIFECYCLE ###########################################
+
+    def serve(self, address=default_address, ready=None):
+        """
+        Serve until stop is called.
+
+        Args:
+            address (str, optional): 'host:port' or the path of a Unix socket. Default is 127.0.0.1:8765.
+            ready (threading.Event, optional): Set once the server accepts connections.
+        """
+        asyncio.run(self._serve(address, ready))
+
+
+    def start(self, address=default_address):
+        """
+        Serve in a background thread.
+
+        Args:
+            address (str, optional): 'host:port', with port 0 for a free port, or the path
+                of a Unix socket. Default is 127.0.0.1:8765.
+
+        Returns:
+            str: The address the server listens on.
+        """
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self.serve, args=(address, ready), name="libra-server", daemon=True)
+        self._thread.start()
+        ready.wait()
+        if self.address is None:
+            raise RuntimeError(f"Unable to serve on {address}")
+        return self.address
+
+
+    def stop(self):
+        '''Stop serving, and wait for the background thread if started with start'''
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+    async def _serve(self, address, ready):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="libra-server")
+        try:
+            # Models are loaded once, before the first request
+            await self._loop.run_in_executor(self._executor, warmup, self.metric_names)
+
+            kind, *location = parse_address(address)
+            if kind == 'unix':
+                server = await asyncio.start_unix_server(self._handle_connection, location[0], limit=max_line_bytes)
+                self.address = location[0]
+            else:
+                server = await asyncio.start_server(self._handle_connection, location[0], location[1], limit=max_line_bytes)
+                host, port = server.sockets[0].getsockname()[:2]
+                self.address = f"{host}:{port}"
+        except BaseException:
+            if ready is not None:
+                ready.set()
+            self._executor.shutdown(wait=False)
+            raise
+
+        print(f"Comparison server listening on {self.address}")
+        if ready is not None:
+            ready.set()
+        try:
+            await self._stopped.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            self._executor.shutdown(wait=True)
+            self._loop = None
+
+
+    ##################### REQUESTS ###########################################
+
+    async def _handle_connection(self, reader, writer):
+        '''Answer the requests of a connection as they complete'''
+        write_lock = asyncio.Lock()
+        tasks = set()
+
+        async def answer(line):
+            response = await self._handle_request(line)
+            async with write_lock:
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                task = asyncio.ensure_future(answer(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def _handle_request(self, line):
+        '''Response to a request line'''
+        self._stats['requests'] += 1
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get('id')
+            handlers = {'metric': self._metric, 'map': self._map, 'diff': self._diff,
+                        'stats': self._stats_request}
+            op = request.get('op')
+            if op not in handlers:
+                raise ValueError(f"Unknown op '{op}', expected one of {list(handlers)}")
+            response = await handlers[op](request)
+        except Exception as e:
+            self._stats['errors'] += 1
+            response = {'error': f"{type(e).__name__}: {e}"}
+        response['id'] = request_id
+        return response
+
+
+    async def _stats_request(self, request):
+        return {'stats': self.stats()}
+
+
+    async def _metric(self, request):
+        metric_name = request.get('metric', 'SSIM')
+        color_space_name = request.get('color_space', 'LAB')
+        pair = ImagePair(decode_request_image(request['dist']), decode_request_image(request.get('ref')))
+
+        if metric_name not in batched_metrics:
+            value = await self._loop.run_in_executor(self._executor, pair.compute_metric, metric_name, color_space_name)
+            return {'value': value}
+
+        def tensors():
+            x = pair.tensor('dist', color_space_name)
+            y = None if metric_name in no_reference_metrics else pair.tensor('ref', color_space_name)
+            return x, y
+
+        x, y = await self._loop.run_in_executor(self._executor, tensors)
+        key = (metric_name, color_space_name, tuple(x.shape), None if y is None else tuple(y.shape))
+        future = self._loop.create_future()
+        batch = self._pending.setdefault(key, [])
+        batch.append((pair, x, y, future))
+        if len(batch) == 1:
+            self._loop.call_later(self.batch_window, self._flush, key)
+        if len(batch) >= self.max_batch_size:
+            self._flush(key)
+        return {'value': await future}
+
+
+    def _flush(self, key):
+        '''Evaluate the pending requests of a key together'''
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+        self._stats['batches'] += 1
+        self._stats['batched requests'] += len(batch)
+        self._stats['largest batch'] = max(self._stats['largest batch'], len(batch))
+        asyncio.ensure_future(self._run_batch(key, batch))
+
+
+    async def _run_batch(self, key, batch):
+        metric_name, color_space_name = key[:2]
+        try:
+            results = await self._loop.run_in_executor(self._executor, self._compute_batch,
+                                                       metric_name, color_space_name, batch)
+        except Exception as e:
+            results = [e] * len(batch)
+        for (*_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+    def _compute_batch(self, metric_name, color_space_name, batch):
+        '''Values of a batch of requests in one forward pass, or one by one if it fails, with the exceptions of failed requests'''
+        batched_fn = batched_metrics[metric_name]
+        try:
+            x = torch.cat([x for _, x, _, _ in batch])
+            with inference.context(metric_name):
+                if batch[0][2] is None:
+                    values = batched_fn(x)
+                else:
+                    values = batched_fn(x, torch.cat([y for _, _, y, _ in batch]))
+            return [float(value) for value in values.detach().flatten().cpu()]
+        except Exception:
+            pass
+
+        # Evaluate the requests one by one, so that only failing requests fail
+        results = []
+        for pair, *_ in batch:
+            try:
+                results.append(pair.compute_metric(metric_name, color_space_name))
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+    async def _map(self, request):
+        def compute():
+            return compute_metric_map(decode_request_image(request['dist']), decode_request_image(request['ref']),
+                                      request.get('metric', 'SSIM'), request.get('color_space', 'HSV'),
+                                      request.get('patch_size', 161), request.get('step', 50),
+                                      request.get('batch_size', 64))
+        metric_map, metadata = await self._loop.run_in_executor(self._executor, compute)
+        return {'map': encode_array(metric_map), 'metadata': metadata}
+
+
+    async def _diff(self, request):
+        def compute():
+            return diff_images(decode_request_image(request['dist']), decode_request_image(request['ref']),
+                               request.get('threshold', 0), request.get('color_space', 'HSV'),
+                               request.get('colormap', 'JET'))
+        heatmap, heatmap_eq = await self._loop.run_in_executor(self._executor, compute)
+        return {'heatmap': encode_array(heatmap), 'heatmap_eq': encode_array(heatmap_eq)}
+
+
+def serve(address=default_address, **server_args):
+    """
+    Run a comparison server until interrupted.
+
+    Args:
+        address (str, optional): 'host:port' or the path of a Unix socket. Default is 127.0.0.1:8765.
+        **server_args: Arguments of ComparisonServer.
+    """
+    try:
+        ComparisonServer(**server_args).serve(address)
+    except KeyboardInterrupt:
+        pass
+
+
+class ComparisonClient:
+    """
+    Client of a comparison server, with the interface of the library functions.
+
+    A client sends one request at a time; use one client per thread to send concurrent
+    requests, which the server batches together.
+
+    Example:
+        with ComparisonClient("127.0.0.1:8765") as client:
+            lpips = client.compute_metric("compressed.png", "orig.png", "LPIPS", "RGB")
+    """
+
+    def __init__(self, address=default_address, timeout=None):
+        """
+        Args:
+            address (str, optional): 'host:port' or the path of a Unix socket of the server.
+                Default is 127.0.0.1:8765.
+            timeout (float, optional): Timeout of the requests in seconds; None waits forever.
+        """
+        kind, *location = parse_address(address)
+        if kind == 'unix':
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.settimeout(timeout)
+            self._socket.connect(location[0])
+        else:
+            self._socket = socket.create_connection(tuple(location), timeout=timeout)
+        self._file = self._socket.makefile('rb')
+        self._next_id = 0
+
+
+    def request(self, op, **arguments):
+        """
+        Send a request and wait for its response.
+
+        Args:
+            op (str): 'metric', 'map', 'diff' or 'stats'.
+            **arguments: Arguments of the request.
+
+        Returns:
+            dict: The response.
+
+        Raises:
+            RuntimeError: If the server could not answer the request.
+        """
+        self._next_id += 1
+        request = dict(arguments, id=self._next_id, op=op)
+        self._socket.sendall(json.dumps(request).encode() + b"\n")
+
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("The comparison server closed the connection")
+        response = json.loads(line)
+        if response.get('error') is not None:
+            raise RuntimeError(response['error'])
+        return response
+
+
+    def compute_metric(self, dist, ref, metric_name='SSIM', color_space_name='LAB'):
+        """
+        Args:
+            dist (str, bytes or numpy.ndarray): Path of distorted image, its content, or the BGR image.
+            ref (str, bytes or numpy.ndarray): Reference image, in the same forms.
+            metric_name (str): metric to use e.g. 'SSIM'.
+            color_space_name (str): Name of the color space to use e.g. 'LAB'.
+
+        Returns:
+            float: The metric value, as returned by compute_metric.
+        """
+        response = self.request('metric', dist=encode_image(dist), ref=encode_image(ref),
+                                metric=metric_name, color_space=color_space_name)
+        return response['value']
+
+
+    def compute_metric_map(self, dist, ref, metric_name='SSIM', color_space='HSV', patch_size=161, step=50, batch_size=64):
+        """
+        Args:
+            dist (str, bytes or numpy.ndarray): Path of distorted image, its content, or the BGR image.
+            ref (str, bytes or numpy.ndarray): Reference image, in the same forms.
+            metric_name (str): metric name.
+            color_space (str): name of the color space.
+            patch_size (int, optional): The size of the patches. Default is 161.
+            step (int, optional): The step size between patches. Default is 50.
+            batch_size (int, optional): Number of patches evaluated per forward pass. Default is 64.
+
+        Returns:
+            tuple: (float32 map, metadata dictionary), as returned by compute_metric_map.
+        """
+        response = self.request('map', dist=encode_image(dist), ref=encode_image(ref), metric=metric_name,
+                                color_space=color_space, patch_size=patch_size, step=step, batch_size=batch_size)
+        return decode_array(response['map']), response['metadata']
+
+
+    def diff_images(self, dist, ref, threshold=0, color_space_name='HSV', colormap_name='JET'):
+        """
+        Args:
+            dist (str, bytes or numpy.ndarray): Path of distorted image, its content, or the BGR image.
+            ref (str, bytes or numpy.ndarray): Reference image, in the same forms.
+            threshold (int): The threshold value to apply for highlighting differences.
+            color_space_name (str): name of the color space to use.
+            colormap_name (str, optional): name of the color map for the difference.
+
+        Returns:
+            tuple: (difference image, histogram equalized difference image), as returned by diff_images.
+        """
+        response = self.request('diff', dist=encode_image(dist), ref=encode_image(ref), threshold=threshold,
+                                color_space=color_space_name, colormap=colormap_name)
+        return decode_array(response['heatmap']), decode_array(response['heatmap_eq'])
+
+
+    def stats(self):
+        """
+        Returns:
+            dict: The statistics of the server, see ComparisonServer.stats.
+        """
+        return self.request('stats')['stats']
+
+
+    def close(self):
+        self._file.close()
+        self._socket.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def __dir__():
+    return ["ComparisonServer", "ComparisonClient", "serve", "parse_address"]
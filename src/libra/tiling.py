@@ -0,0 +1,296 @@
+"""
+This module provides a tiled evaluation mode for images too large to be processed at once.
+
+Images are read region by region from memory-mapped sources (NPY files, uncompressed TIFF
+files, or any array), and metrics and maps are computed tile by tile so that the memory used
+stays within a budget. Map tiles overlap by a halo so that every patch sees the same pixels
+as in a whole-image evaluation, and tile results combine into the same global scores and maps.
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+from .utils import *
+from .metrics import *
+from . import profiling
+from .map_computation import convert_map_color_space, metric_patch_values, patch_grid_shape, scatter_average, compute_ssim_map
+
+
+# Default memory budget for tiled evaluation, in bytes
+default_memory_budget = 256 * 1024 * 1024
+
+# Estimated working memory per pixel of a tile: both images, their color space conversions,
+# and the float64 and float32 intermediates of the metrics
+bytes_per_pixel = 96
+
+# Window of the SSIM maps of compute_ssim_map, and the halo of pixels it reads around a tile
+ssim_window = 7
+ssim_halo = ssim_window // 2
+
+
+class ImageSource:
+    """
+    An image read region by region, from an array that may be memory-mapped.
+    """
+
+    def __init__(self, array, rgb=False):
+        """
+        Args:
+            array (numpy.ndarray): uint8 image shaped (H, W) or (H, W, C).
+            rgb (bool, optional): True if the channels are in RGB order rather than BGR.
+        """
+        self.array = array
+        self.rgb = rgb
+
+
+    @property
+    def shape(self):
+        return self.array.shape[:2]
+
+
+    def read(self, top, bottom, left, right):
+        """
+        Read a region of the image.
+
+        Returns:
+            numpy.ndarray: The BGR region.
+        """
+        with profiling.stage('imread'):
+            region = np.asarray(self.array[top:bottom, left:right])
+        if region.ndim == 2:
+            return cv2.cvtColor(region, cv2.COLOR_GRAY2BGR)
+        if self.rgb:
+            region = region[:, :, ::-1]
+        return np.ascontiguousarray(region)
+
+
+def open_image_source(source):
+    """
+    Open an image for region by region reads.
+
+    NPY files are memory-mapped, as are TIFF files if tifffile is installed and the file is
+    uncompressed. Other files are decoded once with OpenCV.
+
+    Args:
+        source (str or numpy.ndarray): Path to the image, or a BGR image array.
+
+    Returns:
+        ImageSource: The opened image.
+    """
+    if isinstance(source, ImageSource):
+        return source
+    if isinstance(source, np.ndarray):
+        return ImageSource(source)
+
+    extension = os.path.splitext(source)[1].lower()
+    if extension == '.npy':
+        return ImageSource(np.load(source, mmap_mode='r'))
+
+    if extension in ('.tif', '.tiff'):
+        try:
+            import tifffile
+        except ImportError:
+            tifffile = None
+
+        if tifffile is not None:
+            try:
+                return ImageSource(tifffile.memmap(source, mode='r'), rgb=True)
+            except ValueError:
+                # Compressed or tiled files cannot be memory-mapped
+                print(f"{source} cannot be memory-mapped, it will be read at once.")
+                return ImageSource(tifffile.imread(source), rgb=True)
+
+    return ImageSource(decode_image(source))
+
+
+def tile_size(memory_budget, minimum=1):
+    """
+    Args:
+        memory_budget (int): Memory budget in bytes.
+        minimum (int, optional): Smallest tile size returned.
+
+    Returns:
+        int: Side in pixels of the square tiles fitting in the budget.
+    """
+    return max(minimum, int(np.sqrt(memory_budget / bytes_per_pixel)))
+
+
+def _open_pair(dist, ref):
+    dist_source = open_image_source(dist)
+    ref_source = open_image_source(ref)
+    if dist_source.shape != ref_source.shape:
+        raise ValueError(f"Tiled evaluation needs images of the same size, got {dist_source.shape} and {ref_source.shape}")
+    return dist_source, ref_source
+
+
+##################### METRICS ###########################################
+
+def _sum_squared_error(im1, im2):
+    diff = im1.astype(np.float64) / 255.0 - im2.astype(np.float64) / 255.0
+    return np.sum(diff * diff)
+
+
+# metric name -> (sum over a tile, global value from the sum over all tiles, height, width and channels)
+tile_metrics = {
+    'MSE': (lambda im1, im2: compute_mse(im1, im2) * im1.shape[0] * im1.shape[1],
+            lambda total, h, w, c: total / float(h * w)),
+    'MAE': (lambda im1, im2: np.sum(np.abs(im1.astype("float") - im2.astype("float"))),
+            lambda total, h, w, c: total / float(h * w * c)),
+    'PSNR': (_sum_squared_error,
+             lambda total, h, w, c: -10 * np.log10(total / float(h * w * c) + 1e-8)),
+}
+
+
+def compute_metric_tiled(dist, ref, metric_name='MSE', color_space_name='LAB', memory_budget=default_memory_budget):
+    """
+    Compute a metric tile by tile, for images too large to be processed at once.
+
+    Only metrics that are sums over pixels (MSE, MAE and PSNR) can be combined exactly from
+    tiles, and give the same value as compute_metric.
+
+    Args:
+        dist (str or numpy.ndarray): Path of distorted image, or the image.
+        ref (str or numpy.ndarray): Path of reference image, or the image.
+        metric_name (str): metric to use, one of tile_metrics.
+        color_space_name (str): Name of the color space to use e.g. 'LAB'.
+        memory_budget (int, optional): Memory budget in bytes. Default is 256 MB.
+
+    Returns:
+        float: The metric value.
+
+    Raises:
+        ValueError: If the metric cannot be computed tile by tile.
+    """
+    if metric_name not in tile_metrics:
+        raise ValueError(f"{metric_name} cannot be computed tile by tile; supported metrics are {list(tile_metrics)}")
+
+    partial_fn, total_fn = tile_metrics[metric_name]
+    dist_source, ref_source = _open_pair(dist, ref)
+    h, w = dist_source.shape
+    side = tile_size(memory_budget)
+
+    total, channels = 0.0, 1
+    for top in range(0, h, side):
+        for left in range(0, w, side):
+            region = (top, min(h, top + side), left, min(w, left + side))
+            dist_tile, ref_tile = dist_source.read(*region), ref_source.read(*region)
+            with profiling.stage('cvtColor'):
+                dist_tile = cv2.cvtColor(dist_tile, color_spaces[color_space_name])
+                ref_tile = cv2.cvtColor(ref_tile, color_spaces[color_space_name])
+            channels = dist_tile.shape[2] if dist_tile.ndim == 3 else 1
+            with profiling.stage('forward'):
+                total += partial_fn(dist_tile, ref_tile)
+
+    return total_fn(total, h, w, channels)
+
+
+##################### MAPS ###########################################
+
+def compute_map_tiled(dist, ref, metric_name='MSE', color_space='HSV', patch_size=161, step=50,
+                      memory_budget=default_memory_budget, out_path=None, batch_size=64):
+    """
+    Compute a metric map tile by tile, for images too large to be processed at once.
+
+    The patches are evaluated on tiles that overlap by a halo of patch_size - step pixels,
+    so each patch is evaluated exactly once on the same pixels as in a whole-image map.
+    Values of overlapping patches are averaged as in compute_map.
+
+    SSIM maps are not computed per patch, as in compute_map: they are the per-pixel SSIM
+    map of the V channel, computed on tiles with a halo of the SSIM window, and patch_size
+    and step are ignored.
+
+    Args:
+        dist (str or numpy.ndarray): Path of distorted image, or the image.
+        ref (str or numpy.ndarray): Path of reference image, or the image.
+        metric_name (str): metric name.
+        color_space (str): name of the color space.
+        patch_size (int, optional): The size of the patches to compute the metrics on. Default is 161.
+        step (int, optional): The step size between patches. Default is 50.
+        memory_budget (int, optional): Memory budget in bytes. Default is 256 MB.
+        out_path (str, optional): If given, the map is written to this NPY file, which is
+            memory-mapped while it is filled, and the memory-mapped map is returned. The
+            values of the patches, whose number grows with the image at small steps, are
+            then memory-mapped in a temporary file next to it.
+        batch_size (int, optional): Number of patches evaluated per forward pass. Default is 64.
+
+    Returns:
+        numpy.ndarray: The float32 metric map.
+    """
+    dist_source, ref_source = _open_pair(dist, ref)
+    h, w = dist_source.shape
+
+    if out_path is not None:
+        metric_map = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float32, shape=(h, w))
+    else:
+        metric_map = np.zeros((h, w), dtype=np.float32)
+
+    if metric_name == "SSIM":
+        _ssim_map_tiled(dist_source, ref_source, color_space, tile_size(memory_budget, ssim_window), metric_map)
+    else:
+        _patch_map_tiled(dist_source, ref_source, metric_name, color_space, patch_size, step,
+                         memory_budget, out_path, batch_size, metric_map)
+
+    if out_path is not None:
+        metric_map.flush()
+    return metric_map
+
+
+def _ssim_map_tiled(dist_source, ref_source, color_space, side, metric_map):
+    '''Fill a map with the SSIM map of compute_ssim_map, tile by tile'''
+    h, w = dist_source.shape
+    for top in range(0, h, side):
+        for left in range(0, w, side):
+            bottom, right = min(h, top + side), min(w, left + side)
+            # Tiles read the halo of the window around them, and are at least one window wide
+            region = (max(0, min(top - ssim_halo, bottom - ssim_window)), min(h, max(bottom + ssim_halo, top + ssim_window)),
+                      max(0, min(left - ssim_halo, right - ssim_window)), min(w, max(right + ssim_halo, left + ssim_window)))
+
+            dist_tile = convert_map_color_space(dist_source.read(*region), color_space)
+            ref_tile = convert_map_color_space(ref_source.read(*region), color_space)
+            with profiling.stage('forward'):
+                _, tile_map = compute_ssim_map(dist_tile, ref_tile)
+            metric_map[top:bottom, left:right] = tile_map[top - region[0]:bottom - region[0], left - region[2]:right - region[2]]
+
+
+def _patch_map_tiled(dist_source, ref_source, metric_name, color_space, patch_size, step,
+                     memory_budget, out_path, batch_size, metric_map):
+    '''Fill a map with the averaged values of the patches, evaluated tile by tile'''
+    h, w = dist_source.shape
+    rows, cols = patch_grid_shape((h, w), patch_size, step)
+    side = tile_size(memory_budget, patch_size)
+
+    # Patches per tile along each axis, so that a tile with its halo fits in the budget
+    patches_per_tile = max(1, (side - patch_size) // step + 1)
+
+    if out_path is not None:
+        values_path = f"{os.path.splitext(out_path)[0]}.values.npy"
+        values = np.lib.format.open_memmap(values_path, mode='w+', dtype=np.float32, shape=(rows, cols))
+        values[:] = np.nan
+    else:
+        values = np.full((rows, cols), np.nan, dtype=np.float32)
+
+    try:
+        for r0 in range(0, rows, patches_per_tile):
+            for c0 in range(0, cols, patches_per_tile):
+                r1, c1 = min(rows, r0 + patches_per_tile), min(cols, c0 + patches_per_tile)
+                region = (r0 * step, (r1 - 1) * step + patch_size, c0 * step, (c1 - 1) * step + patch_size)
+
+                dist_tile = convert_map_color_space(dist_source.read(*region), color_space)
+                ref_tile = convert_map_color_space(ref_source.read(*region), color_space)
+                with profiling.stage('forward'):
+                    values[r0:r1, c0:c1] = metric_patch_values(dist_tile, ref_tile, metric_name, patch_size, step, batch_size)
+
+        for top in range(0, h, side):
+            for left in range(0, w, side):
+                region = (top, min(h, top + side), left, min(w, left + side))
+                metric_map[region[0]:region[1], region[2]:region[3]] = scatter_average(values, patch_size, step, (h, w), region)
+    finally:
+        if out_path is not None:
+            del values
+            os.remove(values_path)
+
+
+def __dir__():
+    return ["ImageSource", "open_image_source", "compute_metric_tiled", "compute_map_tiled"]
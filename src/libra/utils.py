@@ -1,13 +1,64 @@
 import sys
 import os
+import importlib
 
 import cv2
 import numpy as np
-import torch
 
+from . import profiling
 
-# Use cuda enabled device if available
-device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+
+class LazyModule:
+    """
+    A module that is only imported when one of its attributes is first used.
+
+    Heavy dependencies such as torch, piq and pyiqa are loaded this way, so that importing
+    libra, or using metrics that do not need them, does not pay for their import.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_import(name):
+    """
+    Args:
+        name (str): Name of the module e.g. 'torch'.
+
+    Returns:
+        LazyModule: The module, imported on first attribute access.
+    """
+    return LazyModule(name)
+
+
+torch = lazy_import('torch')
+
+
+_device = None
+
+def get_device():
+    """
+    Returns:
+        torch.device: The cuda device if available, else the cpu.
+    """
+    global _device
+    if _device is None:
+        # Use cuda enabled device if available
+        _device = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
+    return _device
 
 
 color_spaces = {
@@ -58,7 +109,8 @@ def load_image(path):
     Returns:
         tuple: (distorted image, reference image)
     """
-    image = cv2.imread(path)
+    with profiling.stage('imread'):
+        image = cv2.imread(path)
 
     if image is None:
         print("Unable to read input images.")
@@ -67,6 +119,38 @@ def load_image(path):
     return image
 
 
+def decode_image(source):
+    """
+    Decode an image given as a path, encoded bytes or an already decoded array.
+
+    Args:
+        source (str, bytes or numpy.ndarray): Path to the image, content of an image file,
+            or a BGR image as returned by cv2.imread.
+
+    Returns:
+        numpy.ndarray: The BGR image.
+
+    Raises:
+        FileNotFoundError: If the image cannot be read from the given path.
+        ValueError: If the bytes cannot be decoded.
+    """
+    if isinstance(source, np.ndarray):
+        return source
+
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        with profiling.stage('imread'):
+            image = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            raise ValueError("Unable to decode image from bytes")
+        return image
+
+    with profiling.stage('imread'):
+        image = cv2.imread(os.fspath(source))
+    if image is None:
+        raise FileNotFoundError(f"Image not found: {source}")
+    return image
+
+
 def write_image(img, path):
     """
     Write an image out to disk
@@ -76,16 +160,43 @@ def write_image(img, path):
         path (str): Path to write it to
     """
     
-    cv2.imwrite(path, img)
+    with profiling.stage('imwrite'):
+        cv2.imwrite(path, img)
     
 
 
+def read_unchanged_image(image_path):
+    """
+    Load an image as the image differences do: image files are read unchanged, keeping
+    their bit depth and alpha channel.
+
+    Args:
+        image_path (str, bytes or numpy.ndarray): The path to the image file, its content, or
+            a BGR image.
+
+    Returns:
+        numpy.ndarray: The loaded image.
+
+    Raises:
+        FileNotFoundError: If the specified image file is not found.
+    """
+    if isinstance(image_path, (bytes, bytearray, memoryview, np.ndarray)):
+        image = decode_image(image_path)
+    else:
+        with profiling.stage('imread'):
+            image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise FileNotFoundError(f"Image not found: {image_path}")
+    return image
+
+
 def load_and_convert_image(image_path, color_space_code=cv2.COLOR_BGR2RGB):
     """
     Load an image from the given path and convert it to the specified color space.
 
     Args:
-        image_path (str): The path to the image file.
+        image_path (str, bytes or numpy.ndarray): The path to the image file, its content, or
+            a BGR image.
         color_space_code (int): The OpenCV color space conversion code.
 
     Returns:
@@ -94,11 +205,10 @@ def load_and_convert_image(image_path, color_space_code=cv2.COLOR_BGR2RGB):
     Raises:
         FileNotFoundError: If the specified image file is not found.
     """
-    image = cv2.imread(image_path, cv2.IMREAD_UNCHANGED)
-    if image is None:
-        raise FileNotFoundError(f"Image not found: {image_path}")
+    image = read_unchanged_image(image_path)
     
-    return cv2.cvtColor(image, color_space_code)
+    with profiling.stage('cvtColor'):
+        return cv2.cvtColor(image, color_space_code)
 
 
 
@@ -168,12 +278,22 @@ def load_tensor_image(image_path):
     """
     Load an image from file and convert to a PyTorch tensor.
     """
-    image = cv2.imread(image_path)
+    with profiling.stage('imread'):
+        image = cv2.imread(image_path)
     if image is None:
         raise ValueError(f"Unable to load image from path: {image_path}")
-    image = normalize_image(image.astype(np.float32))
-    image_tensor = torch.tensor(image).permute(2, 0, 1).unsqueeze(0).float()
-    return image_tensor.to(device)
+    # One float32 copy, normalized in place, viewed channels-last as (1, C, H, W)
+    buffer = torch.empty(image.shape, dtype=torch.float32)
+    buffer.copy_(torch.from_numpy(image))
+    buffer.div_(255.0)
+    return buffer.permute(2, 0, 1).unsqueeze(0).to(get_device())
+
+
+def __getattr__(name):
+    # device is resolved on first use so that importing libra does not import torch
+    if name == "device":
+        return get_device()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def __dir__():
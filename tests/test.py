@@ -6,6 +6,9 @@ sys.path.append("..")
 
 import src.libra as libra
 
+# Maximum time in seconds for importing libra
+IMPORT_TIME_BUDGET = 1.0
+
 class TestLibra(unittest.TestCase):
     def setUp(self):
         self.ref_path = "data/test/orig.png"
@@ -26,6 +29,26 @@ class TestLibra(unittest.TestCase):
 
         self.assertTrue(results == precomputed_results)
 
+
+    def test_image_pair(self):
+        '''
+        Making sure that an image pair gives the same results from paths, arrays and bytes
+        '''
+        metric_names = ['SSIM', 'MSE', 'PSNR']
+        colorspace_names = ['RGB', 'HSV']
+
+        with open(self.cmp_path, 'rb') as file:
+            cmp_bytes = file.read()
+        ref_image = libra.load_image(self.ref_path)
+
+        results = libra.ImagePair(self.cmp_path, self.ref_path).compute(metric_names, colorspace_names)
+        self.assertEqual(results, libra.ImagePair(cmp_bytes, ref_image).compute(metric_names, colorspace_names))
+
+        for metric_result in results:
+            for colorspace_name in colorspace_names:
+                expected = libra.compute_metric(self.cmp_path, self.ref_path, metric_result['Metric'], colorspace_name)
+                self.assertEqual(metric_result[colorspace_name], expected)
+
         
     def test_image_comparison(self):
         '''
@@ -47,6 +70,184 @@ class TestLibra(unittest.TestCase):
         self.assertTrue( libra.is_same(diff_img_eq, img_diff_eq) )
 
 
+    def test_diff_statistics(self):
+        '''
+        Ensure that the threshold sweep counts the same pixels as thresholding the difference at each level
+        '''
+        import cv2
+        from src.libra.utils import load_and_convert_image
+
+        statistics = libra.diff_statistics(self.ref_path, self.cmp_path, ['HSV', 'RGB'], threshold=10)
+        self.assertEqual(sorted(statistics), ['HSV', 'RGB'])
+
+        for color_space_name, stats in statistics.items():
+            code = libra.get_color_space_code(color_space_name)
+            diff = cv2.absdiff(load_and_convert_image(self.ref_path, code), load_and_convert_image(self.cmp_path, code))
+            for t in [0, 10, 50, 200]:
+                _, thresholded = cv2.threshold(diff, t, 255, cv2.THRESH_TOZERO)
+                self.assertEqual(stats['counts'][t], (thresholded.max(axis=2) > 0).sum())
+            # Every changed pixel above the threshold lies in one of the boxes
+            self.assertEqual(stats['boxes'][:, 4].sum(), stats['counts'][10])
+
+        # Images are read as by the differences, keeping 16 bits, here with channels changing by different amounts
+        import tempfile
+        rng = np.random.default_rng(0)
+        image1 = rng.integers(0, 65535, (64, 64, 3), dtype=np.uint16)
+        changes = rng.integers(-1, 2, image1.shape) * np.array([100, 3000, 20000])
+        image2 = np.clip(image1.astype(np.int32) + changes, 0, 65535).astype(np.uint16)
+        with tempfile.TemporaryDirectory() as folder:
+            paths = [os.path.join(folder, f"image{i}.png") for i in (1, 2)]
+            cv2.imwrite(paths[0], image1)
+            cv2.imwrite(paths[1], image2)
+            stats = libra.diff_statistics(paths[0], paths[1], ['RGB'])['RGB']
+            difference = cv2.absdiff(load_and_convert_image(paths[0]), load_and_convert_image(paths[1]))
+        for t in [10, 500, 10000]:
+            self.assertEqual(stats['counts'][t], (difference.max(axis=2) > t).sum())
+        self.assertEqual(stats['max'], difference.max())
+        self.assertEqual(stats['channel_histograms'].shape, (3, difference.max() + 1))
+        self.assertTrue( np.allclose(stats['channel_means'], difference.mean(axis=(0, 1))) )
+
+
+    def check_map_store(self, extension):
+        '''
+        Write a map and a difference to a container, and check that they read back as written
+        '''
+        import tempfile
+        from src.libra.map_store import MapWriter, open_maps
+        from src.libra.image_difference import difference_image
+
+        metric_map, metadata = libra.compute_metric_map(self.cmp_path, self.ref_path, "PSNR", "HSV", 64, 32)
+        difference = difference_image(self.cmp_path, self.ref_path, 10, 'HSV')
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "run" + extension)
+            with MapWriter(path, chunk_size=128) as writer:
+                writer.write("maps/HSV/PSNR", metric_map, metadata)
+                writer.write("diffs/HSV", difference, {'threshold': 10})
+                with self.assertRaises(ValueError):
+                    writer.write("diffs/HSV", difference)
+
+            with open_maps(path) as maps:
+                self.assertEqual(sorted(maps.keys()), ["diffs/HSV", "maps/HSV/PSNR"])
+                self.assertEqual(maps.attributes("maps/HSV/PSNR"), metadata)
+                self.assertTrue( np.array_equal(maps["maps/HSV/PSNR"][100:300, 50:400], metric_map[100:300, 50:400], equal_nan=True) )
+                self.assertTrue( np.array_equal(maps["diffs/HSV"][:], difference) )
+
+
+    def test_map_store(self):
+        '''
+        Ensure that maps and differences read back from an NPZ container are the ones written
+        '''
+        self.check_map_store(".npz")
+
+
+    def test_map_store_hdf5(self):
+        '''
+        Ensure that maps and differences read back from an HDF5 container are the ones written
+        '''
+        import importlib.util
+        if importlib.util.find_spec("h5py") is None:
+            self.skipTest("h5py is not installed")
+        self.check_map_store(".h5")
+
+
+    def test_map_store_zarr(self):
+        '''
+        Ensure that maps and differences read back from a Zarr container are the ones written
+        '''
+        import importlib.util
+        if importlib.util.find_spec("zarr") is None:
+            self.skipTest("zarr is not installed")
+        self.check_map_store(".zarr")
+
+
+    def test_adaptive_map(self):
+        '''
+        Ensure that adaptive maps refine the changed regions only, with the values of the patches there
+        '''
+        from src.libra.adaptive_map import metric_values_at
+
+        # Mostly uniform images, differing in one textured region
+        rng = np.random.default_rng(0)
+        ref = np.full((2048, 2048, 3), 40, dtype=np.uint8)
+        ref[800:1000, 600:900] = rng.integers(0, 255, (200, 300, 3))
+        dist = ref.copy()
+        dist[850:950, 650:800] = np.clip(dist[850:950, 650:800] + rng.integers(-30, 30, (100, 150, 3)), 0, 255)
+
+        metric_map, levels, metadata = libra.compute_adaptive_metric_map(dist, ref, "MSE", "RGB", 32, 3)
+        self.assertEqual(metadata['dense_patches'], 64 * 64)
+        self.assertLessEqual(metadata['patches'] * 10, metadata['dense_patches'])
+        self.assertTrue( np.all(levels[850:950, 650:800] == 3) )
+        self.assertTrue( np.all(metric_map[:512, 1536:] == 0) )
+
+        # Finest cells hold the value of the metric on their patch
+        tops, lefts = np.array([832, 864, 928]), np.array([640, 704, 768])
+        self.assertTrue( np.allclose(metric_map[tops, lefts], metric_values_at(dist, ref, "MSE", tops, lefts, 32)) )
+
+        # A single coarsest cell is refined where the images differ
+        ref = np.full((256, 256, 3), 40, dtype=np.uint8)
+        dist = ref.copy()
+        dist[100:130, 150:180] = rng.integers(0, 255, (30, 30, 3))
+        for metric_name in ["MSE", "SSIM"]:
+            metric_map, levels, metadata = libra.compute_adaptive_metric_map(dist, ref, metric_name, "RGB", 32, 3)
+            self.assertGreater(metadata['patches'], 1)
+            self.assertTrue( np.all(levels[100:130, 150:180] == 3) )
+            tops, lefts = np.array([96, 128]), np.array([160, 160])
+            self.assertTrue( np.allclose(metric_map[tops, lefts], metric_values_at(dist, ref, metric_name, tops, lefts, 32)) )
+
+        metric_map, levels, metadata = libra.compute_adaptive_metric_map(ref, ref, "MSE", "RGB", 32, 3)
+        self.assertEqual(metadata['patches'], 1)
+
+
+    def test_dense_map(self):
+        '''
+        Ensure that dense maps pool to the values of their metrics
+        '''
+        image_pair = libra.ImagePair(self.cmp_path, self.ref_path)
+        for metric_name in ["SSIM", "GMSD", "MDSI", "HaarPSI", "FSIM", "VSI"]:
+            for color_space in ["RGB", "LAB"]:
+                metric_map, metadata = libra.compute_dense_map(image_pair, None, metric_name, color_space)
+                self.assertEqual(metric_map.shape, image_pair.image('dist').shape[:2])
+                self.assertEqual(metric_map.dtype, np.float32)
+                self.assertAlmostEqual(metadata['score'], libra.compute_metric(self.cmp_path, self.ref_path, metric_name, color_space), places=6)
+
+        # One channel is compared as a grayscale image
+        import piq
+        metric_map, metadata = libra.compute_dense_map(image_pair, None, "GMSD", "LAB", channel=0)
+        x, y = image_pair.tensor('dist', "LAB")[:, :1], image_pair.tensor('ref', "LAB")[:, :1]
+        self.assertAlmostEqual(metadata['score'], piq.gmsd(x, y).item(), places=6)
+        with self.assertRaises(KeyError):
+            libra.compute_dense_map(self.cmp_path, self.ref_path, "LPIPS", "RGB")
+
+
+    def test_preprocess_image(self):
+        '''
+        Ensure that images are converted to tensors in one channels-last buffer, reused when given
+        '''
+        import torch
+        from src.libra.metrics import preprocess_image
+        image = libra.load_image(self.cmp_path)
+
+        tensor = preprocess_image(image)
+        expected = torch.tensor(image.astype(np.float32) / 255.0).permute(2, 0, 1).unsqueeze(0)
+        self.assertTrue(torch.equal(tensor, expected))
+        self.assertEqual(tensor.stride(), expected.stride())
+        self.assertTrue(tensor.is_contiguous(memory_format=torch.channels_last))
+
+        # The buffer of a previous tensor of the same shape is reused, others are not
+        other = preprocess_image(255 - image, out=tensor)
+        self.assertEqual(other.data_ptr(), tensor.data_ptr())
+        self.assertTrue(torch.equal(other, torch.tensor((255 - image).astype(np.float32) / 255.0).permute(2, 0, 1).unsqueeze(0)))
+        smaller = preprocess_image(image[:100], out=tensor)
+        self.assertNotEqual(smaller.data_ptr(), tensor.data_ptr())
+
+        # Distorted images compared to one reference give the same results with reused buffers
+        dists = [self.cmp_path, self.ref_path, self.cmp_path]
+        results = [result for _, result in libra.compare_to_reference(self.ref_path, dists, ["PSNR", "SSIM"], ["RGB"])]
+        for dist, result in zip(dists, results):
+            self.assertEqual(result, libra.ImagePair(dist, self.ref_path).compute(["PSNR", "SSIM"], ["RGB"]))
+
+
     def test_map_computation(self):
         '''
         Ensure that map computation has not changed
@@ -78,8 +279,649 @@ class TestLibra(unittest.TestCase):
         
         self.assertTrue( libra.is_same(map_hsv_mse, map_hsv_mse_computed) )
         self.assertTrue( libra.is_same(map_hsv_ssim, map_hsv_ssim_computed) )
-        
-        
+
+
+    def test_batched_map_computation(self):
+        '''
+        Ensure that batched patch evaluation gives the same map as evaluating patches one by one
+        '''
+        from src.libra.map_computation import compute_patchwise_metric, compute_batched_patchwise_metric
+        from src.libra.metrics import metrics
+
+        img1 = libra.load_image(self.cmp_path)[:96, :128]
+        img2 = libra.load_image(self.ref_path)[:96, :128]
+
+        for metric_name in ['SSIM', 'PSNR']:
+            expected = compute_patchwise_metric(img1, img2, 32, 12, metrics[metric_name])
+            computed = compute_batched_patchwise_metric(img1, img2, 32, 12, metric_name, batch_size=5)
+            self.assertTrue( np.allclose(expected, computed, atol=1e-6) )
+
+
+    def test_box_map_computation(self):
+        '''
+        Ensure that summed-area table maps match evaluating the metric patch by patch
+        '''
+        from src.libra.map_computation import compute_patchwise_metric, compute_box_metric_map
+        from src.libra.metrics import metrics
+
+        img1 = libra.load_image(self.cmp_path)[:96, :128]
+        img2 = libra.load_image(self.ref_path)[:96, :128]
+
+        expected = compute_patchwise_metric(img1, img2, 21, 7, metrics['MAE'])
+        computed = compute_box_metric_map(img1, img2, 'MAE', 21, 7)
+        self.assertTrue( np.allclose(expected, computed) )
+
+
+    def test_batch(self):
+        '''
+        Ensure that batch mode reads manifests and records errors per pair
+        '''
+        import csv
+        import tempfile
+        from src.libra.batch import read_manifest, run_batch
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            manifest_path = os.path.join(temp_dir, "pairs.csv")
+            with open(manifest_path, 'w') as file:
+                file.write("reference,distorted\n")
+                file.write(f"{os.path.abspath(self.ref_path)},{os.path.abspath(self.cmp_path)}\n")
+                file.write(f"{os.path.abspath(self.ref_path)},missing.png\n")
+
+            pairs = read_manifest(manifest_path)
+            self.assertEqual(len(pairs), 2)
+
+            # Threads are limited for the run only
+            import torch
+            from src.libra import inference
+            settings, num_threads = inference.get_settings(), torch.get_num_threads()
+            output_path = os.path.join(temp_dir, "metrics.csv")
+            self.assertEqual(run_batch(pairs, ['SSIM', 'MSE'], ['RGB'], output_path, workers=1, num_threads=num_threads + 1), (2, 1))
+            self.assertEqual((inference.get_settings(), torch.get_num_threads()), (settings, num_threads))
+
+            with open(output_path) as file:
+                rows = list(csv.DictReader(file))
+
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(float(rows[0]['RGB']), libra.compute_metric(self.cmp_path, self.ref_path, 'SSIM', 'RGB'))
+        self.assertTrue(rows[2]['Error'].startswith("FileNotFoundError"))
+
+        # Models that fail to load, or workers that die, are recorded as the error of each pair
+        from unittest import mock
+        from urllib.error import URLError
+        from src.libra.model_registry import model_factories, evict
+
+        def unreachable(device, **params):
+            raise URLError("no network")
+
+        def crash(device, **params):
+            os._exit(1)
+
+        pairs = [(self.ref_path, self.cmp_path)] * 3
+        for factory, workers, error in [(unreachable, 1, "URLError"), (unreachable, 2, "URLError"), (crash, 2, "BrokenProcessPool")]:
+            with tempfile.TemporaryDirectory() as temp_dir, mock.patch.dict(model_factories, {'LPIPS': (factory, 'cpu')}):
+                evict('LPIPS')
+                output_path = os.path.join(temp_dir, "metrics.csv")
+                self.assertEqual(run_batch(pairs, ['LPIPS', 'MSE'], ['RGB'], output_path, workers=workers), (3, 3))
+                with open(output_path) as file:
+                    rows = list(csv.DictReader(file))
+            self.assertEqual(len(rows), 3)
+            self.assertTrue( all(row['Error'].startswith(error) for row in rows) )
+
+
+    def test_tiling(self):
+        '''
+        Ensure that tiled evaluation gives the same results as whole-image evaluation
+        '''
+        from src.libra.tiling import compute_metric_tiled, compute_map_tiled
+        from src.libra.map_computation import compute_box_metric_map, convert_map_color_space
+
+        img1 = libra.load_image(self.cmp_path)
+        img2 = libra.load_image(self.ref_path)
+
+        for metric_name in ['MSE', 'MAE']:
+            expected = libra.compute_metric(self.cmp_path, self.ref_path, metric_name, 'LAB')
+            computed = compute_metric_tiled(img1, img2, metric_name, 'LAB', memory_budget=2**20)
+            self.assertAlmostEqual(expected, computed)
+
+        expected = compute_box_metric_map(convert_map_color_space(img1, 'HSV'), convert_map_color_space(img2, 'HSV'), 'MAE', 31, 9)
+        computed = compute_map_tiled(img1, img2, 'MAE', 'HSV', 31, 9, memory_budget=2**20)
+        self.assertTrue( np.allclose(expected, computed, atol=1e-4) )
+
+        # Patch values are memory-mapped next to the map, and removed
+        import tempfile
+        with tempfile.TemporaryDirectory() as folder:
+            out_path = os.path.join(folder, "map.npy")
+            computed = compute_map_tiled(img1, img2, 'MAE', 'HSV', 31, 9, memory_budget=2**20, out_path=out_path)
+            self.assertTrue( np.allclose(expected, computed, atol=1e-4) )
+            self.assertEqual(os.listdir(folder), ["map.npy"])
+            del computed
+
+        # SSIM maps are the per-pixel maps of compute_metric_map
+        expected, _ = libra.compute_metric_map(img1, img2, 'SSIM', 'HSV')
+        computed = compute_map_tiled(img1, img2, 'SSIM', 'HSV', memory_budget=2**16)
+        self.assertTrue( np.allclose(expected, computed, atol=1e-6) )
+
+
+    def test_import_time(self):
+        '''
+        Ensure that importing libra stays fast and does not load the heavy dependencies
+        '''
+        import subprocess
+
+        code = ("import sys, time; start = time.perf_counter(); import src.libra; "
+                "print(time.perf_counter() - start); "
+                "print(','.join(m for m in ['torch', 'piq', 'pyiqa', 'matplotlib'] if m in sys.modules))")
+        result = subprocess.run([sys.executable, "-c", code], cwd="..", capture_output=True, text=True, check=True)
+        import_time, loaded_modules = result.stdout.split('\n')[:2]
+
+        self.assertLess(float(import_time), IMPORT_TIME_BUDGET)
+        self.assertEqual(loaded_modules, "")
+
+
+    def test_model_registry(self):
+        '''
+        Ensure that models are built once and can be evicted
+        '''
+        from unittest import mock
+        from src.libra.model_registry import ModelRegistry, register_model, model_factories
+
+        # The test models are registered for this test only
+        with mock.patch.dict(model_factories):
+            builds = []
+            register_model('TEST', lambda device, **params: builds.append(device) or object())
+
+            registry = ModelRegistry()
+            model = registry.get('TEST')
+            self.assertIs(registry.get('TEST'), model)
+            self.assertIsNot(registry.get('TEST', 'cuda'), model)
+            self.assertEqual(builds, ['cpu', 'cuda'])
+
+            self.assertEqual(registry.evict('TEST', 'cuda'), 1)
+            self.assertIs(registry.get('TEST'), model)
+            self.assertEqual(registry.evict(), 1)
+            registry.get('TEST')
+            self.assertEqual(len(builds), 3)
+
+            # Lowering the memory limit drops the least recently used models, keeping the newest
+            import torch
+            register_model('TEST_MODULE', lambda device, **params: torch.nn.Linear(16, 16))
+            registry.get('TEST_MODULE', size=1)
+            newest = registry.get('TEST_MODULE', size=2)
+            registry.set_memory_limit(1)
+            self.assertEqual(registry.max_bytes, 1)
+            self.assertEqual(len(registry.keys()), 1)
+            self.assertIs(registry.get('TEST_MODULE', size=2), newest)
+
+            # A factory that fails leaves no build lock behind
+            def fail(device, **params):
+                raise OSError("missing weights")
+            register_model('TEST_FAILING', fail)
+            with self.assertRaises(OSError):
+                registry.get('TEST_FAILING')
+            self.assertEqual(registry._build_locks, {})
+        self.assertNotIn('TEST', model_factories)
+
+
+    def test_profiling(self):
+        '''
+        Ensure that profiling records the stages of a comparison only while it is enabled
+        '''
+        import json
+        import tempfile
+        from src.libra import profiling
+
+        libra.compute_metric(self.cmp_path, self.ref_path, 'MSE', 'LAB')
+        self.assertEqual(profiling.summary(), [])
+
+        profiling.enable()
+        try:
+            libra.compute_metric(self.cmp_path, self.ref_path, 'MSE', 'LAB')
+        finally:
+            profiling.disable()
+
+        calls = {row['Stage']: row['Calls'] for row in profiling.summary()}
+        self.assertEqual(calls, {'imread': 2, 'cvtColor': 2, 'forward': 1})
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            trace_path = os.path.join(temp_dir, "trace.json")
+            profiling.write_chrome_trace(trace_path)
+            with open(trace_path) as file:
+                events = json.load(file)['traceEvents']
+        self.assertEqual(len(events), 5)
+        profiling.reset()
+
+
+    def test_result_cache(self):
+        '''
+        Ensure that cached results are reused, keyed by image content, and evicted when too large
+        '''
+        import tempfile
+        from src.libra.result_cache import enable_cache, disable_cache
+
+        expected = libra.compute_metric(self.cmp_path, self.ref_path, 'PSNR', 'LAB')
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = enable_cache(os.path.join(temp_dir, "results.sqlite"))
+            try:
+                self.assertEqual(libra.compute_metric(self.cmp_path, self.ref_path, 'PSNR', 'LAB'), expected)
+                self.assertEqual(len(cache), 1)
+
+                # A second call reads the stored result
+                libra.compute_metric(self.cmp_path, self.ref_path, 'PSNR', 'LAB')
+                self.assertEqual(len(cache), 1)
+                pair = libra.ImagePair(self.cmp_path, self.ref_path)
+                key = cache.make_key('metric', pair.content_hash('dist'), pair.content_hash('ref'), 'PSNR', 'LAB')
+                self.assertEqual(cache.get(key), expected)
+
+                # Settings changing the values of a metric are part of its keys
+                from src.libra import inference
+                hashes = (pair.content_hash('dist'), pair.content_hash('ref'))
+                lpips_key = cache.make_key('metric', *hashes, 'LPIPS', 'LAB')
+                previous = inference.configure(bfloat16=True)
+                try:
+                    self.assertNotEqual(cache.make_key('metric', *hashes, 'LPIPS', 'LAB'), lpips_key)
+                    self.assertEqual(cache.make_key('metric', *hashes, 'PSNR', 'LAB'), key)
+                finally:
+                    inference.configure(**previous)
+
+                # Keys change with the sources of libra, installed or not
+                from unittest import mock
+                from src.libra import result_cache
+                self.assertIsNotNone(result_cache.package_versions()['libra'])
+                with mock.patch.object(result_cache, '_source_hash', "changed"):
+                    changed = result_cache.ResultCache(os.path.join(temp_dir, "changed.sqlite"))
+                self.assertNotEqual(changed.make_key('metric', *hashes, 'PSNR', 'LAB'), key)
+
+                cache.max_bytes = cache.size()
+                libra.compute_metric(self.cmp_path, self.ref_path, 'PSNR', 'HSV')
+                self.assertEqual(len(cache), 1)
+                self.assertIsNone(cache.get(key))
+            finally:
+                disable_cache()
+
+
+    def test_metric_map(self):
+        '''
+        Ensure that raw maps match the patchwise computation and render without matplotlib
+        '''
+        from src.libra.map_computation import compute_patchwise_metric, convert_map_color_space
+        from src.libra.metrics import metrics
+
+        img1 = libra.load_image(self.cmp_path)[:96, :128]
+        img2 = libra.load_image(self.ref_path)[:96, :128]
+
+        metric_map, metadata = libra.compute_metric_map(img1, img2, 'GMSD', 'LAB', 32, 16)
+        expected = compute_patchwise_metric(convert_map_color_space(img1, 'LAB'), convert_map_color_space(img2, 'LAB'), 32, 16, metrics['GMSD'])
+        self.assertEqual(metric_map.dtype, np.float32)
+        self.assertTrue( np.allclose(metric_map, expected, atol=1e-5) )
+        self.assertAlmostEqual(metadata['max'], float(metric_map.max()))
+
+        metric_map[0, 0] = np.nan
+        image = libra.render_map(metric_map, 'JET', colorbar=False)
+        self.assertEqual(image.shape, (96, 128, 3))
+        self.assertEqual(image[0, 0].tolist(), [0, 0, 0])
+        self.assertGreater(libra.render_map(metric_map, 'gray', title='GMSD').shape[1], 128)
+
+
+    def test_fused_metrics(self):
+        '''
+        Ensure that the fused SSIM and GMSD families match piq and share their intermediates
+        '''
+        import piq
+        from src.libra.fused_metrics import FusedMetrics
+        from src.libra.metrics import preprocess_image
+
+        for shape in [(300, 320), (512, 640), (767, 901)]:
+            x = preprocess_image(libra.load_image(self.cmp_path)[:shape[0], :shape[1]])
+            y = preprocess_image(libra.load_image(self.ref_path)[:shape[0], :shape[1]])
+            workspace = FusedMetrics(x, y)
+            self.assertEqual(workspace.ssim().item(), piq.ssim(x, y).item())
+            self.assertEqual(workspace.ms_ssim().item(), piq.multi_scale_ssim(x, y).item())
+            self.assertAlmostEqual(workspace.gmsd().item(), piq.gmsd(x, y).item(), places=6)
+            self.assertAlmostEqual(workspace.ms_gmsd().item(), piq.multi_scale_gmsd(x, y).item(), places=6)
+
+        # MS-SSIM reuses the statistics of SSIM, and MS-GMSD the gradients of GMSD
+        x, y = x[..., :300, :300], y[..., :300, :300]
+        workspace = FusedMetrics(x, y)
+        workspace.ssim()
+        workspace.gmsd()
+        statistics, gradients = workspace._memo['xy'][('ssim_statistics', ('pyramid', 0))], workspace._memo['x'][('gradients', 1)]
+        workspace.ms_ssim()
+        workspace.ms_gmsd()
+        self.assertIs(workspace._memo['xy'][('ssim_statistics', ('pyramid', 0))], statistics)
+        self.assertIs(workspace._memo['x'][('gradients', 1)], gradients)
+
+
+    def test_sequence(self):
+        '''
+        Ensure that frame sequences are compared in natural order with per-frame rows and aggregates
+        '''
+        import csv
+        import tempfile
+        import cv2
+        from src.libra.sequence import compare_sequences, summary_path
+
+        ref = libra.load_image(self.ref_path)[400:464, 400:464]
+        cmp = libra.load_image(self.cmp_path)[400:464, 400:464]
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.makedirs(os.path.join(temp_dir, "ref"))
+            os.makedirs(os.path.join(temp_dir, "cmp"))
+            for i in range(11):
+                # Frame 10 is the most distorted, and sorts before frame 2 alphabetically
+                cv2.imwrite(os.path.join(temp_dir, "ref", f"frame_{i}.png"), ref)
+                cv2.imwrite(os.path.join(temp_dir, "cmp", f"frame_{i}.png"), cmp if i == 10 else ref)
+
+            output_path = os.path.join(temp_dir, "frames.csv")
+            summary = compare_sequences(os.path.join(temp_dir, "ref", "frame_*.png"), os.path.join(temp_dir, "cmp"),
+                                        ['SSIM', 'MAE'], ['RGB'], output_path, worst_count=1)
+            with open(output_path) as file:
+                rows = list(csv.DictReader(file))
+            self.assertTrue(os.path.exists(summary_path(output_path)))
+
+        self.assertEqual(len(rows), 22)
+        self.assertEqual(float(rows[20]['RGB']), libra.compute_metric(cmp, ref, 'SSIM', 'RGB'))
+        self.assertEqual([row['Worst frames'] for row in summary], ["10", "10"])
+        self.assertEqual(summary[0]['Frames'], 11)
+        self.assertEqual(summary[0]['Max'], 1.0)
+
+
+    def test_fan_out(self):
+        '''
+        Ensure that comparing many images to one reference reuses the reference and gives the same results
+        '''
+        metric_names = ['SSIM', 'MS-SSIM', 'GMSD', 'PSNR']
+        colorspace_names = ['RGB', 'LAB']
+        ref_image = libra.load_image(self.ref_path)
+        cmp_image = libra.load_image(self.cmp_path)
+        dists = [cmp_image, cmp_image[::-1, ::-1].copy(), ref_image]
+
+        results = list(libra.compare_to_reference(ref_image, dists, metric_names, colorspace_names))
+        for dist, dist_results in results:
+            self.assertEqual(dist_results, libra.ImagePair(dist, ref_image).compute(metric_names, colorspace_names))
+
+        pair = libra.ImagePair(cmp_image, ref_image)
+        pair.compute(['SSIM'], ['LAB'])
+        other = pair.with_distorted(ref_image)
+        self.assertIs(other.tensor('ref', 'LAB'), pair.tensor('ref', 'LAB'))
+        self.assertIs(other.workspace('LAB')._memo['y'], pair.workspace('LAB')._memo['y'])
+
+
+    def test_distance_matrix(self):
+        '''
+        Ensure that a pairwise LPIPS matrix extracts the features of each image once and matches compute_metric
+        '''
+        import tempfile
+        from src.libra import profiling, inference
+        from src.libra.model_registry import get_model
+
+        # Features extracted under other inference settings are not reused from a spill directory
+        key = libra.FeatureCache.make_key('LPIPS', self.ref_path, 'RGB')
+        previous = inference.configure(bfloat16=True)
+        try:
+            self.assertNotEqual(libra.FeatureCache.make_key('LPIPS', self.ref_path, 'RGB'), key)
+        finally:
+            inference.configure(**previous)
+
+        # Nor features extracted by other sources of libra
+        from unittest import mock
+        from src.libra import result_cache
+        with mock.patch.object(result_cache, '_source_hash', "changed"):
+            self.assertNotEqual(libra.FeatureCache.make_key('LPIPS', self.ref_path, 'RGB'), key)
+
+        try:
+            get_model('LPIPS')
+        except Exception as e:
+            self.skipTest(f"LPIPS weights are not available: {e}")
+
+        # Images of another dtype are converted, the shared model is left as it is
+        from src.libra.metrics import preprocess_image
+        from src.libra.deep_features import extract_features
+        x = preprocess_image(libra.load_image(self.ref_path)[:64, :64])
+        features = extract_features('LPIPS', x.double())
+        self.assertEqual(next(get_model('LPIPS').parameters()).dtype, x.dtype)
+        self.assertTrue( all(a.equal(b) for a, b in zip(features, extract_features('LPIPS', x))) )
+
+        images = [libra.load_image(path)[400:528, 400:560] for path in (self.ref_path, self.cmp_path)]
+        images.append(images[1][::-1].copy())
+
+        profiling.enable()
+        try:
+            with tempfile.TemporaryDirectory() as spill_dir:
+                # Features do not fit in memory and are spilled to disk
+                matrix = libra.distance_matrix(images, 'LPIPS', feature_cache=libra.FeatureCache(max_bytes=1, spill_dir=spill_dir))
+                extractions = profiling.counters()['feature extractions']
+        finally:
+            profiling.disable()
+
+        self.assertEqual(extractions, 3)
+        self.assertTrue( np.array_equal(matrix, matrix.T) )
+        self.assertEqual(matrix[0, 1], libra.compute_metric(images[0], images[1], 'LPIPS', 'RGB'))
+
+
+    def test_phash_index(self):
+        '''
+        Ensure that the pHash index finds the same neighbors and near-duplicates as comparing every pair of hashes
+        '''
+        import tempfile
+        from src.libra.phash_index import image_hash, hamming_distance
+
+        rng = np.random.default_rng(0)
+        hashes = rng.integers(0, 2**64 - 1, size=300, dtype=np.uint64, endpoint=True)
+        # Near-duplicates of the first hashes, with a few flipped bits, and exact duplicates
+        flips = [np.uint64(sum(1 << int(b) for b in rng.choice(64, rng.integers(0, 6), replace=False))) for _ in range(100)]
+        hashes = np.concatenate([hashes, hashes[:100] ^ np.array(flips, dtype=np.uint64), hashes[:10]])
+        index = libra.PHashIndex(hashes)
+
+        distances = hamming_distance(hashes[:, None], hashes[None, :])
+        i, j = np.triu_indices(len(hashes), 1)
+        for k in [0, 3, 8, 20]:
+            within = distances[i, j] <= k
+            expected = set(zip(i[within].tolist(), j[within].tolist(), distances[i, j][within].tolist()))
+            self.assertEqual(set(map(tuple, index.near_duplicates(k, block_pairs=1000).tolist())), expected)
+            self.assertEqual(sorted(index.query(hashes[5], k)),
+                             sorted((int(n), int(distances[5, n])) for n in np.flatnonzero(distances[5] <= k)))
+
+        self.assertEqual(libra.PHashIndex(np.zeros(0, dtype=np.uint64)).near_duplicates(3).shape, (0, 3))
+        values = np.arange(1 << 16, dtype=np.uint64)
+        self.assertEqual(hamming_distance(values, 0).tolist(), [bin(value).count('1') for value in range(1 << 16)])
+        self.assertEqual(np.shape(hamming_distance(hashes[0], hashes[1])), ())
+        self.assertEqual(hamming_distance(hashes[:6].reshape(2, 3), hashes[0]).shape, (2, 3))
+
+        ref_image = libra.load_image(self.ref_path)
+        cmp_image = libra.load_image(self.cmp_path)
+        self.assertEqual(libra.compute_metric(cmp_image, ref_image, 'PHASH', 'RGB'),
+                         hamming_distance(image_hash(cmp_image[:, :, ::-1]), image_hash(ref_image[:, :, ::-1])))
+
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "index.npz")
+            index.save(path)
+            self.assertTrue( np.array_equal(libra.PHashIndex.load(path).near_duplicates(3), index.near_duplicates(3)) )
+
+
+    def test_inference_settings(self):
+        '''
+        Ensure that the inference settings keep the metric values of the default settings
+        '''
+        from src.libra import inference
+        from src.libra.model_registry import get_model
+
+        ref_image = libra.load_image(self.ref_path)[400:528, 400:528]
+        cmp_image = libra.load_image(self.cmp_path)[400:528, 400:528]
+        metric_names = ['SSIM', 'PSNR', 'GMSD', 'VSI', 'MDSI']
+        expected = {metric_name: libra.compute_metric(cmp_image, ref_image, metric_name, 'RGB') for metric_name in metric_names}
+
+        for settings in [{'inference_mode': False}, {'num_threads': 1, 'channels_last': True}]:
+            previous = inference.configure(**settings)
+            try:
+                for metric_name in metric_names:
+                    self.assertAlmostEqual(libra.compute_metric(cmp_image, ref_image, metric_name, 'RGB'), expected[metric_name], places=6)
+            finally:
+                inference.configure(**previous)
+
+        with self.assertRaises(KeyError):
+            inference.configure(half=True)
+
+        try:
+            get_model('LPIPS')
+        except Exception as e:
+            self.skipTest(f"LPIPS weights are not available: {e}")
+
+        lpips = libra.compute_metric(cmp_image, ref_image, 'LPIPS', 'RGB')
+        previous = inference.configure(bfloat16=True)
+        try:
+            self.assertAlmostEqual(libra.compute_metric(cmp_image, ref_image, 'LPIPS', 'RGB'), lpips, delta=1e-2)
+        finally:
+            inference.configure(**previous)
+
+
+    def test_numpy_backend(self):
+        '''
+        Ensure that the NumPy and OpenCV backend of the classical metrics agrees with torch and piq
+        '''
+        from src.libra import inference
+        from src.libra.numpy_backend import numpy_metrics, numpy_tolerance, numpy_image_hash, resolve_backend
+        from src.libra.phash_index import image_hash
+
+        image_pair = libra.ImagePair(self.cmp_path, self.ref_path)
+        for color_space in ['RGB', 'HSV', 'LAB', 'YCrCb']:
+            for metric_name in numpy_metrics:
+                expected = image_pair.compute_metric(metric_name, color_space, backend='torch')
+                self.assertAlmostEqual(image_pair.compute_metric(metric_name, color_space, backend='numpy'), expected, delta=numpy_tolerance)
+
+        # Odd sizes, and images small enough not to be downsampled by SSIM
+        ref_image = libra.load_image(self.ref_path)[301:498, 402:617]
+        cmp_image = libra.load_image(self.cmp_path)[301:498, 402:617]
+        for metric_name in numpy_metrics:
+            self.assertAlmostEqual(libra.compute_metric(cmp_image, ref_image, metric_name, 'LAB', backend='numpy'),
+                                   libra.compute_metric(cmp_image, ref_image, metric_name, 'LAB', backend='torch'), delta=numpy_tolerance)
+
+        # Hashes are those of imagehash
+        rng = np.random.default_rng(0)
+        for height, width in [(32, 32), (7, 300), (517, 45), (1085, 1100)]:
+            image = np.cumsum(rng.integers(0, 8, (height, width, 3)), axis=1).astype(np.uint8)
+            self.assertEqual(numpy_image_hash(image), image_hash(image))
+
+        # The process-wide setting applies to calls without a backend, and auto uses torch when it is installed
+        previous = inference.configure(classical_backend='numpy')
+        try:
+            self.assertEqual(libra.compute_metric(self.cmp_path, self.ref_path, 'SSIM', 'RGB'),
+                             image_pair.compute_metric('SSIM', 'RGB', backend='numpy'))
+        finally:
+            inference.configure(**previous)
+        self.assertEqual(resolve_backend('auto', 'SSIM'), 'torch')
+        with self.assertRaises(ValueError):
+            libra.compute_metric(self.cmp_path, self.ref_path, 'LPIPS', 'RGB', backend='numpy')
+        with self.assertRaises(ValueError):
+            inference.configure(classical_backend='cuda')
+
+
+    def test_onnx_backend(self):
+        '''
+        Ensure that the networks run with ONNX Runtime match torch, are exported once, and are cached apart from torch
+        '''
+        import importlib.util
+        import tempfile
+        from src.libra import inference, onnx_backend
+        from src.libra.model_registry import get_model
+
+        # Results and features of the ONNX networks, float32 or int8, are keyed apart from those of torch
+        keys = set()
+        for settings in [{}, {'backend': 'onnx'}, {'backend': 'onnx', 'int8': True}]:
+            previous = inference.configure(**settings)
+            try:
+                keys.add(libra.FeatureCache.make_key('LPIPS', self.ref_path, 'RGB'))
+                self.assertEqual(inference.value_settings('SSIM'), {})
+            finally:
+                inference.configure(**previous)
+        self.assertEqual(len(keys), 3)
+
+        for package in ('onnxruntime', 'onnx', 'onnxscript'):
+            if importlib.util.find_spec(package) is None:
+                self.skipTest(f"{package} is not installed")
+
+        metric_names = []
+        for metric_name in ['LPIPS', 'DISTS', 'NIMA', 'MUSIQ']:
+            try:
+                get_model(metric_name)
+                metric_names.append(metric_name)
+            except Exception:
+                pass
+        if not metric_names:
+            self.skipTest("No weights of LPIPS, DISTS, NIMA or MUSIQ are available")
+
+        ref_image = libra.load_image(self.ref_path)[400:528, 400:560]
+        cmp_image = libra.load_image(self.cmp_path)[400:528, 400:560]
+        expected = {metric_name: libra.compute_metric(cmp_image, ref_image, metric_name, 'RGB') for metric_name in metric_names}
+
+        default_onnx_dir = onnx_backend.default_onnx_dir
+        previous = inference.configure(backend='onnx')
+        try:
+            with tempfile.TemporaryDirectory() as onnx_dir:
+                onnx_backend.default_onnx_dir = onnx_dir
+                for metric_name in metric_names:
+                    value = libra.compute_metric(cmp_image, ref_image, metric_name, 'RGB')
+                    self.assertAlmostEqual(value, expected[metric_name], delta=1e-4 * max(1.0, abs(expected[metric_name])))
+                if 'LPIPS' in metric_names:
+                    # Other sizes run the same network
+                    libra.compute_metric(cmp_image[:96, :100], ref_image[:96, :100], 'LPIPS', 'RGB')
+                    self.assertEqual(len([name for name in os.listdir(onnx_dir) if name.startswith('LPIPS-')]), 1)
+        finally:
+            onnx_backend.default_onnx_dir = default_onnx_dir
+            inference.configure(**previous)
+
+
+    def test_server(self):
+        '''
+        Ensure that a local comparison server batches concurrent requests and returns the values of the library
+        '''
+        import tempfile
+        import threading
+        from src.libra.server import ComparisonServer, ComparisonClient
+
+        ref_image = libra.load_image(self.ref_path)
+        cmp_image = libra.load_image(self.cmp_path)
+        crops = [(cmp_image[y:y + 64, 400:464].copy(), ref_image[y:y + 64, 400:464].copy()) for y in range(300, 700, 50)]
+
+        server = ComparisonServer(batch_window=0.5, max_batch_size=len(crops))
+        address = server.start("127.0.0.1:0")
+        try:
+            values = {}
+            def compare(index):
+                with ComparisonClient(address) as client:
+                    values[index] = client.compute_metric(*crops[index], 'SSIM', 'RGB')
+
+            threads = [threading.Thread(target=compare, args=(index,)) for index in range(len(crops))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            for index, (dist, ref) in enumerate(crops):
+                self.assertAlmostEqual(values[index], libra.compute_metric(dist, ref, 'SSIM', 'RGB'), places=6)
+
+            with ComparisonClient(address) as client:
+                self.assertEqual(client.stats()['largest batch'], len(crops))
+                self.assertEqual(client.compute_metric(self.cmp_path, self.ref_path, 'MAE', 'RGB'),
+                                 libra.compute_metric(self.cmp_path, self.ref_path, 'MAE', 'RGB'))
+                metric_map, metadata = client.compute_metric_map(*crops[0], 'PSNR', 'RGB', 32, 16)
+                self.assertTrue( np.array_equal(metric_map, libra.compute_metric_map(*crops[0], 'PSNR', 'RGB', 32, 16)[0], equal_nan=True) )
+                with self.assertRaises(RuntimeError):
+                    client.compute_metric("missing.png", self.ref_path, 'SSIM', 'RGB')
+        finally:
+            server.stop()
+
+        with tempfile.TemporaryDirectory() as folder:
+            server = ComparisonServer()
+            address = server.start(os.path.join(folder, "libra.sock"))
+            try:
+                with ComparisonClient(address) as client:
+                    heatmap, _ = client.diff_images(self.cmp_path, self.ref_path, 10, 'HSV')
+                self.assertTrue( np.array_equal(heatmap, libra.diff_images(self.cmp_path, self.ref_path, 10, 'HSV')[0]) )
+            finally:
+                server.stop()
+
+
 if __name__ == '__main__':
     unittest.main()
     